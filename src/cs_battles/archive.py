@@ -0,0 +1,279 @@
+"""
+Archive of finished battles.
+
+Battles finished more than ``BATTLE_ARCHIVE_DAYS`` days ago are moved out of
+the hot tables by the archive_battles command. The ranked participations, with
+the digests of their sources, are stored as compressed JSON in a BattleArchive
+row (sources stay in the source store, see cs_battles.sources) and every
+participation except the winner is deleted. The responses and response items
+belong to cs_core and are kept, unless ``BATTLE_ARCHIVE_PURGE_RESPONSES`` is
+true (or the command runs with --purge-responses). Each battle is archived in
+its own transaction and flagged with ``Battle.archived``, so an interrupted
+run is simply started again.
+
+The result pages read archived battles from here transparently.
+"""
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from cs_battles import code_metrics, queries
+from cs_battles.models import Battle, BattleArchive, SourceBlob
+from cs_core.models import Response, ResponseItem
+
+
+def compress(payload):
+    data = json.dumps(payload, separators=(',', ':')).encode('utf8')
+    return zlib.compress(data, 9)
+
+
+def decompress(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf8'))
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def _metrics(battle, battle_response):
+    """Stored metrics, measuring those left for later by sync grading."""
+    stored = {name: battle_response.metric(name)
+              for name in code_metrics.METRICS}
+    missing = [name for name, value in stored.items() if value is None]
+    source = battle_response.source
+    if missing and source is not None:
+        stored.update(code_metrics.measure(source, battle.language, missing))
+    return stored
+
+
+def build_payload(battle):
+    """Ranked participations of a battle, with their source digests."""
+    participants = []
+    ranked = queries.participations(
+        battle.battles.ranked(battle.challenge_type))
+    for battle_response in ranked.iterator():
+        user = battle_response.response.user
+        last_item = battle_response.last_item
+        blob = battle_response.source_blob
+        if blob is None and last_item is not None:
+            blob = SourceBlob.objects.store(battle_response.source)
+        duration = None
+        if battle_response.time_end is not None:
+            duration = (battle_response.time_end
+                        - battle_response.time_begin).total_seconds()
+        participants.append({
+            'id': battle_response.pk,
+            'user': str(user),
+            'user_id': user.id,
+            'username': user.username,
+            'time_begin': _isoformat(battle_response.time_begin),
+            'time_end': _isoformat(battle_response.time_end),
+            'time': duration,
+            'length': blob.length if blob else None,
+            'metrics': _metrics(battle, battle_response),
+            'grade': (float(last_item.given_grade)
+                      if last_item and last_item.given_grade is not None
+                      else None),
+            'incorrect': bool(battle_response.incorrect),
+            'give_up': battle_response.give_up,
+            'submitions_used': battle_response.submitions_used,
+            'runtime': battle_response.runtime_median,
+            'runtime_iqr': battle_response.runtime_iqr,
+            'source_digest': blob.digest if blob else None,
+        })
+    return {
+        'battle': battle.pk,
+        'challenge_type': battle.challenge_type,
+        'winner': battle.battle_winner_id,
+        'finished_at': _isoformat(battle.finished_at),
+        'participants': participants,
+    }
+
+
+def purge_responses():
+    return getattr(settings, 'BATTLE_ARCHIVE_PURGE_RESPONSES', False)
+
+
+def purge(battle, responses=False):
+    """
+    Delete every participation but the winner and recompute the participant
+    counters. With ``responses`` the cs_core responses of the losers and the
+    items of the winner but its last one are deleted too.
+    """
+    losers = battle.battles.exclude(pk=battle.battle_winner_id)
+    response_ids = list(losers.values_list('response_id', flat=True))
+    losers.delete()
+    if responses:
+        Response.objects.filter(pk__in=response_ids).delete()
+        winner = battle.battle_winner
+        ResponseItem.objects.filter(response_id=winner.response_id) \
+                            .exclude(pk=winner.last_item_id) \
+                            .delete()
+    battle.invitations_user.clear()
+    Battle.objects.filter(pk=battle.pk).update(
+        active_count=0, finished_count=battle.battles.count())
+
+
+def archive_battle(battle_pk, responses=None):
+    """
+    Archive a finished battle, see purge() for ``responses``. Return False if
+    it has no winner or was already archived.
+    """
+    if responses is None:
+        responses = purge_responses()
+    with transaction.atomic():
+        battle = Battle.objects.select_for_update() \
+                               .select_related('battle_winner') \
+                               .get(pk=battle_pk)
+        if battle.archived or battle.battle_winner_id is None:
+            return False
+        payload = build_payload(battle)
+        BattleArchive.objects.create(battle=battle, data=compress(payload),
+                                     participants=len(payload['participants']))
+        purge(battle, responses)
+        Battle.objects.filter(pk=battle.pk).update(archived=True)
+        Battle.bump_version(battle.pk)
+    return True
+
+
+def candidates(days=None):
+    """Battles finished more than ``days`` days ago and not archived yet."""
+    if days is None:
+        days = getattr(settings, 'BATTLE_ARCHIVE_DAYS', 30)
+    cutoff = timezone.now() - timedelta(days=days)
+    return Battle.objects.filter(archived=False, finished_at__lt=cutoff)
+
+
+class ArchivedUser:
+    def __init__(self, row):
+        self.id = row['user_id']
+        self.username = row['username']
+        self.name = row['user']
+
+    def __str__(self):
+        return self.name
+
+
+class ArchivedResponse:
+    def __init__(self, row):
+        self.user = ArchivedUser(row)
+
+
+class ArchivedItem:
+    def __init__(self, row, source):
+        self.source = source
+        self.given_grade = row['grade']
+
+
+class ArchivedParticipation:
+    """Read only participation with the attributes used by the templates."""
+
+    def __init__(self, row, source=None):
+        self.pk = self.id = row['id']
+        self.response = ArchivedResponse(row)
+        self.time_begin = parse_datetime(row['time_begin'])
+        self.time_end = (parse_datetime(row['time_end'])
+                         if row['time_end'] else None)
+        self.last_item = ArchivedItem(row, source) if source is not None \
+            else None
+        self.source = source
+        self.source_size = row['length']
+        self.give_up = row['give_up']
+        self.submitions_used = row['submitions_used']
+        self.metrics = row.get('metrics', {})
+        self.runtime_median = row.get('runtime')
+        self.runtime_iqr = row.get('runtime_iqr')
+
+    def metric(self, name):
+        return self.metrics.get(name or 'bytes')
+
+
+def participants(battle):
+    """Archived participations, limited to the top sources of mass battles."""
+    rows = battle.archive.payload['participants']
+    if battle.mass:
+        rows = rows[:getattr(settings, 'BATTLE_MASS_TOP_SOURCES', 10)]
+    blobs = SourceBlob.objects.in_bulk(
+        [row['source_digest'] for row in rows if row.get('source_digest')])
+    # Early archives stored the sources inline
+    return [ArchivedParticipation(row, blobs[row['source_digest']].text
+                                  if row.get('source_digest')
+                                  else row.get('source'))
+            for row in rows]
+
+
+def results_entry(battle):
+    """The {'html', 'payload'} results entry of an archived battle."""
+    payload = battle.archive.payload
+    winner = battle.battle_winner
+    keys = ('id', 'user', 'user_id', 'time', 'length', 'grade', 'give_up',
+            'runtime')
+    return {
+        'html': render_to_string('battles/results.jinja2', {
+            'object': battle,
+            'all_battles': participants(battle),
+        }),
+        'payload': {
+            'battle': battle.pk,
+            'version': battle.version,
+            'challenge_type': battle.challenge_type,
+            'winner': battle.battle_winner_id,
+            'winner_user': str(winner.response.user) if winner else None,
+            'participants': [{key: row.get(key) for key in keys}
+                             for row in payload['participants']],
+        },
+    }
+
+
+def _length(battle, row):
+    """Length metric of an archived participation."""
+    if 'metrics' in row:
+        return row['metrics'].get(battle.length_metric or 'bytes')
+    return row['length']
+
+
+def standings(battle):
+    """Archived standings, in the format of queries.standings()."""
+    rows = []
+    for row in battle.archive.payload['participants']:
+        standing = {
+            'pk': row['id'],
+            'response__user__username': row['username'],
+            'time_begin': parse_datetime(row['time_begin']),
+            'time_end': (parse_datetime(row['time_end'])
+                         if row['time_end'] else None),
+            'give_up': row['give_up'],
+            'submitions_used': row['submitions_used'],
+            'incorrect': int(row['incorrect']),
+        }
+        if battle.challenge_type == 'length':
+            standing['source_length'] = (None if row['incorrect']
+                                         else _length(battle, row))
+        elif battle.challenge_type == 'runtime':
+            standing['runtime'] = (None if row['incorrect']
+                                   else row.get('runtime'))
+        elif row['time'] is not None:
+            standing['duration'] = timedelta(seconds=row['time'])
+        else:
+            standing['duration'] = None
+        rows.append(standing)
+    return rows
+
+
+def stats_results(battle):
+    """Participant results for BattleStats.objects.record_battle()."""
+    return [{
+        'pk': row['id'],
+        'response__user_id': row['user_id'],
+        'incorrect': int(row['incorrect']),
+        'source_length': None if row['incorrect'] else _length(battle, row),
+        'duration': (timedelta(seconds=row['time'])
+                     if row['time'] is not None else None),
+        'runtime': None if row['incorrect'] else row.get('runtime'),
+    } for row in battle.archive.payload['participants']]
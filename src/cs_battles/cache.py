@@ -0,0 +1,235 @@
+"""
+Caches used by cs_battles.
+
+LRUCache is a small thread safe in-memory cache. GradeCache stores the result
+of grading a source code so byte-identical resubmitions are not run again.
+The grade cache is disabled unless ``BATTLE_GRADE_CACHE`` is true.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Attributes of a response item that are copied from a cached grading
+CACHED_FIELDS = ('given_grade', 'feedback_data', 'status')
+
+_grade_cache = None
+
+
+class LRUCache:
+    """Mapping with a maximum size that evicts the least recently used key."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, predicate):
+        """Delete every key for which predicate(key) is true."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def normalize_source(source):
+    """
+    Normalize line endings and trailing blank space at the end of the file.
+    Nothing inside the code changes, so the normalized source always grades
+    like the original.
+    """
+    source = source.replace('\r\n', '\n').replace('\r', '\n')
+    return source.rstrip()
+
+
+def source_hash(source):
+    return hashlib.sha256(normalize_source(source).encode('utf8')).hexdigest()
+
+
+def iospec_hash(question):
+    iospec = question.iospec_source or ''
+    return hashlib.sha256(iospec.encode('utf8')).hexdigest()
+
+
+def dump_fields(fields):
+    """
+    JSON of the cached fields for the database tier, or None if they can not
+    be represented in JSON.
+    """
+    try:
+        return json.dumps(fields, cls=DjangoJSONEncoder)
+    except TypeError:
+        return None
+
+
+def load_fields(data):
+    fields = json.loads(data)
+    if fields.get('given_grade') is not None:
+        fields['given_grade'] = Decimal(fields['given_grade'])
+    return fields
+
+
+def get_grade_cache():
+    """Return the grade cache of the process, or None if it is disabled."""
+    global _grade_cache
+    if not getattr(settings, 'BATTLE_GRADE_CACHE', False):
+        return None
+    if _grade_cache is None:
+        _grade_cache = GradeCache(
+            maxsize=getattr(settings, 'BATTLE_GRADE_CACHE_SIZE', 1024),
+            use_db=getattr(settings, 'BATTLE_GRADE_CACHE_DB', False),
+        )
+    return _grade_cache
+
+
+class GradeCache:
+    """
+    Cache of grading results keyed by (question id, iospec hash, language,
+    normalized source hash).
+
+    The first tier is an LRUCache local to the process. When ``use_db`` is
+    true, GradeCacheEntry rows act as a second tier shared by every process.
+    They hold JSON, results that can not be written as JSON only live in the
+    first tier.
+    """
+
+    def __init__(self, maxsize=1024, use_db=False):
+        self.memory = LRUCache(maxsize)
+        self.use_db = use_db
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'size': len(self.memory),
+            }
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def key(self, question, language, source):
+        return (question.pk, iospec_hash(question), language.pk,
+                source_hash(source))
+
+    def get(self, key):
+        """Return the cached fields for a key or None."""
+        fields = self.memory.get(key)
+        if fields is not None:
+            self._count('hits')
+            return fields
+        if self.use_db:
+            from cs_battles.models import GradeCacheEntry
+
+            entry = GradeCacheEntry.objects.filter(
+                question_id=key[0], iospec_hash=key[1],
+                language_id=key[2], source_hash=key[3],
+            ).first()
+            if entry is not None:
+                fields = load_fields(entry.data)
+                self.memory.set(key, fields)
+                self._count('db_hits')
+                return fields
+        self._count('misses')
+        return None
+
+    def set(self, key, fields):
+        self.memory.set(key, fields)
+        data = dump_fields(fields) if self.use_db else None
+        if data is not None:
+            from cs_battles.models import GradeCacheEntry
+
+            GradeCacheEntry.objects.update_or_create(
+                question_id=key[0], iospec_hash=key[1],
+                language_id=key[2], source_hash=key[3],
+                defaults={'data': data},
+            )
+
+    def apply(self, question, language, response_item):
+        """
+        Copy a cached grading into the response item. Return False on a miss.
+        """
+        fields = self.get(self.key(question, language, response_item.source))
+        if fields is None:
+            return False
+        for name, value in fields.items():
+            setattr(response_item, name, value)
+        response_item.save()
+        return True
+
+    def store(self, question, language, response_item):
+        fields = {name: getattr(response_item, name)
+                  for name in CACHED_FIELDS if hasattr(response_item, name)}
+        self.set(self.key(question, language, response_item.source), fields)
+
+    def invalidate(self, question):
+        """Drop the results graded against an old iospec of the question."""
+        current = iospec_hash(question)
+        self.memory.delete_many(
+            lambda key: key[0] == question.pk and key[1] != current)
+        if self.use_db:
+            from cs_battles.models import GradeCacheEntry
+
+            GradeCacheEntry.objects.filter(question_id=question.pk) \
+                                   .exclude(iospec_hash=current) \
+                                   .delete()
+
+
+class DjangoCacheBackend:
+    """Use one of the caches configured in settings.CACHES as a backend."""
+
+    def __init__(self, alias='default', timeout=None):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
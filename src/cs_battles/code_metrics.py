@@ -0,0 +1,77 @@
+"""
+Size metrics of submitted source codes.
+
+The metrics are computed once, when a submition is graded, and stored in the
+participation (see BattleResponse.update). Grading inside the request ("sync"
+mode) only measures bytes and the metric that ranks the battle; grading
+workers measure all of them. The others are filled when the battle is
+archived or by the rebuild_code_metrics command. Length battles are ranked by
+the metric chosen in ``Battle.length_metric``:
+
+* bytes: size of the UTF-8 encoded source;
+* chars: number of non whitespace characters;
+* tokens: number of tokens, comments and layout excluded for Python;
+* ast_nodes: number of nodes of the Python syntax tree.
+"""
+import ast
+import io
+import re
+import tokenize
+
+METRICS = ('bytes', 'chars', 'tokens', 'ast_nodes')
+
+# Identifiers and numbers, quoted strings or any other single character
+TOKEN_RE = re.compile(r'''\w+|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|\S''')
+
+LAYOUT_TOKENS = {tokenize.ENCODING, tokenize.NL, tokenize.NEWLINE,
+                 tokenize.INDENT, tokenize.DEDENT, tokenize.COMMENT,
+                 tokenize.ENDMARKER}
+
+
+def is_python(language):
+    ref = getattr(language, 'ref', language) or ''
+    return str(ref).startswith('python')
+
+
+def count_python_tokens(source):
+    """Number of Python tokens, None if the source can not be tokenized."""
+    readline = io.BytesIO(source.encode('utf8')).readline
+    try:
+        return sum(1 for token in tokenize.tokenize(readline)
+                   if token.type not in LAYOUT_TOKENS)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return None
+
+
+def count_tokens(source, language=None):
+    count = None
+    if is_python(language):
+        count = count_python_tokens(source)
+    if count is None:
+        count = len(TOKEN_RE.findall(source))
+    return count
+
+
+def count_ast_nodes(source, language=None):
+    """Nodes of the Python syntax tree, None for other languages."""
+    if not is_python(language):
+        return None
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return None
+    return sum(1 for _ in ast.walk(tree))
+
+
+MEASURES = {
+    'bytes': lambda source, language: len(source.encode('utf8')),
+    'chars': lambda source, language: sum(1 for char in source
+                                          if not char.isspace()),
+    'tokens': count_tokens,
+    'ast_nodes': count_ast_nodes,
+}
+
+
+def measure(source, language=None, names=METRICS):
+    """Return a dictionary with the given metrics (all by default)."""
+    return {name: MEASURES[name](source, language) for name in names}
@@ -0,0 +1,92 @@
+"""
+Server-side processing for DataTables.
+
+DataTable answers the ajax requests of a jQuery DataTables table doing the
+paging, sorting and searching in SQL. Each request costs a fixed number of
+queries: one count for the total, one for the filtered total (only when
+searching) and one for the page. When the client sorts by the key column and
+sends the key of the last row it saw in ``after``, the page is fetched with a
+keyset condition instead of an OFFSET.
+"""
+import json
+
+from django.db.models import Q
+from django.http import HttpResponse
+
+MAX_PAGE_LENGTH = 100
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class DataTable:
+    """
+    ``columns`` is the list of ORM lookups used to sort each column of the
+    table, ``search_fields`` are matched with icontains and ``render_row``
+    converts an object into the list of cells sent to the client.
+    """
+
+    def __init__(self, queryset, columns, search_fields, render_row,
+                 key='pk'):
+        self.queryset = queryset
+        self.columns = columns
+        self.search_fields = search_fields
+        self.render_row = render_row
+        self.key = key
+
+    def ordering(self, params):
+        column = _int(params.get('order[0][column]'), None)
+        if column is None or not 0 <= column < len(self.columns):
+            return self.key, False
+        descending = params.get('order[0][dir]') == 'desc'
+        return self.columns[column], descending
+
+    def search(self, queryset, value):
+        query = Q()
+        for field in self.search_fields:
+            query |= Q(**{field + '__icontains': value})
+        return queryset.filter(query)
+
+    def page(self, queryset, params):
+        start = max(_int(params.get('start'), 0), 0)
+        length = _int(params.get('length'), 10)
+        if length < 0 or length > MAX_PAGE_LENGTH:
+            length = MAX_PAGE_LENGTH
+        column, descending = self.ordering(params)
+        after = _int(params.get('after'), None)
+
+        if column == self.key and after is not None:
+            lookup = '%s__%s' % (self.key, 'lt' if descending else 'gt')
+            queryset = queryset.filter(**{lookup: after})
+            start = 0
+        prefix = '-' if descending else ''
+        order = [prefix + column]
+        if column != self.key:
+            order.append(prefix + self.key)
+        return list(queryset.order_by(*order)[start:start + length])
+
+    def data(self, params):
+        """Return the DataTables response for the given request parameters."""
+        total = self.queryset.count()
+        queryset = self.queryset
+        filtered = total
+        search = params.get('search[value]', '').strip()
+        if search:
+            queryset = self.search(queryset, search)
+            filtered = queryset.count()
+        objects = self.page(queryset, params)
+        return {
+            'draw': _int(params.get('draw'), 0),
+            'recordsTotal': total,
+            'recordsFiltered': filtered,
+            'data': [self.render_row(obj) for obj in objects],
+            'last_key': getattr(objects[-1], self.key) if objects else None,
+        }
+
+    def response(self, request):
+        return HttpResponse(json.dumps(self.data(request.GET)),
+                            content_type="application/json")
@@ -0,0 +1,150 @@
+"""
+Battle events pushed to the clients with Server-Sent Events.
+
+Grading results, the progress of each challenger and the final winner are
+published to the group of the battle. The ``battle_events`` view streams them
+so the browser does not keep a request open waiting for a grader and
+spectators do not poll the detail page.
+
+The channel layer is selected by ``BATTLE_CHANNEL_LAYER`` (a dotted path).
+The default CacheChannelLayer shares events through the Django cache, so web
+processes see the events published by grading workers as long as the cache is
+shared (memcached, redis, database). InMemoryChannelLayer only reaches
+clients of the same process and is meant for development and tests. Clients
+also poll their submition tickets, so a lost event only delays the result.
+
+Each stream holds a worker, so a process serves at most
+``BATTLE_EVENTS_MAX_STREAMS`` streams at a time and closes each of them after
+``BATTLE_EVENTS_MAX_DURATION`` seconds (the browser then reconnects).
+"""
+import json
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_LAYER = 'cs_battles.events.CacheChannelLayer'
+
+GRADE = 'grade'
+PROGRESS = 'progress'
+WINNER = 'winner'
+
+_layer = (None, None)
+_streams = 0
+_streams_lock = threading.Lock()
+
+
+def get_layer():
+    global _layer
+    path = getattr(settings, 'BATTLE_CHANNEL_LAYER', DEFAULT_LAYER)
+    if _layer[0] != path:
+        _layer = (path, import_string(path)())
+    return _layer[1]
+
+
+def open_stream():
+    """Take a stream slot of this process. Return False if none is free."""
+    global _streams
+    with _streams_lock:
+        if _streams >= getattr(settings, 'BATTLE_EVENTS_MAX_STREAMS', 8):
+            return False
+        _streams += 1
+        return True
+
+
+def close_stream():
+    global _streams
+    with _streams_lock:
+        _streams -= 1
+
+
+def battle_group(battle_pk):
+    return 'battle-%s' % battle_pk
+
+
+def publish(battle_pk, event_type, data):
+    """Publish an event to everyone following the battle."""
+    return get_layer().publish(battle_group(battle_pk), event_type, data)
+
+
+def format_event(event_id, event_type, data):
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (event_id, event_type,
+                                                json.dumps(data))
+
+
+class InMemoryChannelLayer:
+    """Keep the last ``history`` events of each group in this process."""
+
+    def __init__(self, history=200):
+        self.history = history
+        self._groups = {}
+        self._last_id = {}
+        self._condition = threading.Condition()
+
+    def publish(self, group, event_type, data):
+        with self._condition:
+            event_id = self._last_id.get(group, 0) + 1
+            self._last_id[group] = event_id
+            events = self._groups.setdefault(group, deque(maxlen=self.history))
+            events.append((event_id, event_type, data))
+            self._condition.notify_all()
+        return event_id
+
+    def events_since(self, group, last_id):
+        with self._condition:
+            return [event for event in self._groups.get(group, ())
+                    if event[0] > last_id]
+
+    def wait(self, group, last_id, timeout):
+        """Block up to timeout seconds for events newer than last_id."""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._last_id.get(group, 0) > last_id, timeout)
+        return self.events_since(group, last_id)
+
+
+class CacheChannelLayer:
+    """
+    Store events in the Django cache so every process sees them. Each event
+    lives ``timeout`` seconds and readers poll every ``interval`` seconds.
+    """
+
+    def __init__(self, alias='default', timeout=300, interval=0.5):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.interval = interval
+
+    def _last_key(self, group):
+        return 'cs_battles:events:%s:last' % group
+
+    def _event_key(self, group, event_id):
+        return 'cs_battles:events:%s:%s' % (group, event_id)
+
+    def publish(self, group, event_type, data):
+        last_key = self._last_key(group)
+        self.cache.add(last_key, 0, None)
+        event_id = self.cache.incr(last_key)
+        self.cache.set(self._event_key(group, event_id),
+                       (event_id, event_type, data), self.timeout)
+        return event_id
+
+    def events_since(self, group, last_id):
+        last = self.cache.get(self._last_key(group), 0)
+        if last <= last_id:
+            return []
+        keys = [self._event_key(group, event_id)
+                for event_id in range(last_id + 1, last + 1)]
+        found = self.cache.get_many(keys)
+        return [found[key] for key in keys if key in found]
+
+    def wait(self, group, last_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.events_since(group, last_id)
+            if events or time.monotonic() >= deadline:
+                return events
+            time.sleep(self.interval)
@@ -0,0 +1,244 @@
+"""
+Process pool used to grade battle submitions.
+
+Jobs are queued per battle and dispatched round-robin between battles, so a
+battle with many challengers cannot starve the others: the next job comes
+from the battle that waits the longest since it was last served, battles that
+were never served first. At most
+``BATTLE_GRADING_PROCESSES`` jobs run at the same time and at most
+``BATTLE_GRADING_PER_BATTLE`` of them belong to the same battle.
+
+Every grading path goes through the executor (see cs_battles.grading). The
+default backend of the "queued" mode submits its jobs to the pool. The "sync"
+mode waits for a turn of the battle with run() and grades in the request
+thread, so it shares the fairness and the limits of the pool jobs while its
+grades stay in the transaction of the request.
+
+A pool whose worker died is broken for good. The executor replaces it, jobs
+that were running in it fail.
+"""
+import logging
+import os
+import threading
+import itertools
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+# Number of battles whose last turn is remembered by the executor
+SERVED_MEMORY = 10000
+
+logger = logging.getLogger(__name__)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _init_worker():
+    """Prepare a pool process to run Django code."""
+    import django
+    from django.apps import apps
+    from django.db import connections
+
+    if not apps.ready:
+        django.setup()
+    # Forget database sockets inherited from the parent process, closing them
+    # here would also close the parent connection
+    for connection in connections.all():
+        connection.connection = None
+
+
+# Marker of the jobs that run in the thread that called GradingExecutor.run()
+_INLINE = object()
+
+
+def get_executor():
+    """
+    Return the grading executor shared by the whole process, with a new pool
+    if the previous one broke.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = GradingExecutor()
+        elif _executor.broken:
+            _executor.restart()
+        return _executor
+
+
+class GradingExecutor:
+    """
+    Fair scheduler in front of a ProcessPoolExecutor.
+
+    ``pool`` may be any concurrent.futures executor, tests use a thread pool.
+    Only pools created by the executor are replaced when they break.
+    """
+
+    def __init__(self, max_workers=None, per_battle=None, pool=None):
+        if max_workers is None:
+            max_workers = getattr(settings, 'BATTLE_GRADING_PROCESSES', None)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        if per_battle is None:
+            per_battle = getattr(settings, 'BATTLE_GRADING_PER_BATTLE', None)
+        self.per_battle = per_battle or max(1, self.max_workers // 2)
+        self._owns_pool = pool is None
+        self.pool = pool if pool is not None else self._new_pool()
+        self.broken = False
+        self.wall_times = deque(maxlen=1000)
+        self.jobs_done = 0
+        self._queues = OrderedDict()
+        self._served = OrderedDict()
+        self._turns = itertools.count()
+        self._running = {}
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        with self._lock:
+            return sum(len(jobs) for jobs in self._queues.values())
+
+    @property
+    def running(self):
+        with self._lock:
+            return sum(self._running.values())
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(self.max_workers, initializer=_init_worker)
+
+    def restart(self):
+        """Replace a broken pool."""
+        with self._lock:
+            if not self.broken or not self._owns_pool:
+                return
+            broken, self.pool = self.pool, self._new_pool()
+            self.broken = False
+        logger.warning('Grading pool was broken, a new one was started')
+        broken.shutdown(wait=False)
+
+    def run(self, battle_id, fn, *args):
+        """
+        Wait for a turn of the battle and call fn(*args) in the current
+        thread. It counts as a running job of the battle until it returns.
+        """
+        self.submit(battle_id, _INLINE).result()
+        started = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            self._finish(battle_id, time.monotonic() - started)
+            self._schedule()
+
+    def submit(self, battle_id, fn, *args):
+        """Queue fn(*args) on behalf of a battle and return its Future."""
+        future = Future()
+        with self._lock:
+            # A battle keeps its last turn when its queue empties, so queueing
+            # again does not put it ahead of the battles that are waiting
+            jobs = self._queues.setdefault(battle_id, deque())
+            jobs.append((future, fn, args, time.monotonic()))
+        self._schedule()
+        return future
+
+    def stats(self):
+        """Return queue depth, running jobs and wall time statistics."""
+        with self._lock:
+            wall_times = list(self.wall_times)
+            stats = {
+                'queue_depth': sum(len(x) for x in self._queues.values()),
+                'running': sum(self._running.values()),
+                'battles_waiting': sum(1 for x in self._queues.values() if x),
+                'jobs_done': self.jobs_done,
+            }
+        stats['wall_time_last'] = wall_times[-1] if wall_times else None
+        stats['wall_time_avg'] = (sum(wall_times) / len(wall_times)
+                                  if wall_times else None)
+        stats['wall_time_max'] = max(wall_times) if wall_times else None
+        return stats
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+    def _next_job(self):
+        # Called with the lock held. Battles never served have turn -1, ties
+        # are broken by the order the battles were queued.
+        chosen, chosen_turn = None, None
+        for battle_id, jobs in self._queues.items():
+            if jobs and self._running.get(battle_id, 0) < self.per_battle:
+                turn = self._served.get(battle_id, -1)
+                if chosen is None or turn < chosen_turn:
+                    chosen, chosen_turn = battle_id, turn
+        if chosen is None:
+            return None, None
+        self._served[chosen] = next(self._turns)
+        self._served.move_to_end(chosen)
+        if len(self._served) > SERVED_MEMORY:
+            self._served.popitem(last=False)
+        return chosen, self._queues[chosen].popleft()
+
+    def _schedule(self):
+        while True:
+            with self._lock:
+                if sum(self._running.values()) >= self.max_workers:
+                    return
+                battle_id, job = self._next_job()
+                if job is None:
+                    return
+                self._running[battle_id] = self._running.get(battle_id, 0) + 1
+                if not self._queues[battle_id]:
+                    del self._queues[battle_id]
+
+            future, fn, args, queued_at = job
+            if not future.set_running_or_notify_cancel():
+                self._finish(battle_id)
+                continue
+            if fn is _INLINE:
+                # The caller of run() holds the slot until its job returns
+                future.set_result(None)
+                continue
+            started = time.monotonic()
+            try:
+                pool_future = self._pool_submit(fn, args)
+            except Exception as ex:
+                self._finish(battle_id)
+                future.set_exception(ex)
+                continue
+            pool_future.add_done_callback(
+                lambda done, battle_id=battle_id, future=future,
+                started=started, queued_at=queued_at:
+                self._done(battle_id, future, done, started, queued_at)
+            )
+
+    def _pool_submit(self, fn, args):
+        try:
+            return self.pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self.broken = True
+            if not self._owns_pool:
+                raise
+        self.restart()
+        return self.pool.submit(fn, *args)
+
+    def _finish(self, battle_id, wall_time=None):
+        with self._lock:
+            self._running[battle_id] -= 1
+            if not self._running[battle_id]:
+                del self._running[battle_id]
+            if wall_time is not None:
+                self.wall_times.append(wall_time)
+                self.jobs_done += 1
+
+    def _done(self, battle_id, future, done, started, queued_at):
+        now = time.monotonic()
+        self._finish(battle_id, now - started)
+        logger.debug('Battle %s grading job took %.3fs (%.3fs queued)',
+                     battle_id, now - started, started - queued_at)
+        exception = done.exception()
+        if isinstance(exception, BrokenProcessPool):
+            self.broken = True
+        if exception is None:
+            future.set_result(done.result())
+        else:
+            future.set_exception(exception)
+        self._schedule()
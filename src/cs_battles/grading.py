@@ -0,0 +1,322 @@
+"""
+Grading pipeline for battle submitions.
+
+Submitions are graded inside the request when ``BATTLE_GRADING_MODE`` is
+"sync" (the default), once the GradingExecutor of cs_battles.executor gives
+the battle a turn. In "queued" mode the request only registers the response
+item and hands a ticket (the response item pk) to a grading backend, the
+client then follows the ticket through the ``submition_status`` view.
+Submitions to runtime battles are always queued, their benchmark never runs
+inside a request.
+
+The backend is selected by the ``BATTLE_GRADING_BACKEND`` setting (a dotted
+path) and must implement ``enqueue(battle_id, battle_response_pk, item_pk,
+give_up)``. The default backend grades in the process pool of
+cs_battles.executor.
+
+Python sources first run once for each test case in the resource limited
+sandbox of cs_battles.sandbox, which stores a SandboxReport of the run. A
+source that exceeds the time, memory or output limits gets grade 0 and its
+report tells the client why. The others are graded by autograde(), as any
+other item.
+
+The function that grades an item is ``BATTLE_GRADER``, a dotted path to a
+callable ``(battle, response_item)`` returning True if the item was autograded
+and may be cached. It defaults to sandboxed_autograde; the battle_loadtest
+command uses the stub of cs_battles.loadtest instead.
+"""
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+from cs_battles import code_metrics, events, metrics, runtime, sandbox
+from cs_battles.cache import get_grade_cache
+
+SYNC = 'sync'
+QUEUED = 'queued'
+
+DEFAULT_BACKEND = 'cs_battles.grading.ExecutorBackend'
+DEFAULT_GRADER = 'cs_battles.grading.sandboxed_autograde'
+
+logger = logging.getLogger(__name__)
+_backend = (None, None)
+_grader = (None, None)
+
+
+def grading_mode():
+    return getattr(settings, 'BATTLE_GRADING_MODE', SYNC)
+
+
+def get_backend():
+    """Return the grading backend instance configured in settings."""
+    global _backend
+    path = getattr(settings, 'BATTLE_GRADING_BACKEND', DEFAULT_BACKEND)
+    if _backend[0] != path:
+        _backend = (path, import_string(path)())
+    return _backend[1]
+
+
+def get_grader():
+    """Return the grading function configured in settings."""
+    global _grader
+    path = getattr(settings, 'BATTLE_GRADER', DEFAULT_GRADER)
+    if _grader[0] != path:
+        _grader = (path, import_string(path))
+    return _grader[1]
+
+
+def is_pending(response_item):
+    return response_item.given_grade is None
+
+
+def sandbox_check(battle, response_item):
+    """
+    Run a Python source in the sandbox, store its SandboxReport and return
+    the sandbox Result. Return None when the sandbox is disabled or the
+    language is not Python.
+    """
+    from cs_battles.models import SandboxReport
+
+    if not sandbox.enabled() or not code_metrics.is_python(battle.language):
+        return None
+    with metrics.grading_phase('sandbox'):
+        result = sandbox.check_source(response_item.source,
+                                      runtime.question_inputs(battle.question))
+    SandboxReport.objects.update_or_create(
+        item_id=response_item.pk,
+        defaults={
+            'status': result.status,
+            'cpu_time': result.cpu_time,
+            'wall_time': result.wall_time,
+            'peak_memory': result.peak_memory,
+        })
+    return result
+
+
+def sandboxed_autograde(battle, response_item):
+    """
+    Autograde the item unless its sandboxed run exceeded the limits, which
+    gives it grade 0. Return True if the grade may be cached.
+    """
+    result = sandbox_check(battle, response_item)
+    if result is not None and result.violation:
+        response_item.given_grade = 0
+        response_item.save()
+        return False
+    with metrics.grading_phase('autograde'):
+        response_item.autograde()
+    return True
+
+
+def grade(battle_response, response_item, give_up=False, background=False):
+    """
+    Autograde a registered response item and update its participation.
+    ``background`` graders, outside of a request, measure every code metric.
+    """
+    battle = battle_response.battle
+    grade_cache = get_grade_cache()
+    autograde = get_grader()
+    if grade_cache is None:
+        autograde(battle, response_item)
+    else:
+        with metrics.grading_phase('autograde'):
+            cached = grade_cache.apply(battle.question, battle.language,
+                                       response_item)
+        # Limit violations are not cached, they may depend on the load
+        if not cached and autograde(battle, response_item):
+            grade_cache.store(battle.question, battle.language, response_item)
+    if battle.challenge_type == 'runtime':
+        with metrics.grading_phase('benchmark'):
+            runtime.measure_response(battle_response, response_item)
+    return record_grade(battle_response, response_item, give_up, background)
+
+
+def record_grade(battle_response, response_item, give_up=False,
+                 background=False):
+    """
+    Record a graded item in its participation. It finishes the participation
+    and settles the winner when the item was the last one expected.
+    """
+    with metrics.grading_phase('update'):
+        if give_up:
+            battle_response.give_up = True
+        elif background:
+            # The challenger may have given up while the item was queued
+            battle_response.refresh_from_db(fields=['give_up'])
+        battle_response.update(response_item, all_metrics=background)
+    events.publish(battle_response.battle_id, events.GRADE, {
+        'ticket': response_item.pk,
+        'battle_response': battle_response.pk,
+        'given_grade': (None if response_item.given_grade is None
+                        else float(response_item.given_grade)),
+    })
+    return response_item
+
+
+def fail(battle_response_pk, item_pk, give_up=False):
+    """
+    Give grade 0 to an item whose grading raised or whose worker died, so it
+    does not stay pending forever, and record it in its SandboxReport.
+    """
+    from cs_battles.models import BattleResponse, SandboxReport
+    from cs_questions.models import CodingIoResponseItem
+
+    response_item = CodingIoResponseItem.objects.get(pk=item_pk)
+    if not is_pending(response_item):
+        return response_item
+    response_item.given_grade = 0
+    response_item.save()
+    SandboxReport.objects.update_or_create(
+        item_id=item_pk,
+        defaults={
+            'status': sandbox.ERROR,
+            'cpu_time': 0,
+            'wall_time': 0,
+            'peak_memory': 0,
+        })
+    battle_response = BattleResponse.objects \
+        .select_related('battle__language', 'last_item') \
+        .get(pk=battle_response_pk)
+    return record_grade(battle_response, response_item, give_up, background=True)
+
+
+def grade_by_pk(battle_response_pk, item_pk, give_up=False):
+    """Worker entry point: load the objects again and grade them."""
+    from cs_battles.models import BattleResponse
+    from cs_questions.models import CodingIoResponseItem
+
+    battle_response = BattleResponse.objects \
+        .select_related('battle__question', 'battle__language', 'last_item') \
+        .get(pk=battle_response_pk)
+    response_item = CodingIoResponseItem.objects.get(pk=item_pk)
+    return grade(battle_response, response_item, give_up, background=True)
+
+
+def grade_job(battle_response_pk, item_pk, give_up=False):
+    """
+    Picklable job executed by the grading pool. Return the item pk and the
+    metrics recorded by the pool process, which the backend merges.
+    """
+    close_old_connections()
+    try:
+        grade_by_pk(battle_response_pk, item_pk, give_up)
+    finally:
+        close_old_connections()
+    return item_pk, metrics.REGISTRY.drain()
+
+
+def dispatch(battle_response, response_item, give_up=False):
+    """
+    Grade the response item now or enqueue it, according to the grading mode.
+    Runtime battles benchmark the sources, so they are always enqueued.
+    """
+    from cs_battles.executor import get_executor
+
+    if (grading_mode() == QUEUED
+            or battle_response.battle.challenge_type == 'runtime'):
+        get_backend().enqueue(battle_response.battle_id, battle_response.pk,
+                              response_item.pk, give_up)
+    else:
+        try:
+            get_executor().run(battle_response.battle_id, grade,
+                               battle_response, response_item, give_up)
+        except Exception:
+            fail(battle_response.pk, response_item.pk, give_up)
+            raise
+    return response_item
+
+
+class ExecutorBackend:
+    """Grade submitions in the shared GradingExecutor process pool."""
+
+    def __init__(self, executor=None):
+        if executor is None:
+            from cs_battles.executor import get_executor
+            executor = get_executor()
+        self.executor = executor
+
+    def enqueue(self, battle_id, battle_response_pk, item_pk, give_up=False):
+        future = self.executor.submit(battle_id, grade_job,
+                                      battle_response_pk, item_pk, give_up)
+        future.add_done_callback(
+            lambda done: self._job_done(done, battle_response_pk, item_pk,
+                                        give_up))
+        return future
+
+    @staticmethod
+    def _job_done(future, battle_response_pk, item_pk, give_up=False):
+        if future.exception() is None:
+            metrics.REGISTRY.merge(future.result()[1])
+            return
+        logger.error('Error grading battle submition %s', item_pk,
+                     exc_info=future.exception())
+        # The callback runs in a thread of the executor
+        try:
+            fail(battle_response_pk, item_pk, give_up)
+        except Exception:
+            logger.exception('Error failing battle submition %s', item_pk)
+        finally:
+            close_old_connections()
+
+
+class LocalQueueBackend:
+    """
+    In-process FIFO queue consumed by daemon threads.
+
+    With ``workers=0`` nothing is graded until drain() is called, which makes
+    the queued mode deterministic in tests.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = getattr(settings, 'BATTLE_GRADING_WORKERS', 2)
+        self.workers = workers
+        self.queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, battle_id, battle_response_pk, item_pk, give_up=False):
+        self.queue.put((battle_response_pk, item_pk, give_up))
+        self._start_workers()
+        return item_pk
+
+    def drain(self):
+        """Grade every pending job in the current thread."""
+        graded = 0
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                return graded
+            self._run(job)
+            graded += 1
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            close_old_connections()
+            self._run(job)
+            close_old_connections()
+
+    def _run(self, job):
+        try:
+            grade_by_pk(*job)
+        except Exception:
+            logger.exception('Error grading battle submition %s', job[1])
+            try:
+                fail(*job)
+            except Exception:
+                logger.exception('Error failing battle submition %s', job[1])
+        finally:
+            self.queue.task_done()
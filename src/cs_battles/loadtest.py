@@ -0,0 +1,292 @@
+"""
+Load driver that plays whole battles against a running server.
+
+Users and their sessions are created with the ORM, so the server must use the
+same database. Everything else goes through HTTP: battles are created with the
+BattleCRUDView create form, the invited users accept them in the
+``battle_invitation`` view and then each simulated user submits code to
+``/battles/battle/<pk>`` and gives up in ``/battles/surrender/<pk>``.
+
+The local server of the ``battle_loadtest`` management command grades with
+stub_autograde() and does not throttle submitions, so the load reaches the
+views and the grading pipeline.
+"""
+import json
+import math
+import random
+import string
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import Cookie, CookieJar
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urlsplit
+from urllib.request import (HTTPCookieProcessor, HTTPRedirectHandler,
+                            Request, build_opener)
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, \
+    SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.wsgi import get_wsgi_application
+from django.utils.module_loading import import_string
+
+SOURCE = 'print(input())\n'
+
+
+def stub_autograde(battle, response_item):
+    """
+    Grader for load tests (see ``BATTLE_GRADER``): wait
+    ``BATTLE_STUB_GRADER_LATENCY`` seconds and accept every non empty source
+    without running it. Stub grades are never cached.
+    """
+    from cs_battles import metrics
+
+    with metrics.grading_phase('autograde'):
+        time.sleep(getattr(settings, 'BATTLE_STUB_GRADER_LATENCY', 0.05))
+        response_item.given_grade = 100 if response_item.source.strip() else 0
+        response_item.save()
+    return False
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a list of numbers."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[index]
+
+
+class _ThreadedServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=0):
+    """
+    Serve this project in a background thread, return (server, base_url).
+    Stop it with server.shutdown().
+    """
+    server = make_server(host, port, get_wsgi_application(),
+                         server_class=_ThreadedServer,
+                         handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://%s:%d' % (host, server.server_port)
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Session:
+    """HTTP client logged in as a user, with a CSRF token."""
+
+    def __init__(self, base_url, user, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.user = user
+        self.timeout = timeout
+        self.csrf_token = ''.join(
+            random.choice(string.ascii_letters + string.digits)
+            for _ in range(32))
+        self.cookies = CookieJar()
+        self.opener = build_opener(HTTPCookieProcessor(self.cookies),
+                                   _NoRedirect)
+        self.set_cookie(settings.CSRF_COOKIE_NAME, self.csrf_token)
+        self.set_cookie(settings.SESSION_COOKIE_NAME, self.login(user))
+
+    def login(self, user):
+        """Create a session for the user, like django.test.Client does."""
+        engine = import_string(settings.SESSION_ENGINE)
+        session = engine.SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    def set_cookie(self, name, value):
+        host = urlsplit(self.base_url).hostname
+        self.cookies.set_cookie(Cookie(
+            0, name, value, None, False, host, False, False, '/', True,
+            False, None, False, None, None, {}))
+
+    def request(self, path, data=None):
+        """Return (status, headers, body), redirects are not followed."""
+        url = self.base_url + path
+        body = None
+        if data is not None:
+            body = urlencode(data, doseq=True).encode('utf8')
+        request = Request(url, body, {'X-CSRFToken': self.csrf_token,
+                                      'Referer': url})
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+        except HTTPError as error:
+            response = error
+        return response.code, response.headers, response.read()
+
+    def redirect(self, path, data):
+        """POST a form and return the Location of its redirect."""
+        status, headers, body = self.request(path, data)
+        if not 300 <= status < 400:
+            raise RuntimeError('POST %s returned %d' % (path, status))
+        return headers['Location']
+
+
+class LoadDriver:
+    """
+    Create ``battles`` battles with ``users`` participants each and make every
+    participant submit ``submitions`` times and give up, with at most
+    ``concurrency`` simulated users running at the same time.
+    """
+
+    def __init__(self, base_url, question, language='python', battles=10,
+                 users=4, submitions=3, concurrency=10, think_time=0,
+                 challenge_type='length', timeout=30):
+        self.base_url = base_url
+        self.question = question
+        self.language = language
+        self.battles = battles
+        self.users = users
+        self.submitions = submitions
+        self.concurrency = concurrency
+        self.think_time = think_time
+        self.challenge_type = challenge_type
+        self.timeout = timeout
+        self.prefix = 'load_%s_' % uuid.uuid4().hex[:8]
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.outcomes = Counter()
+        self.battle_pks = []
+        self.participants = []
+        self._lock = threading.Lock()
+
+    def create_user(self, name):
+        return User.objects.create_user(self.prefix + name,
+                                        password=uuid.uuid4().hex)
+
+    def session(self, user):
+        return Session(self.base_url, user, self.timeout)
+
+    def setup(self):
+        """Create the battles through HTTP and accept all invitations."""
+        for index in range(self.battles):
+            owner = self.session(self.create_user('%d_owner' % index))
+            guests = [self.session(self.create_user('%d_%d' % (index, x)))
+                      for x in range(self.users - 1)]
+            location = owner.redirect('/battles/new/', {
+                'question': self.question.pk,
+                'language': self.language,
+                'challenge_type': self.challenge_type,
+                'limit_submitions': self.submitions + 1,
+                'invitations_user': [guest.user.pk for guest in guests],
+            })
+            battle_pk = int(location.rstrip('/').rsplit('/', 1)[-1])
+            for guest in guests:
+                guest.redirect('/battles/accept', {'battle_pk': battle_pk,
+                                                   'accept': 'accept'})
+            self.battle_pks.append(battle_pk)
+            self.participants.extend((session, battle_pk)
+                                     for session in [owner] + guests)
+
+    def record(self, endpoint, start, status, body):
+        elapsed = time.perf_counter() - start
+        error = None
+        if status >= 400:
+            error = 'HTTP %d' % status
+        elif endpoint == 'battle':
+            try:
+                outcome = json.loads(body.decode('utf8'))['status_code']
+            except (ValueError, KeyError):
+                error = 'invalid response'
+            else:
+                with self._lock:
+                    self.outcomes[outcome] += 1
+        with self._lock:
+            self.samples[endpoint].append(elapsed)
+            if error is not None:
+                self.errors[(endpoint, error)] += 1
+
+    def call(self, endpoint, session, path, data):
+        start = time.perf_counter()
+        try:
+            status, _, body = session.request(path, data)
+        except (URLError, OSError) as error:
+            with self._lock:
+                self.samples[endpoint].append(time.perf_counter() - start)
+                self.errors[(endpoint, type(error).__name__)] += 1
+            return
+        self.record(endpoint, start, status, body)
+
+    def play(self, session, battle_pk):
+        """Simulated participant: submit a few times and give up."""
+        for _ in range(self.submitions):
+            self.call('battle', session, '/battles/battle/%d' % battle_pk,
+                      {'code': SOURCE})
+            if self.think_time:
+                time.sleep(self.think_time)
+        self.call('surrender', session, '/battles/surrender/%d' % battle_pk,
+                  {'code': SOURCE})
+
+    def run(self):
+        """Play all participants and return the report."""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for future in [pool.submit(self.play, *participant)
+                           for participant in self.participants]:
+                future.result()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, duration):
+        from cs_battles.views import OUTCOMES
+
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            errors = sum(count for (name, _), count in self.errors.items()
+                         if name == endpoint)
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'errors': errors,
+                'error_rate': errors / len(samples),
+                'p50': percentile(samples, 0.5),
+                'p99': percentile(samples, 0.99),
+            }
+        requests = sum(len(samples) for samples in self.samples.values())
+        errors = sum(self.errors.values())
+        return {
+            'duration': duration,
+            'requests': requests,
+            'throughput': requests / duration if duration else None,
+            'errors': errors,
+            'error_rate': errors / requests if requests else 0,
+            'endpoints': endpoints,
+            'outcomes': {OUTCOMES.get(code, code): count
+                         for code, count in self.outcomes.items()},
+            'error_kinds': {'%s: %s' % key: count
+                            for key, count in self.errors.items()},
+        }
+
+    def cleanup(self):
+        """
+        Delete the users, battles and response contexts created by this
+        driver. Deleting the contexts also deletes the responses in them.
+        """
+        from cs_battles.models import Battle
+        from cs_core.models import ResponseContext
+
+        battles = Battle.objects.filter(pk__in=self.battle_pks)
+        contexts = list(battles.values_list('battle_context_id', flat=True))
+        battles.update(battle_winner=None)
+        battles.delete()
+        # A context is shared by battles with the same name, keep those
+        ResponseContext.objects.filter(pk__in=contexts, battle=None).delete()
+        User.objects.filter(username__startswith=self.prefix).delete()
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cs_battles import archive
+
+
+class Command(BaseCommand):
+    help = ('Move battles finished long ago to compressed archives, keeping '
+            'only the winner in the hot tables. Interrupted runs can simply '
+            'be started again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'BATTLE_ARCHIVE_DAYS', 30),
+                            help='Archive battles finished more than this '
+                                 'number of days ago.')
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Number of battles fetched at a time.')
+        parser.add_argument('--purge-responses', action='store_true',
+                            default=archive.purge_responses(),
+                            help='Also delete the cs_core responses of the '
+                                 'losers and the older items of the winner.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        battles = archive.candidates(options['days']).order_by('pk')
+
+        last_pk = 0
+        archived = 0
+        while True:
+            chunk = list(battles.filter(pk__gt=last_pk)
+                                .values_list('pk', flat=True)[:chunk_size])
+            if not chunk:
+                break
+            # Every battle is archived in its own transaction
+            for battle_pk in chunk:
+                archived += archive.archive_battle(
+                    battle_pk, options['purge_responses'])
+            last_pk = chunk[-1]
+            self.stdout.write('Archived %d battles' % archived)
@@ -0,0 +1,99 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cs_battles import loadtest
+from cs_questions.models import CodingIoQuestion
+
+
+class Command(BaseCommand):
+    help = ('Play concurrent battles against a live server and report '
+            'throughput, latency percentiles and error rates.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url',
+                            help='Server to test. By default this project is '
+                                 'served in a local thread.')
+        parser.add_argument('--battles', type=int, default=10,
+                            help='Number of battles created.')
+        parser.add_argument('--users', type=int, default=4,
+                            help='Participants of each battle.')
+        parser.add_argument('--submitions', type=int, default=3,
+                            help='Submitions of each participant before '
+                                 'giving up.')
+        parser.add_argument('--concurrency', type=int, default=10,
+                            help='Simulated users running at the same time.')
+        parser.add_argument('--think-time', type=float, default=0,
+                            help='Seconds between submitions of a user.')
+        parser.add_argument('--grader-latency', type=float, default=0.05,
+                            help='Latency of the stub grader of the local '
+                                 'server. Remote servers use their own '
+                                 'BATTLE_GRADER and '
+                                 'BATTLE_STUB_GRADER_LATENCY.')
+        parser.add_argument('--throttle', action='store_true',
+                            help='Keep the submition throttle of the local '
+                                 'server. Remote servers use their own '
+                                 'BATTLE_SUBMIT_THROTTLE.')
+        parser.add_argument('--question', type=int,
+                            help='Question pk, the first coding question by '
+                                 'default.')
+        parser.add_argument('--language', default='python')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the users and battles created.')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the report as JSON.')
+
+    def handle(self, *args, **options):
+        questions = CodingIoQuestion.objects.order_by('pk')
+        if options['question']:
+            questions = questions.filter(pk=options['question'])
+        question = questions.first()
+        if question is None:
+            raise CommandError('There is no coding question to battle on.')
+
+        server = None
+        base_url = options['base_url']
+        if base_url is None:
+            settings.BATTLE_GRADER = 'cs_battles.loadtest.stub_autograde'
+            settings.BATTLE_STUB_GRADER_LATENCY = options['grader_latency']
+            settings.BATTLE_SUBMIT_THROTTLE = options['throttle']
+            server, base_url = loadtest.serve()
+
+        driver = loadtest.LoadDriver(
+            base_url, question,
+            language=options['language'],
+            battles=options['battles'],
+            users=options['users'],
+            submitions=options['submitions'],
+            concurrency=options['concurrency'],
+            think_time=options['think_time'],
+        )
+        try:
+            driver.setup()
+            report = driver.run()
+        finally:
+            if server is not None:
+                server.shutdown()
+            if not options['keep']:
+                driver.cleanup()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        else:
+            self.write_report(report)
+
+    def write_report(self, report):
+        self.stdout.write('%d requests in %.1fs: %.1f req/s, %.2f%% errors' % (
+            report['requests'], report['duration'], report['throughput'],
+            100 * report['error_rate']))
+        for endpoint, stats in report['endpoints'].items():
+            self.stdout.write(
+                '  %-10s %6d requests  p50 %7.1fms  p99 %7.1fms  '
+                '%.2f%% errors' % (endpoint, stats['requests'],
+                                   1000 * stats['p50'], 1000 * stats['p99'],
+                                   100 * stats['error_rate']))
+        for outcome, count in sorted(report['outcomes'].items()):
+            self.stdout.write('  %-10s %6d submitions' % (outcome, count))
+        for kind, count in sorted(report['error_kinds'].items()):
+            self.stdout.write('  %s: %d' % (kind, count))
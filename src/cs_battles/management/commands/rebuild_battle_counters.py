@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, When
+
+from cs_battles.models import Battle, BattleResponse
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the submition counters of BattleResponse and the '
+            'participant counters of Battle from ResponseItem history. '
+            'Archived battles keep their submition counters, their history '
+            'may have been purged.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of rows updated per transaction.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        responses = BattleResponse.objects \
+            .filter(battle__archived=False) \
+            .annotate(items_count=Count('response__items')) \
+            .select_related('battle', 'last_item') \
+            .order_by('pk')
+
+        last_pk = 0
+        fixed = 0
+        while True:
+            chunk = list(responses.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for battle_response in chunk:
+                    battle_response.submitions_used = battle_response.items_count
+                    finished = not battle_response.is_active
+                    BattleResponse.objects.filter(pk=battle_response.pk).update(
+                        submitions_used=battle_response.items_count,
+                        finished=finished,
+                    )
+                    fixed += 1
+            last_pk = chunk[-1].pk
+
+        counters = BattleResponse.objects.values('battle').annotate(
+            active=Count(Case(When(finished=False, then=1),
+                              output_field=IntegerField())),
+            done=Count(Case(When(finished=True, then=1),
+                            output_field=IntegerField())),
+        )
+        with transaction.atomic():
+            Battle.objects.update(active_count=0, finished_count=0)
+            for row in counters.order_by():
+                Battle.objects.filter(pk=row['battle']).update(
+                    active_count=row['active'],
+                    finished_count=row['done'],
+                )
+
+        self.stdout.write('Rebuilt counters of %d battle responses.' % fixed)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from cs_battles.models import Battle, BattleStats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild BattleStats replaying every settled battle.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200,
+                            help='Number of battles replayed per transaction.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        BattleStats.objects.update(
+            battles=0, wins=0, losses=0, rank_score=0,
+            length_total=0, length_count=0, time_total=0, time_count=0,
+            runtime_total=0, runtime_count=0,
+        )
+        # Battles settled from now on are recorded by determine_winner(), only
+        # the older ones are replayed. Each chunk commits on its own, so the
+        # stats table is never locked for the whole rebuild; meanwhile the
+        # ranking only has the battles replayed so far.
+        started = timezone.now()
+        battles = Battle.objects \
+            .filter(battle_winner__isnull=False) \
+            .filter(Q(finished_at__isnull=True) | Q(finished_at__lt=started)) \
+            .order_by('pk')
+        last_pk = 0
+        replayed = 0
+        while True:
+            chunk = list(battles.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for battle in chunk:
+                    BattleStats.objects.record_battle(battle)
+            replayed += len(chunk)
+            last_pk = chunk[-1].pk
+            self.stdout.write('Replayed %d battles' % replayed)
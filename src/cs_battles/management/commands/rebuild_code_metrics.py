@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from cs_battles import code_metrics
+from cs_battles.models import BattleResponse
+
+FIELDS = ['source_' + name for name in code_metrics.METRICS]
+
+
+class Command(BaseCommand):
+    help = ('Compute the stored source metrics of participations graded '
+            'before they existed or graded inside the request, which only '
+            'measures the metric of the battle.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of rows updated per transaction.')
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute the metrics of every '
+                                 'participation.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        responses = BattleResponse.objects \
+            .filter(last_item__isnull=False) \
+            .select_related('battle__language', 'last_item', 'source_blob') \
+            .order_by('pk')
+        if not options['all']:
+            # ast_nodes is None for sources that are not Python
+            responses = responses.filter(Q(source_bytes__isnull=True)
+                                         | Q(source_chars__isnull=True)
+                                         | Q(source_tokens__isnull=True))
+
+        last_pk = 0
+        fixed = 0
+        while True:
+            chunk = list(responses.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for battle_response in chunk:
+                    metrics = code_metrics.measure(
+                        battle_response.source,
+                        battle_response.battle.language)
+                    for name, value in metrics.items():
+                        setattr(battle_response, 'source_' + name, value)
+                    battle_response.save(update_fields=FIELDS)
+            fixed += len(chunk)
+            last_pk = chunk[-1].pk
+            self.stdout.write('Measured %d participations' % fixed)
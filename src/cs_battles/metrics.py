@@ -0,0 +1,308 @@
+"""
+Low overhead metrics for the battle views and the grading pipeline.
+
+Counters and histograms live in the memory of each process and are exported
+in the Prometheus text format by the ``metrics`` view. Grading pool processes
+send what they recorded back with the result of each job (see drain() and
+merge()), so the web process exports them too. Set ``BATTLE_METRICS = False``
+to disable the instrumentation.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def enabled():
+    return getattr(settings, 'BATTLE_METRICS', True)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ['%s="%s"' % (name, str(value).replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    return '{%s}' % ','.join(pairs)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def drain(self):
+        """Return the recorded values and start again from zero."""
+        with self._lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        for key, amount in values.items():
+            with self._lock:
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s counter' % self.name]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name,
+                                          _labels(self.labelnames, key),
+                                          value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1),
+                                                  0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def drain(self):
+        """Return the recorded values and start again from zero."""
+        with self._lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        for key, (counts, total) in values.items():
+            with self._lock:
+                current, current_total = self.values.get(
+                    key, ([0] * (len(self.buckets) + 1), 0.0))
+                self.values[key] = ([x + y for x, y in zip(current, counts)],
+                                    current_total + total)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        names = self.labelnames + ('le',)
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (
+                        self.name, _labels(names, key + (bound,)), cumulative))
+                labels = _labels(self.labelnames, key)
+                lines.append('%s_sum%s %s' % (self.name, labels, total))
+                lines.append('%s_count%s %s' % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """Metrics of the process plus collectors that report gauges on export."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        """Register a function returning {(name, help): value} gauges."""
+        self.collectors.append(function)
+        return function
+
+    def drain(self):
+        """Values of every metric, which are reset, as a picklable dict."""
+        return {metric.name: metric.drain() for metric in self.metrics}
+
+    def merge(self, snapshot):
+        """Add the values returned by drain() in another process."""
+        for metric in self.metrics:
+            if snapshot.get(metric.name):
+                metric.merge(snapshot[metric.name])
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for (name, help), value in sorted(collect().items()):
+                if value is None:
+                    continue
+                lines.extend(['# HELP %s %s' % (name, help),
+                              '# TYPE %s gauge' % name,
+                              '%s %s' % (name, value)])
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+VIEW_SECONDS = REGISTRY.histogram(
+    'cs_battles_view_seconds', 'Time spent in battle views.', ['view'])
+VIEW_QUERIES = REGISTRY.histogram(
+    'cs_battles_view_queries', 'Database queries per battle view.', ['view'],
+    buckets=QUERY_BUCKETS)
+VIEW_QUERY_SECONDS = REGISTRY.histogram(
+    'cs_battles_view_query_seconds', 'Database time per battle view.',
+    ['view'])
+GRADING_SECONDS = REGISTRY.histogram(
+    'cs_battles_grading_seconds',
+    'Time of each grading phase '
+    '(register, sandbox, autograde, benchmark, update).',
+    ['phase'])
+SUBMITIONS = REGISTRY.counter(
+    'cs_battles_submitions_total', 'Battle submitions by outcome.',
+    ['outcome'])
+
+
+_tracking = threading.local()
+
+
+class QueryTimer:
+    """
+    Cursor wrapper that adds the count and the time of the queries to the
+    view tracked by the thread. Unlike the debug cursor it keeps no SQL.
+    """
+
+    def __init__(self, cursor, tracked):
+        self.cursor = cursor
+        self.tracked = tracked
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.cursor.__exit__(*exc_info)
+
+    def _timed(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.tracked[0] += 1
+            self.tracked[1] += time.perf_counter() - start
+
+    def execute(self, *args, **kwargs):
+        return self._timed(self.cursor.execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._timed(self.cursor.executemany, *args, **kwargs)
+
+
+def _hook_cursor(db):
+    """Make db.cursor() return a QueryTimer while a view is tracked."""
+    if getattr(db, '_battle_query_timer', False):
+        return
+    cursor = db.cursor
+
+    def timed_cursor():
+        tracked = getattr(_tracking, 'queries', None)
+        if tracked is None:
+            return cursor()
+        return QueryTimer(cursor(), tracked)
+
+    db.cursor = timed_cursor
+    db._battle_query_timer = True
+
+
+@contextmanager
+def track_view(name):
+    """Record latency, query count and query time of a view."""
+    if not enabled():
+        yield
+        return
+    _hook_cursor(connections[DEFAULT_DB_ALIAS])
+    previous = getattr(_tracking, 'queries', None)
+    tracked = _tracking.queries = [0, 0.0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _tracking.queries = previous
+        VIEW_SECONDS.observe(elapsed, view=name)
+        VIEW_QUERIES.observe(tracked[0], view=name)
+        VIEW_QUERY_SECONDS.observe(tracked[1], view=name)
+
+
+def instrumented(name):
+    """Decorator for function views, see track_view()."""
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            with track_view(name):
+                return view(request, *args, **kwargs)
+        wrapper.__name__ = view.__name__
+        wrapper.__doc__ = view.__doc__
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def grading_phase(phase):
+    if not enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        GRADING_SECONDS.observe(time.perf_counter() - start, phase=phase)
+
+
+@REGISTRY.collector
+def pipeline_gauges():
+    """Current state of the grading executor, grade cache and throttle."""
+    from cs_battles import cache, executor, throttle
+
+    gauges = {}
+    if executor._executor is not None:
+        stats = executor._executor.stats()
+        gauges[('cs_battles_grading_queue_depth',
+                'Jobs waiting for a grading process.')] = stats['queue_depth']
+        gauges[('cs_battles_grading_running',
+                'Jobs running in the grading pool.')] = stats['running']
+        gauges[('cs_battles_grading_job_seconds_avg',
+                'Average wall time of recent grading jobs.')] = \
+            stats['wall_time_avg']
+    grade_cache = cache._grade_cache
+    if grade_cache is not None:
+        for name, value in grade_cache.stats().items():
+            gauges[('cs_battles_grade_cache_%s' % name,
+                    'Grade cache %s.' % name.replace('_', ' '))] = value
+    if throttle._throttle is not None:
+        for name, value in throttle._throttle.stats().items():
+            gauges[('cs_battles_throttle_%s' % name,
+                    'Submition throttle decisions: %s.' % name)] = value
+    return gauges
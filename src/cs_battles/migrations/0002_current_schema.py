@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    Bring the tables of 0001_initial up to the models in place. The required
+    foreign keys have no default, so a database holding rows created with
+    0001 stops here with an error instead of losing them.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cs_core', '__first__'),
+        ('cs_questions', '__first__'),
+        ('cs_battles', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='battle',
+            old_name='type',
+            new_name='challenge_type',
+        ),
+        migrations.AlterField(
+            model_name='battle',
+            name='challenge_type',
+            field=models.CharField(choices=[('length', 'length'), ('time', 'time')], default='length', help_text='Choose a battle challenge type.', max_length=20, verbose_name='challenge type'),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='limit_submitions',
+            field=models.IntegerField(default=10, help_text='Define the maximun of submitions for each challenger', verbose_name='limit submitions'),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='mass',
+            field=models.BooleanField(default=False, help_text='Battle for thousands of challengers, results are shown as paginated standings', verbose_name='mass battle'),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='active_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='finished_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='battle_context',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cs_core.ResponseContext'),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='battle_owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='battle_owner', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='invitations_user',
+            field=models.ManyToManyField(to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='language',
+            field=models.ForeignKey(help_text='Select the language for battle', on_delete=django.db.models.deletion.CASCADE, related_name='battle_language', to='cs_core.ProgrammingLanguage'),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='question',
+            field=models.ForeignKey(help_text='Select a created question for battle', on_delete=django.db.models.deletion.CASCADE, related_name='battle_question', to='cs_questions.CodingIoQuestion'),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='give_up',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='submitions_used',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='finished',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='last_item',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cs_core.ResponseItem'),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='response',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='cs_core.Response'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='battleresponse',
+            unique_together=set([('response', 'battle')]),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='battle_winner',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='winner', to='cs_battles.BattleResponse'),
+        ),
+        migrations.CreateModel(
+            name='BattleStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('battles', models.PositiveIntegerField(default=0)),
+                ('wins', models.PositiveIntegerField(default=0)),
+                ('losses', models.PositiveIntegerField(default=0)),
+                ('length_total', models.BigIntegerField(default=0)),
+                ('length_count', models.PositiveIntegerField(default=0)),
+                ('time_total', models.FloatField(default=0)),
+                ('time_count', models.PositiveIntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='battle_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='battlestats',
+            index_together=set([('wins', 'losses', 'user')]),
+        ),
+        migrations.CreateModel(
+            name='GradeCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('iospec_hash', models.CharField(max_length=64)),
+                ('source_hash', models.CharField(max_length=64)),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cs_core.ProgrammingLanguage')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cs_questions.CodingIoQuestion')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='gradecacheentry',
+            unique_together=set([('question', 'iospec_hash', 'language', 'source_hash')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_battles', '0002_current_schema'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='battleresponse',
+            index_together=set([('battle', 'response'), ('battle', 'finished')]),
+        ),
+    ]
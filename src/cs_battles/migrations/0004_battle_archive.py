@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Max
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def settle_finished_at(apps, schema_editor):
+    """Battles settled before this migration finished with their last answer."""
+    Battle = apps.get_model('cs_battles', 'Battle')
+    battles = Battle.objects.filter(battle_winner__isnull=False,
+                                    finished_at__isnull=True) \
+                            .annotate(last_answer=Max('battles__time_end'))
+    for battle in battles.iterator():
+        Battle.objects.filter(pk=battle.pk).update(
+            finished_at=battle.last_answer or timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_battles', '0003_battle_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battle',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='battle',
+            name='archived',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='battle',
+            index_together=set([('archived', 'finished_at')]),
+        ),
+        migrations.CreateModel(
+            name='BattleArchive',
+            fields=[
+                ('battle', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='cs_battles.Battle')),
+                ('data', models.BinaryField()),
+                ('participants', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(settle_finished_at, migrations.RunPython.noop),
+    ]
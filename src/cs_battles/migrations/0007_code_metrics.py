@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Metrics of existing participations are filled by rebuild_code_metrics."""
+
+    dependencies = [
+        ('cs_battles', '0006_battle_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battle',
+            name='length_metric',
+            field=models.CharField(blank=True, choices=[('bytes', 'bytes'), ('chars', 'non whitespace characters'), ('tokens', 'tokens'), ('ast_nodes', 'syntax tree nodes (Python)')], default='bytes', help_text='How the source codes of length battles are measured.', max_length=20, verbose_name='length metric'),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='source_bytes',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='source_chars',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='source_tokens',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='source_ast_nodes',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_battles', '0007_code_metrics'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='battle',
+            name='challenge_type',
+            field=models.CharField(choices=[('length', 'length'), ('time', 'time'), ('runtime', 'runtime')], default='length', help_text='Choose a battle challenge type.', max_length=20, verbose_name='challenge type'),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='runtime_median',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='battleresponse',
+            name='runtime_iqr',
+            field=models.FloatField(editable=False, null=True),
+        ),
+    ]
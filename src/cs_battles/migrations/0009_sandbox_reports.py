@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_core', '__first__'),
+        ('cs_battles', '0008_runtime_battles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SandboxReport',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sandbox_report', serialize=False, to='cs_core.ResponseItem')),
+                ('status', models.CharField(choices=[('ok', 'ok'), ('runtime_error', 'runtime error'), ('time_limit', 'time limit exceeded'), ('memory_limit', 'memory limit exceeded'), ('output_limit', 'output limit exceeded')], max_length=20)),
+                ('cpu_time', models.FloatField()),
+                ('wall_time', models.FloatField()),
+                ('peak_memory', models.BigIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_counters(apps, schema_editor):
+    """
+    Fill the submition and participant counters of participations created
+    before they existed, from the ResponseItem history (the same rules as the
+    rebuild_battle_counters command).
+    """
+    Battle = apps.get_model('cs_battles', 'Battle')
+    BattleResponse = apps.get_model('cs_battles', 'BattleResponse')
+    responses = BattleResponse.objects \
+        .annotate(items_count=Count('response__items')) \
+        .select_related('battle', 'last_item')
+    for battle_response in responses.iterator():
+        last_item = battle_response.last_item
+        active = (not battle_response.give_up
+                  and battle_response.items_count
+                  < battle_response.battle.limit_submitions
+                  and (last_item is None or last_item.given_grade != 100))
+        BattleResponse.objects.filter(pk=battle_response.pk).update(
+            submitions_used=battle_response.items_count,
+            finished=not active,
+        )
+    for battle in Battle.objects.iterator():
+        participations = BattleResponse.objects.filter(battle_id=battle.pk)
+        finished = participations.filter(finished=True).count()
+        Battle.objects.filter(pk=battle.pk).update(
+            active_count=participations.count() - finished,
+            finished_count=finished,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_core', '__first__'),
+        ('cs_battles', '0009_sandbox_reports'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_grade_cache(apps, schema_editor):
+    # Entries were pickled, the cache is simply filled again
+    apps.get_model('cs_battles', 'GradeCacheEntry').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_battles', '0010_backfill_battle_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_grade_cache, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='gradecacheentry',
+            name='data',
+            field=models.TextField(),
+        ),
+    ]
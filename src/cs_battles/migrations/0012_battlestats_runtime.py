@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_battles', '0011_grade_cache_json'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battlestats',
+            name='runtime_total',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='battlestats',
+            name='runtime_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_battles', '0012_battlestats_runtime'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sandboxreport',
+            name='status',
+            field=models.CharField(choices=[('ok', 'ok'), ('runtime_error', 'runtime error'), ('time_limit', 'time limit exceeded'), ('memory_limit', 'memory limit exceeded'), ('output_limit', 'output limit exceeded'), ('error', 'grading error')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_rank_score(apps, schema_editor):
+    """rank_score of the existing rows, see BattleStats.score()."""
+    BattleStats = apps.get_model('cs_battles', 'BattleStats')
+    BattleStats.objects.update(rank_score=F('losses') - F('wins') * 2 ** 32)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_battles', '0013_sandboxreport_error'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battlestats',
+            name='rank_score',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_rank_score, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='battlestats',
+            index_together=set([('rank_score', 'user')]),
+        ),
+    ]
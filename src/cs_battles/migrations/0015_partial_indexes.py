@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class VendorRunSQL(migrations.RunSQL):
+    """RunSQL that only runs on the given database vendors."""
+
+    def __init__(self, vendors, *args, **kwargs):
+        self.vendors = vendors
+        super().__init__(*args, **kwargs)
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if schema_editor.connection.vendor in self.vendors:
+            super().database_forwards(app_label, schema_editor, from_state,
+                                      to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if schema_editor.connection.vendor in self.vendors:
+            super().database_backwards(app_label, schema_editor, from_state,
+                                       to_state)
+
+
+PARTIAL = ('postgresql', 'sqlite')
+
+
+class Migration(migrations.Migration):
+    """
+    Partial indexes on the rows that are still being played, which stay
+    small while finished rows pile up. MySQL, which has no partial indexes,
+    gets a plain (battle_id, finished) index instead.
+
+    The ResponseContext name="battle_N" lookup also filters by activity, so
+    it is served by the activity_id foreign key index of cs_core, and only
+    scans the few contexts of one question. That table belongs to cs_core and
+    is not indexed here.
+    """
+
+    dependencies = [
+        ('cs_battles', '0014_battlestats_rank_score'),
+    ]
+
+    operations = [
+        # (battle, response) is covered by the unique (response, battle)
+        # index and the battle_id foreign key index
+        migrations.AlterIndexTogether(
+            name='battleresponse',
+            index_together=set(),
+        ),
+        VendorRunSQL(
+            PARTIAL,
+            'CREATE INDEX cs_battles_battleresponse_playing '
+            'ON cs_battles_battleresponse (battle_id) WHERE NOT finished',
+            'DROP INDEX cs_battles_battleresponse_playing',
+        ),
+        VendorRunSQL(
+            PARTIAL,
+            'CREATE INDEX cs_battles_battle_unfinished '
+            'ON cs_battles_battle (id) WHERE battle_winner_id IS NULL',
+            'DROP INDEX cs_battles_battle_unfinished',
+        ),
+        VendorRunSQL(
+            ('mysql',),
+            'CREATE INDEX cs_battles_battleresponse_playing '
+            'ON cs_battles_battleresponse (battle_id, finished)',
+            'DROP INDEX cs_battles_battleresponse_playing '
+            'ON cs_battles_battleresponse',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cs_core', '__first__'),
+        ('cs_battles', '0015_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemSource',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='battle_source', serialize=False, to='cs_core.ResponseItem')),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cs_battles.SourceBlob')),
+            ],
+        ),
+    ]
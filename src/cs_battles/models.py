@@ -2,16 +2,202 @@ from codeschool import models as auth_model
 from cs_core.models import ProgrammingLanguage,ResponseContext,ResponseItem,programming_language
 from cs_questions.models import CodingIoQuestion, CodingIoResponseItem
 from cs_questions.models import Question
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (BooleanField, Case, DurationField,
+                              ExpressionWrapper, F, IntegerField, Q, Value,
+                              When)
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from cs_core.models import Response
+from cs_battles import code_metrics, events, grading, metrics, sandbox, sources
+from cs_battles.cache import get_grade_cache
+
+
+def _length_metric():
+    """The stored source metric chosen by the battle of each participation."""
+    whens = [When(battle__length_metric=name, then=F('source_' + name))
+             for name in code_metrics.METRICS if name != 'bytes']
+    return Case(*whens, default=F('source_bytes'),
+                output_field=IntegerField())
+
+
+def _column(model, name):
+    """Return the (table, column) pair that stores the given model field."""
+    field = model._meta.get_field(name)
+    return field.model._meta.db_table, field.column
+
+
+class BattleQuerySet(models.QuerySet):
+    """Battle queries that compute the activity state inside the database."""
+
+    def with_activity(self):
+        """
+        Annotate each battle with the number of pending invitations, the number
+        of active participants and a boolean ``activity`` flag.
+        """
+        battle_table = Battle._meta.db_table
+        br_table = BattleResponse._meta.db_table
+        grade_table, grade_column = _column(ResponseItem, 'given_grade')
+        grade_pk = ResponseItem._meta.get_field('given_grade').model._meta.pk
+        through = Battle.invitations_user.through
+        through_table = through._meta.db_table
+        through_battle = through._meta.get_field('battle').column
+
+        invitations = RawSQL(
+            'SELECT COUNT(*) FROM %s WHERE %s.%s = %s.id'
+            % (through_table, through_table, through_battle, battle_table),
+            ()
+        )
+        # Mass battles trust the participant counters instead of scanning
+        # every participation
+        active_responses = RawSQL(
+            'CASE WHEN {battle}.mass = %s THEN {battle}.active_count ELSE ('
+            'SELECT COUNT(*) FROM {br} '
+            'LEFT OUTER JOIN {grade} ON {grade}.{pk} = {br}.last_item_id '
+            'WHERE {br}.battle_id = {battle}.id AND {br}.give_up = %s '
+            'AND ({grade}.{column} IS NULL OR {grade}.{column} < 100) '
+            'AND {br}.submitions_used < {battle}.limit_submitions) END'.format(
+                br=br_table,
+                battle=battle_table,
+                grade=grade_table,
+                column=grade_column,
+                pk=grade_pk.column,
+            ),
+            (True, False)
+        )
+        return self.annotate(
+            pending_invitations=invitations,
+            active_responses=active_responses,
+        ).annotate(
+            activity=Case(
+                When(Q(pending_invitations__gt=0) | Q(active_responses__gt=0),
+                     then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            )
+        )
+
+    def active(self):
+        return self.with_activity().filter(activity=True)
+
+    def finished(self):
+        return self.with_activity().filter(activity=False)
+
+
+class BattleResponseQuerySet(models.QuerySet):
+    """BattleResponse queries that compute the activity state in SQL."""
+
+    def with_activity(self):
+        """
+        Annotate each participation with the ``last_grade`` received and a
+        boolean ``activity`` flag.
+        """
+        return self.annotate(
+            last_grade=F('last_item__given_grade'),
+            activity=Case(
+                When(Q(give_up=False,
+                       submitions_used__lt=F('battle__limit_submitions'))
+                     & (Q(last_item__given_grade__isnull=True)
+                        | Q(last_item__given_grade__lt=100)),
+                     then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            )
+        )
+
+    def active(self):
+        return self.with_activity().filter(activity=True)
+
+    def finished(self):
+        return self.with_activity().filter(activity=False)
+
+    def ranked(self, challenge_type):
+        """Order the participations by the rank_<challenge_type> strategy."""
+        return getattr(self, 'rank_' + str(challenge_type))()
+
+    def with_correctness(self):
+        """Annotate ``incorrect`` as 0 for a last item graded with 100."""
+        return self.annotate(
+            incorrect=Case(
+                When(last_item__given_grade=100, then=Value(0)),
+                default=Value(1),
+                output_field=IntegerField(),
+            )
+        )
+
+    def rank_length(self):
+        """
+        Correct solutions first, then the shortest source code according to
+        the length metric of the battle.
+        """
+        return self.with_correctness().annotate(
+            source_length=Case(
+                When(last_item__given_grade=100, then=_length_metric()),
+                default=Value(None),
+                output_field=IntegerField(),
+            )
+        ).order_by('incorrect', 'source_length', 'time_end', 'pk')
+
+    def rank_time(self):
+        """
+        The fastest challenger, whatever the grade, as time battles always
+        ranked. Participations that never submitted come last.
+        """
+        return self.with_correctness().annotate(
+            unfinished=Case(
+                When(time_end__isnull=True, then=Value(1)),
+                default=Value(0),
+                output_field=IntegerField(),
+            ),
+            duration=ExpressionWrapper(F('time_end') - F('time_begin'),
+                                       output_field=DurationField()),
+        ).order_by('unfinished', 'duration', 'pk')
+
+    def rank_runtime(self):
+        """
+        Correct solutions first, then the lowest median CPU time. Correct
+        solutions that could not be benchmarked come after the others.
+        """
+        return self.with_correctness().annotate(
+            runtime=Case(
+                When(last_item__given_grade=100, then=F('runtime_median')),
+                default=Value(None),
+                output_field=models.FloatField(),
+            ),
+            unbenchmarked=Case(
+                When(runtime_median__isnull=True, then=Value(1)),
+                default=Value(0),
+                output_field=IntegerField(),
+            ),
+        ).order_by('incorrect', 'unbenchmarked', 'runtime', 'time_end', 'pk')
+
 
 class Battle(models.Model):
     """The model to associate many battles"""
+
+    class Meta:
+        # Candidates of the archive_battles command. Battles without a winner
+        # have the partial cs_battles_battle_unfinished index of migration 0015
+        index_together = [('archived', 'finished_at')]
+
+    # Each challenge type is ranked by BattleResponseQuerySet.rank_<type> and
+    # its winner is chosen by Battle.winner_<type>
     TYPE_BATTLES = (
                     (_("length"),"length"),
-                    (_("time"),"time")
+                    (_("time"),"time"),
+                    (_("runtime"),"runtime"),
+                    )
+    # Source metrics that can rank length battles, see cs_battles.code_metrics
+    LENGTH_METRICS = (
+                    ("bytes",_("bytes")),
+                    ("chars",_("non whitespace characters")),
+                    ("tokens",_("tokens")),
+                    ("ast_nodes",_("syntax tree nodes (Python)")),
                     )
     date = models.DateField(auto_now_add=True)
 
@@ -60,36 +246,258 @@ class Battle(models.Model):
                 help_text=_('Define the maximun of submitions for each challenger')
             )
 
+    length_metric = models.CharField(
+                _('length metric'),
+                default=LENGTH_METRICS[0][0],
+                choices=LENGTH_METRICS,
+                max_length=20,
+                blank=True,
+                help_text=_('How the source codes of length battles are '
+                            'measured.')
+            )
+
+    mass = models.BooleanField(
+                _('mass battle'),
+                default=False,
+                help_text=_('Battle for thousands of challengers, results are '
+                            'shown as paginated standings')
+            )
+
+    # Participants still playing and participants that already finished.
+    # Both are maintained by BattleResponse and rebuilt by the
+    # rebuild_battle_counters command.
+    active_count = models.PositiveIntegerField(default=0, editable=False)
+    finished_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Incremented every time the battle or one of its participations changes,
+    # together with the time of the change. They are the ETag and
+    # Last-Modified of the JSON API.
+    version = models.PositiveIntegerField(default=0, editable=False)
+    updated = models.DateTimeField(default=timezone.now, editable=False)
+
+    # When the winner was settled
+    finished_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Participations were moved to a BattleArchive, only the winner is kept
+    archived = models.BooleanField(default=False, editable=False)
+
+    # Columns only changed by atomic UPDATEs, a regular save never writes them
+    COUNTER_FIELDS = ('active_count', 'finished_count', 'version', 'updated',
+                      'archived')
+    # Written once by determine_winner() under the row lock, a regular save
+    # must not overwrite them with a stale value
+    SETTLED_FIELDS = ('battle_winner', 'finished_at')
+
+    objects = BattleQuerySet.as_manager()
+
     @property
     def is_active(self):
-        return (len(self.invitations_user.all()) is not 0
-                or True in [br.is_active for br in self.battles.all()]
-                )
+        # Battles fetched through with_activity() already carry the flag
+        activity = getattr(self, 'activity', None)
+        if activity is None:
+            activity = (Battle.objects.with_activity()
+                                      .filter(pk=self.pk)
+                                      .values_list('activity', flat=True)
+                                      .first())
+        return bool(activity)
 
     def __init__(self, *args, **kwargs):
         if 'language' in kwargs and isinstance(kwargs['language'], str):
             kwargs['language'] = programming_language(kwargs['language'])
         super().__init__(*args, **kwargs)
-    
+        # Participant counters depend on the limit, see save()
+        self._saved_limit = self.__dict__.get('limit_submitions')
+
+    def clean(self):
+        if (self.length_metric == 'ast_nodes' and self.language_id
+                and not code_metrics.is_python(self.language)):
+            raise ValidationError({'length_metric': _(
+                'Syntax tree nodes can only measure Python battles.')})
+        if (self.challenge_type == 'runtime' and self.language_id
+                and not code_metrics.is_python(self.language)):
+            raise ValidationError({'challenge_type': _(
+                'Only Python battles can be benchmarked.')})
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            return super().save(*args, **kwargs)
+        if not kwargs.get('update_fields'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.COUNTER_FIELDS
+                and field.name not in self.SETTLED_FIELDS
+            ]
+        # Bump the version in the same UPDATE that saves the fields
+        kwargs['update_fields'] = [
+            name for name in kwargs['update_fields']
+            if name not in ('version', 'updated')
+        ] + ['version', 'updated']
+        self.version = F('version') + 1
+        self.updated = timezone.now()
+        super().save(*args, **kwargs)
+        # Read back the value of the F() expression
+        self.refresh_from_db(fields=['version'])
+        limit_changed = self.limit_submitions != self._saved_limit
+        self._saved_limit = self.limit_submitions
+        if limit_changed and 'limit_submitions' in kwargs['update_fields']:
+            self.refresh_counters()
+
+    def refresh_counters(self):
+        """
+        Recompute the finished flags and the participant counters of the
+        battle, which change with the limit of submitions, and settle the
+        winner if no participation is active anymore.
+        """
+        with transaction.atomic():
+            playing = list(self.battles.active().values_list('pk', flat=True))
+            self.battles.update(finished=True)
+            BattleResponse.objects.filter(pk__in=playing).update(finished=False)
+            total = self.battles.count()
+            Battle.objects.filter(pk=self.pk).update(
+                active_count=len(playing),
+                finished_count=total - len(playing),
+            )
+        self.determine_winner()
+
+    @staticmethod
+    def bump_version(battle_pk):
+        Battle.objects.filter(pk=battle_pk).update(version=F('version') + 1,
+                                                   updated=timezone.now())
+
     def determine_winner(self):
-        if not self.is_active and self.battle_winner is None:
-            self.battle_winner = getattr(self,'winner_'+str(self.challenge_type))()
-            self.save()
+        """
+        Settle the winner once the battle is finished. It is called when a
+        participation stops being active or an invitation is removed, and the
+        row lock makes concurrent calls settle the winner only once.
+        """
+        from cs_battles import results
+
+        if self.battle_winner_id is None:
+            with transaction.atomic():
+                battle = Battle.objects.select_for_update().get(pk=self.pk)
+                if battle.battle_winner_id is None and not battle.is_active:
+                    battle.battle_winner = getattr(
+                        battle,'winner_'+str(battle.challenge_type))()
+                    battle.finished_at = timezone.now()
+                    battle.save(update_fields=['battle_winner','finished_at'])
+                    # Stats scan every participation, keep it out of the lock
+                    transaction.on_commit(
+                        lambda: BattleStats.objects.record_battle(battle))
+                    transaction.on_commit(
+                        lambda: results.fill_cache(battle.pk))
+                    transaction.on_commit(
+                        lambda: battle.publish_winner())
+                self.battle_winner = battle.battle_winner
         return self.battle_winner
 
+    def publish_winner(self):
+        winner = self.battle_winner
+        events.publish(self.pk, events.WINNER, {
+            'battle_response': winner.pk,
+            'user': str(winner.response.user),
+        })
+
+    def invite_users(self, users):
+        """
+        Invite many users (instances or ids) with one bulk INSERT in the
+        invitations table. Users already invited or participating are skipped.
+        Return the number of new invitations.
+        """
+        through = Battle.invitations_user.through
+        user_ids = {getattr(user, 'pk', user) for user in users}
+        skip = set(through.objects
+                          .filter(battle_id=self.pk, user_id__in=user_ids)
+                          .values_list('user_id', flat=True))
+        skip.update(self.battles.filter(response__user_id__in=user_ids)
+                                .values_list('response__user_id', flat=True))
+        through.objects.bulk_create([
+            through(battle_id=self.pk, user_id=user_id)
+            for user_id in user_ids - skip
+        ])
+        if user_ids - skip:
+            Battle.bump_version(self.pk)
+        return len(user_ids - skip)
+
+    def enroll_users(self, users):
+        """
+        Create the participations of many users at once and remove their
+        invitations, all in a single transaction. Return the new
+        participations.
+        """
+        users = {user.pk: user for user in users}
+        with transaction.atomic():
+            enrolled = set(self.battles
+                               .filter(response__user_id__in=users)
+                               .values_list('response__user_id', flat=True))
+            new_users = {user_id: user for user_id, user in users.items()
+                         if user_id not in enrolled}
+            responses = self.bulk_responses(new_users)
+            participations = [
+                BattleResponse(battle=self, response=responses[user_id])
+                for user_id in new_users
+            ]
+            BattleResponse.objects.bulk_create(participations)
+            if participations:
+                Battle.objects.filter(pk=self.pk).update(
+                    active_count=F('active_count') + len(participations))
+            Battle.invitations_user.through.objects \
+                .filter(battle_id=self.pk, user_id__in=users) \
+                .delete()
+            Battle.bump_version(self.pk)
+        return participations
+
+    def bulk_responses(self, users):
+        """
+        Return the responses of the users ({pk: user}) in the battle context,
+        creating the missing ones with a constant number of queries.
+
+        The question creates the first missing response, so it chooses the
+        response class. Plain Response rows are then inserted with a single
+        bulk_create and read back, as bulk_create does not set primary keys on
+        most databases. Subclasses use multi-table inheritance, which
+        bulk_create can not insert, and are created one by one.
+        """
+        context = self.battle_context
+        responses = {
+            response.user_id: response
+            for response in Response.objects.filter(context=context,
+                                                    user_id__in=users)
+        }
+        missing = [user_id for user_id in users if user_id not in responses]
+        if not missing:
+            return responses
+        first = self.question.get_response(user=users[missing[0]],
+                                           context=context)
+        responses[missing[0]] = first
+        others = missing[1:]
+        if type(first) is not Response:
+            for user_id in others:
+                responses[user_id] = self.question.get_response(
+                    user=users[user_id], context=context)
+            return responses
+        extra = {}
+        if hasattr(first, 'polymorphic_ctype_id'):
+            extra['polymorphic_ctype_id'] = first.polymorphic_ctype_id
+        Response.objects.bulk_create([
+            Response(context=context, user_id=user_id, **extra)
+            for user_id in others
+        ])
+        responses.update(
+            (response.user_id, response)
+            for response in Response.objects.filter(context=context,
+                                                    user_id__in=others)
+        )
+        return responses
+
     def winner_length(self):
-        def source_length(battle):
-            if (battle.last_item.source is not None
-                 and battle.last_item.given_grade == 100):
-                return len(battle.last_item.source)
-            else:
-                return -1
-        return min(self.battles.all(), key=source_length)
+        return self.battles.rank_length().first()
 
     def winner_time(self):
-        def source_time(battle):
-            return battle.time_end - battle.time_begin
-        return min(self.battles.all(),key=source_time)
+        return self.battles.rank_time().first()
+
+    def winner_runtime(self):
+        return self.battles.rank_runtime().first()
 
     def __str__(self):
             return "Battle (%s): %s" % (self.id,self.short_description)
@@ -103,6 +511,8 @@ class BattleResponse(models.Model):
 
     class Meta:
         unique_together = [('response', 'battle')]
+        # The participations still playing of a battle are found through the
+        # partial cs_battles_battleresponse_playing index of migration 0015
 
     response = models.OneToOneField(Response)
     time_begin = models.DateTimeField(auto_now_add=True)
@@ -120,9 +530,58 @@ class BattleResponse(models.Model):
 
     give_up = models.BooleanField(default=False)
 
+    # Number of submitions already spent, it is incremented with a conditional
+    # UPDATE so the limit check never races with concurrent posts
+    submitions_used = models.PositiveIntegerField(default=0, editable=False)
+
+    # Set once when the participation stops being active
+    finished = models.BooleanField(default=False, editable=False)
+
+    # Metrics of the last source, computed when it is graded
+    source_bytes = models.PositiveIntegerField(null=True, editable=False)
+    source_chars = models.PositiveIntegerField(null=True, editable=False)
+    source_tokens = models.PositiveIntegerField(null=True, editable=False)
+    source_ast_nodes = models.PositiveIntegerField(null=True, editable=False)
+
+    # CPU time of the last correct source in runtime battles (seconds), see
+    # cs_battles.runtime
+    runtime_median = models.FloatField(null=True, editable=False)
+    runtime_iqr = models.FloatField(null=True, editable=False)
+
+    # Source of the last item in the content addressed source store
+    source_blob = models.ForeignKey(
+        'SourceBlob',
+        blank=True,
+        null=True,
+        editable=False,
+        related_name='+'
+    )
+
+    objects = BattleResponseQuerySet.as_manager()
+
     @property
     def submitions_count(self):
-        return len(self.response.items.all())
+        return self.submitions_used
+
+    @property
+    def source(self):
+        """Source of the last item, read from the source store."""
+        if self.source_blob_id is not None:
+            return self.source_blob.text
+        if self.last_item is not None:
+            return ItemSource.objects.text(self.last_item)
+
+    def metric(self, name):
+        """Stored value of one of the code_metrics.METRICS."""
+        return getattr(self, 'source_' + (name or 'bytes'))
+
+    @property
+    def source_size(self):
+        """Length of the last source, without decompressing it."""
+        if self.source_blob_id is not None:
+            return self.source_blob.length
+        if self.last_item is not None:
+            return len(self.source)
 
     @property
     def can_submit(self):
@@ -136,29 +595,437 @@ class BattleResponse(models.Model):
         else:
             return self.can_submit and not self.give_up
 
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        super().save(*args, **kwargs)
+        if created:
+            Battle.objects.filter(pk=self.battle_id) \
+                          .update(active_count=F('active_count') + 1)
+
+    def reserve_submition(self):
+        """
+        Spend one submition of the limit. Return False if the limit was already
+        reached.
+        """
+        updated = BattleResponse.objects \
+            .filter(pk=self.pk,
+                    submitions_used__lt=self.battle.limit_submitions) \
+            .update(submitions_used=F('submitions_used') + 1)
+        if updated:
+            self.submitions_used += 1
+        return bool(updated)
+
+    def update_state(self):
+        """
+        Move the participation to the finished counters of the battle when it
+        stops being active and settle the battle winner if it was the last
+        one. Return True only for the call that finished it.
+
+        A participation with a submition still being graded is not finished,
+        the grading of that submition finishes it.
+        """
+        if self.finished or self.is_active or self.grading_pending():
+            return False
+        updated = BattleResponse.objects \
+            .filter(pk=self.pk, finished=False) \
+            .update(finished=True)
+        if updated:
+            self.finished = True
+            Battle.objects.filter(pk=self.battle_id).update(
+                active_count=F('active_count') - 1,
+                finished_count=F('finished_count') + 1,
+                version=F('version') + 1,
+                updated=timezone.now(),
+            )
+            self.battle.determine_winner()
+        return bool(updated)
+
+    def grading_pending(self):
+        return ResponseItem.objects.filter(response_id=self.response_id,
+                                           given_grade__isnull=True).exists()
+
+    def changed(self):
+        """
+        Update the battle state after the participation changed. The version
+        of a mass battle only changes when a participation finishes, so the
+        submitions of thousands of challengers do not all write the battle
+        row.
+        """
+        if not self.update_state() and not self.battle.mass:
+            Battle.bump_version(self.battle_id)
+        self.publish_progress()
+
     def give_up_battle(self):
         self.give_up = True
-        self.save()
+        self.save(update_fields=['give_up'])
+        self.changed()
 
-    def submit_code(self,source_code,give_up=False):
-        if self.can_submit:
-            response_item = self.battle.question.register_response_item(
+    def register_code(self,source_code):
+        """Spend a submition and register the source code without grading."""
+        if self.reserve_submition():
+            return self.battle.question.register_response_item(
                 user=self.response.user,
                 language=self.battle.language,
                 source=source_code,
                 context=self.battle.battle_context,
                 )
-            response_item.autograde()
-            self.give_up = give_up
-            self.update(response_item)
-            return response_item
         else:
             raise Exception(_('Limit of submitions was reached'))
 
-    def update(self, response_item):
+    def submit_code(self,source_code,give_up=False):
+        """
+        Register the source code and grade it. In queued grading mode the
+        returned response item is still pending.
+        """
+        with metrics.grading_phase('register'):
+            response_item = self.register_code(source_code)
+        return grading.dispatch(self, response_item, give_up)
+
+    def update(self, response_item, all_metrics=False):
+        """
+        Record a graded item. Only bytes and the metric that ranks the battle
+        are measured unless ``all_metrics`` is true, see code_metrics.
+        """
         self.time_end = response_item.created
         self.last_item = response_item
-        self.save()
+        source = ItemSource.objects.text(response_item)
+        self.source_blob = ItemSource.objects.move(response_item, source)
+        update_fields = ['time_end', 'last_item', 'source_blob']
+        names = code_metrics.METRICS
+        if not all_metrics:
+            names = {'bytes', self.battle.length_metric or 'bytes'}
+        for name, value in code_metrics.measure(source,
+                                                self.battle.language,
+                                                names).items():
+            setattr(self, 'source_' + name, value)
+            update_fields.append('source_' + name)
+        if self.battle.challenge_type == 'runtime':
+            update_fields.extend(['runtime_median', 'runtime_iqr'])
+        # Counters are owned by the conditional updates and give_up is never
+        # reset by a late grading, so only save what the grading changed
+        if self.give_up:
+            update_fields.append('give_up')
+        self.save(update_fields=update_fields)
+        self.changed()
+
+    def publish_progress(self):
+        events.publish(self.battle_id, events.PROGRESS, {
+            'battle_response': self.pk,
+            'user': str(self.response.user),
+            'submitions': self.submitions_used,
+            'finished': self.finished,
+            'give_up': self.give_up,
+        })
 
     def __str__(self):
         return "Battle responses of user: %s" % self.response.user
+
+
+class BattleStatsQuerySet(models.QuerySet):
+    """Ranking queries and incremental maintenance of BattleStats."""
+
+    def ranking(self):
+        # Most wins, then fewest losses, see BattleStats.rank_score
+        return self.order_by('rank_score', 'user_id')
+
+    def top(self, size=10):
+        return self.ranking().select_related('user')[:size]
+
+    def rank_of(self, stats):
+        """Position of the given stats in the ranking, starting at 1."""
+        better = self.filter(
+            Q(rank_score__lt=stats.rank_score)
+            | Q(rank_score=stats.rank_score, user_id__lt=stats.user_id)
+        )
+        return better.count() + 1
+
+    def record_battle(self, battle):
+        """
+        Add the results of a settled battle to its participants stats. It runs
+        once the winner is committed, the rebuild_battle_stats command replays
+        the battles that a crash could have skipped.
+        """
+        with transaction.atomic():
+            self._record_battle(battle)
+
+    def _record_battle(self, battle):
+        if battle.archived:
+            from cs_battles.archive import stats_results
+            results = stats_results(battle)
+        else:
+            results = list(battle.battles.with_correctness().annotate(
+                source_length=_length_metric(),
+                duration=ExpressionWrapper(F('time_end') - F('time_begin'),
+                                           output_field=DurationField()),
+                runtime=F('runtime_median'),
+            ).values('pk', 'response__user_id', 'incorrect', 'source_length',
+                     'duration', 'runtime'))
+        users = [row['response__user_id'] for row in results]
+        existing = set(self.filter(user_id__in=users)
+                           .values_list('user_id', flat=True))
+        # Battles sharing a user may be recorded at the same time, so the
+        # missing rows are created one by one: get_or_create() recovers when
+        # another transaction inserted the same user first
+        for user in set(users) - existing:
+            self.get_or_create(user_id=user)
+
+        # One UPDATE per chunk of participants, whatever the battle size
+        for start in range(0, len(results), 500):
+            chunk = results[start:start + 500]
+            wins, lengths, length_counts, times, time_counts = {}, {}, {}, {}, {}
+            runtimes, runtime_counts = {}, {}
+            for row in chunk:
+                user = row['response__user_id']
+                wins[user] = int(row['pk'] == battle.battle_winner_id)
+                if not row['incorrect'] and row['source_length'] is not None:
+                    lengths[user] = row['source_length']
+                    length_counts[user] = 1
+                if row['duration'] is not None:
+                    times[user] = row['duration'].total_seconds()
+                    time_counts[user] = 1
+                # Only correct sources of runtime battles are benchmarked
+                if not row['incorrect'] and row.get('runtime') is not None:
+                    runtimes[user] = row['runtime']
+                    runtime_counts[user] = 1
+            self.filter(user_id__in=list(wins)).update(
+                battles=F('battles') + 1,
+                wins=_increment('wins', wins),
+                losses=_increment('losses',
+                                  {user: 1 - won for user, won in wins.items()}),
+                rank_score=_increment('rank_score', {
+                    user: BattleStats.score(won, 1 - won)
+                    for user, won in wins.items()
+                }, models.BigIntegerField()),
+                length_total=_increment('length_total', lengths),
+                length_count=_increment('length_count', length_counts),
+                time_total=_increment('time_total', times, models.FloatField()),
+                time_count=_increment('time_count', time_counts),
+                runtime_total=_increment('runtime_total', runtimes,
+                                         models.FloatField()),
+                runtime_count=_increment('runtime_count', runtime_counts),
+            )
+
+
+def _increment(name, increments, output_field=None):
+    """F(name) plus a per user increment, as a single CASE expression."""
+    whens = [When(user_id=user, then=Value(value))
+             for user, value in increments.items() if value]
+    if not whens:
+        return F(name)
+    return F(name) + Case(*whens, default=Value(0),
+                          output_field=output_field or IntegerField())
+
+
+class BattleStats(models.Model):
+    """
+    Materialized battle statistics of one user. Rows are updated every time a
+    battle winner is settled and can be rebuilt with the rebuild_battle_stats
+    command.
+    """
+
+    class Meta:
+        # The ranking reads this index in order, without sorting the table
+        index_together = [('rank_score', 'user')]
+
+    # Weight of a win in rank_score, more than any number of losses
+    WIN_WEIGHT = 2 ** 32
+
+    user = models.OneToOneField(auth_model.User, related_name='battle_stats')
+    battles = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+    losses = models.PositiveIntegerField(default=0)
+    # score(wins, losses): sorting it ascending ranks by most wins, then by
+    # fewest losses, in a single direction
+    rank_score = models.BigIntegerField(default=0, editable=False)
+
+    # Length of correct solutions and time spent in each battle (seconds)
+    length_total = models.BigIntegerField(default=0)
+    length_count = models.PositiveIntegerField(default=0)
+    time_total = models.FloatField(default=0)
+    time_count = models.PositiveIntegerField(default=0)
+    # Median CPU time of correct solutions in runtime battles (seconds)
+    runtime_total = models.FloatField(default=0)
+    runtime_count = models.PositiveIntegerField(default=0)
+
+    objects = BattleStatsQuerySet.as_manager()
+
+    @classmethod
+    def score(cls, wins, losses):
+        return losses - wins * cls.WIN_WEIGHT
+
+    @property
+    def average_length(self):
+        if self.length_count:
+            return self.length_total / self.length_count
+
+    @property
+    def average_time(self):
+        if self.time_count:
+            return self.time_total / self.time_count
+
+    @property
+    def average_runtime(self):
+        if self.runtime_count:
+            return self.runtime_total / self.runtime_count
+
+    @property
+    def rank(self):
+        return BattleStats.objects.rank_of(self)
+
+    def __str__(self):
+        return "Battle stats of user: %s" % self.user
+
+
+class GradeCacheEntry(models.Model):
+    """
+    Shared tier of the grade cache. It stores the graded fields of a response
+    item for a source code (see cs_battles.cache.GradeCache).
+    """
+
+    class Meta:
+        unique_together = [
+            ('question', 'iospec_hash', 'language', 'source_hash')
+        ]
+
+    question = models.ForeignKey(CodingIoQuestion, related_name='+')
+    iospec_hash = models.CharField(max_length=64)
+    language = models.ForeignKey(ProgrammingLanguage, related_name='+')
+    source_hash = models.CharField(max_length=64)
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "Grade cache for question %s: %s" % (self.question_id,
+                                                    self.source_hash)
+
+
+class SourceBlobQuerySet(models.QuerySet):
+    def store(self, source):
+        """
+        Return the blob of a source. Known sources are neither compressed nor
+        written again.
+        """
+        digest = sources.digest(source)
+        blob = self.defer('data').filter(pk=digest).first()
+        if blob is None:
+            codec = sources.default_codec()
+            data = sources.compress(source, codec)
+            blob = self.get_or_create(digest=digest, defaults={
+                'data': data,
+                'codec': codec,
+                'length': len(source),
+                'size': len(data),
+            })[0]
+        return blob
+
+
+class SourceBlob(models.Model):
+    """
+    A compressed source code, keyed by its SHA-256 digest (see
+    cs_battles.sources).
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    codec = models.CharField(max_length=8, default=sources.ZLIB)
+    length = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = SourceBlobQuerySet.as_manager()
+
+    @property
+    def text(self):
+        return sources.decompress(self.data, self.codec)
+
+    def __str__(self):
+        return "Source %s" % self.digest
+
+
+class ItemSourceQuerySet(models.QuerySet):
+    def move(self, response_item, source):
+        """
+        Store the source of a graded item as a blob, point the item at it and
+        clear the text of the item, so the blob is its only copy. Return the
+        blob.
+        """
+        blob = SourceBlob.objects.store(source)
+        self.update_or_create(item_id=response_item.pk,
+                              defaults={'blob': blob})
+        if response_item.source:
+            type(response_item).objects.filter(pk=response_item.pk) \
+                                       .update(source='')
+        return blob
+
+    def text(self, response_item):
+        """Source of a response item, moved to the source store or not."""
+        if response_item.source:
+            return response_item.source
+        moved = self.select_related('blob').filter(item_id=response_item.pk) \
+                                           .first()
+        return moved.blob.text if moved is not None else response_item.source
+
+
+class ItemSource(models.Model):
+    """
+    Blob of a graded battle item. The text of the item is cleared when it is
+    recorded, see ItemSourceQuerySet.move().
+    """
+    item = models.OneToOneField(ResponseItem, primary_key=True,
+                                related_name='battle_source')
+    blob = models.ForeignKey(SourceBlob, related_name='+')
+
+    objects = ItemSourceQuerySet.as_manager()
+
+    def __str__(self):
+        return "Source of item %s: %s" % (self.item_id, self.blob_id)
+
+
+class BattleArchive(models.Model):
+    """
+    Results and sources of a finished battle, stored as zlib compressed JSON
+    after its participations were removed from the hot tables (see
+    cs_battles.archive).
+    """
+    battle = models.OneToOneField(Battle, primary_key=True,
+                                  related_name='archive')
+    data = models.BinaryField()
+    participants = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def payload(self):
+        if not hasattr(self, '_payload'):
+            from cs_battles.archive import decompress
+            self._payload = decompress(self.data)
+        return self._payload
+
+    def __str__(self):
+        return "Archive of battle %s" % self.battle_id
+
+
+class SandboxReport(models.Model):
+    """
+    Status and resources used by a response item when it ran in the grading
+    sandbox (see cs_battles.sandbox).
+    """
+    item = models.OneToOneField(ResponseItem, primary_key=True,
+                                related_name='sandbox_report')
+    status = models.CharField(max_length=20, choices=sandbox.STATUSES)
+    cpu_time = models.FloatField()
+    wall_time = models.FloatField()
+    peak_memory = models.BigIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def violation(self):
+        return self.status in sandbox.VIOLATIONS
+
+    def __str__(self):
+        return "Sandbox report of item %s: %s" % (self.item_id, self.status)
+
+
+@receiver(post_save, sender=CodingIoQuestion)
+def invalidate_grade_cache(sender, instance, **kwargs):
+    grade_cache = get_grade_cache()
+    if grade_cache is not None:
+        grade_cache.invalidate(instance)
@@ -0,0 +1,100 @@
+"""
+Prefetched object graphs used by the battle views.
+
+Every function returns the related objects its template touches, so the
+number of queries of a page stays the same as the participants grow.
+"""
+from django.db.models import Prefetch
+
+from cs_battles.models import Battle, BattleResponse
+
+
+def participations(queryset=None):
+    """Participations with their user, last item and activity flag."""
+    if queryset is None:
+        queryset = BattleResponse.objects.all()
+    if not queryset.ordered:
+        queryset = queryset.order_by('pk')
+    return queryset.with_activity() \
+                   .select_related('response__user', 'last_item',
+                                   'source_blob')
+
+
+def top_participants(battle, size):
+    """The best ranked participations of a battle, with their last items."""
+    return list(participations(battle.battles.ranked(battle.challenge_type))
+                [:size])
+
+
+STANDING_FIELDS = ('pk', 'response__user__username', 'time_begin', 'time_end',
+                   'give_up', 'submitions_used', 'incorrect')
+
+RANKING_FIELDS = ('source_length', 'duration', 'runtime')
+
+
+def standings(battle):
+    """
+    Ranked participations of a battle as dictionaries. Source codes are never
+    loaded, so pages of standings cost the same for any number of
+    participants.
+    """
+    ranked = battle.battles.ranked(battle.challenge_type)
+    fields = STANDING_FIELDS + tuple(
+        name for name in RANKING_FIELDS if name in ranked.query.annotations)
+    return ranked.values(*fields)
+
+
+def iter_standings(battle, chunk_size=500):
+    """Iterate over all standings fetching chunk_size rows at a time."""
+    queryset = standings(battle)
+    start = 0
+    while True:
+        chunk = list(queryset[start:start + chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        start += chunk_size
+
+
+def battle_summary(queryset=None):
+    """Battles with their activity flag, question, language and winner."""
+    if queryset is None:
+        queryset = Battle.objects.all()
+    return queryset.with_activity() \
+        .select_related('question', 'language',
+                        'battle_winner__response__user')
+
+
+def battle_detail(queryset=None):
+    """
+    Battles ready for the detail page. The participations are prefetched into
+    ``participants`` and the invited users into ``pending_users``.
+    """
+    return battle_summary(queryset) \
+        .prefetch_related(
+            Prefetch('battles', queryset=participations(),
+                     to_attr='participants'),
+            Prefetch('invitations_user', to_attr='pending_users'),
+        )
+
+
+def battle_for_submition(battle_pk):
+    """Battle with everything needed to register and grade a submition."""
+    return Battle.objects \
+        .select_related('question', 'language', 'battle_context') \
+        .get(pk=battle_pk)
+
+
+def user_battles(user):
+    """Participations of a user with their battle and question."""
+    return BattleResponse.objects \
+        .filter(response__user_id=user.id) \
+        .select_related('battle__question', 'battle__language', 'last_item')
+
+
+def user_invitations(user):
+    """Battles the user was invited to, with their question and language."""
+    return Battle.objects \
+        .filter(invitations_user=user.id) \
+        .select_related('question', 'language')
@@ -0,0 +1,131 @@
+"""
+Cache of the results of finished battles.
+
+Once a battle has a winner its result section never changes, so the rendered
+fragment and the results payload are cached under the battle id and version.
+Any change to the battle or to one of its participations increments the
+version, which invalidates the entry. Archived battles are rendered from
+their BattleArchive (see cs_battles.archive). The backend is configured by
+``BATTLE_RESULTS_CACHE_BACKEND`` (a dotted path to a class with get/set/delete
+methods) and defaults to an LRUCache of ``BATTLE_RESULTS_CACHE_SIZE`` entries.
+"""
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.module_loading import import_string
+
+from cs_battles import queries
+
+DEFAULT_BACKEND = 'cs_battles.cache.LRUCache'
+
+_backend = (None, None)
+
+
+def get_backend():
+    global _backend
+    path = getattr(settings, 'BATTLE_RESULTS_CACHE_BACKEND', DEFAULT_BACKEND)
+    if _backend[0] != path:
+        if path == DEFAULT_BACKEND:
+            size = getattr(settings, 'BATTLE_RESULTS_CACHE_SIZE', 256)
+            _backend = (path, import_string(path)(size))
+        else:
+            _backend = (path, import_string(path)())
+    return _backend[1]
+
+
+def cache_key(battle):
+    return 'cs_battles:results:%s:%s' % (battle.pk, battle.version)
+
+
+def load_participants(battle):
+    """
+    Attach the participants and invited users used by the result pages. Mass
+    battles only load the best ``BATTLE_MASS_TOP_SOURCES`` participants.
+    """
+    if not hasattr(battle, 'participants'):
+        if battle.mass:
+            size = getattr(settings, 'BATTLE_MASS_TOP_SOURCES', 10)
+            battle.participants = queries.top_participants(battle, size)
+        else:
+            battle.participants = list(
+                queries.participations(battle.battles.all()))
+    if not hasattr(battle, 'pending_users'):
+        if battle.mass:
+            battle.pending_users = []
+        else:
+            battle.pending_users = list(battle.invitations_user.all())
+    return battle
+
+
+def results_payload(battle):
+    """Serializable results of a battle."""
+    load_participants(battle)
+    winner = battle.battle_winner
+    participants = []
+    for battle_response in battle.participants:
+        last_item = battle_response.last_item
+        duration = None
+        if battle_response.time_end is not None:
+            duration = (battle_response.time_end
+                        - battle_response.time_begin).total_seconds()
+        participants.append({
+            'id': battle_response.pk,
+            'user': str(battle_response.response.user),
+            'user_id': battle_response.response.user.id,
+            'time': duration,
+            'length': battle_response.source_size,
+            'grade': (float(last_item.given_grade)
+                      if last_item and last_item.given_grade is not None
+                      else None),
+            'give_up': battle_response.give_up,
+            'runtime': battle_response.runtime_median,
+        })
+    return {
+        'battle': battle.pk,
+        'version': battle.version,
+        'challenge_type': battle.challenge_type,
+        'winner': winner.pk if winner else None,
+        'winner_user': str(winner.response.user) if winner else None,
+        'participants': participants,
+    }
+
+
+def render_results(battle):
+    load_participants(battle)
+    return render_to_string('battles/results.jinja2', {
+        'object': battle,
+        'all_battles': battle.participants,
+    })
+
+
+def results_entry(battle):
+    if battle.archived:
+        from cs_battles import archive
+        return archive.results_entry(battle)
+    return {
+        'html': render_results(battle),
+        'payload': results_payload(battle),
+    }
+
+
+def fill_cache(battle_pk):
+    """Render and store the results of a finished battle."""
+    battle = queries.battle_summary().get(pk=battle_pk)
+    if battle.battle_winner_id is None:
+        return None
+    entry = results_entry(battle)
+    get_backend().set(cache_key(battle), entry)
+    return entry
+
+
+def get_results(battle):
+    """
+    Return the cached {'html', 'payload'} entry of a finished battle, filling
+    it on a miss. Return None for battles without a winner.
+    """
+    if battle.battle_winner_id is None:
+        return None
+    entry = get_backend().get(cache_key(battle))
+    if entry is None:
+        entry = results_entry(battle)
+        get_backend().set(cache_key(battle), entry)
+    return entry
@@ -0,0 +1,102 @@
+"""
+Runtime benchmarks of correct submitions.
+
+Participations of "runtime" battles are ranked by the CPU time of their last
+correct source. When such a source is graded each round runs it in the
+sandbox (see cs_battles.sandbox) against the inputs of every test case of the
+question, one process per test case, and sums the CPU time the parent reads
+for those processes with wait4(). The source can not report its own timings,
+and the interpreter start up it is charged for is the same for everyone.
+``BATTLE_RUNTIME_WARMUP`` warm-up rounds are discarded and the median and
+interquartile range of ``BATTLE_RUNTIME_REPETITIONS`` measured rounds are
+stored in the participation. ``BATTLE_RUNTIME_TIMEOUT`` limits the CPU and
+wall time of each test case run, the memory and output limits of the sandbox
+apply as usual.
+
+Benchmarks take seconds, so runtime battles are always graded by the grading
+backend, even in "sync" mode (see cs_battles.grading.dispatch).
+
+Only Python battles can be benchmarked.
+"""
+import logging
+
+from django.conf import settings
+
+from cs_battles import sandbox
+
+logger = logging.getLogger(__name__)
+
+
+class BenchmarkError(Exception):
+    """The source could not be benchmarked."""
+
+
+def quantile(values, fraction):
+    """Linear interpolation quantile of a sorted list."""
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    q1, median, q3 = (quantile(timings, x) for x in (0.25, 0.5, 0.75))
+    return {
+        'median': median,
+        'iqr': q3 - q1,
+        'min': timings[0],
+        'repetitions': len(timings),
+    }
+
+
+def question_inputs(question):
+    """Inputs of each test case of the question iospec."""
+    return [list(case.inputs()) for case in question.iospec]
+
+
+def benchmark(source, inputs, warmup=None, repetitions=None, timeout=None):
+    """
+    Run the source in the sandbox and return the summary of the CPU time
+    spent in each repetition over all inputs.
+    """
+    if warmup is None:
+        warmup = getattr(settings, 'BATTLE_RUNTIME_WARMUP', 1)
+    if repetitions is None:
+        repetitions = getattr(settings, 'BATTLE_RUNTIME_REPETITIONS', 5)
+    if timeout is None:
+        timeout = getattr(settings, 'BATTLE_RUNTIME_TIMEOUT', 30)
+    limits = sandbox.Limits(cpu_time=timeout, wall_time=timeout)
+    timings = []
+    for repetition in range(warmup + repetitions):
+        result = sandbox.check_source(source, inputs, limits)
+        if result.status == sandbox.TIME_LIMIT:
+            raise BenchmarkError('A test case took more than %s seconds'
+                                 % timeout)
+        if result.status != sandbox.OK:
+            raise BenchmarkError(result.status)
+        if repetition >= warmup:
+            timings.append(result.cpu_time)
+    return summarize(timings)
+
+
+def measure_response(battle_response, response_item):
+    """
+    Benchmark a graded item and set the runtime of its participation. Only
+    correct sources are benchmarked, the others have no runtime.
+    """
+    battle = battle_response.battle
+    battle_response.runtime_median = None
+    battle_response.runtime_iqr = None
+    if response_item.given_grade != 100:
+        return None
+    try:
+        summary = benchmark(response_item.source,
+                            question_inputs(battle.question))
+    except BenchmarkError as error:
+        logger.warning('Could not benchmark item %s: %s', response_item.pk,
+                       error)
+        return None
+    battle_response.runtime_median = summary['median']
+    battle_response.runtime_iqr = summary['iqr']
+    return summary
@@ -0,0 +1,232 @@
+"""
+Resource limited execution of battle submitions.
+
+Submitted code runs in a child process in its own session and temporary
+directory. On Linux the child is started through cs_battles.sandbox_exec,
+which sets rlimits for CPU time, address space and file size before running
+the command. The parent kills the whole session when the wall time or the
+output size is exceeded, and when the child exits, to stop the processes it
+left behind. The CPU time and peak memory of the child are read with wait4().
+
+Nothing the submitted code writes or reports is trusted: the status and
+resources of a run come from its exit status, the rusage of the parent and
+the output read by the parent. Each test case runs in a process of its own.
+
+The limits are configured by the settings ``BATTLE_SANDBOX_CPU_TIME`` and
+``BATTLE_SANDBOX_WALL_TIME`` (seconds), ``BATTLE_SANDBOX_MEMORY`` and
+``BATTLE_SANDBOX_OUTPUT`` (bytes). Set ``BATTLE_SANDBOX = False`` to grade
+without the sandbox check.
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+OK = 'ok'
+RUNTIME_ERROR = 'runtime_error'
+TIME_LIMIT = 'time_limit'
+MEMORY_LIMIT = 'memory_limit'
+OUTPUT_LIMIT = 'output_limit'
+# Grading raised or its worker died, the item got grade 0
+ERROR = 'error'
+
+STATUSES = (
+    (OK, 'ok'),
+    (RUNTIME_ERROR, 'runtime error'),
+    (TIME_LIMIT, 'time limit exceeded'),
+    (MEMORY_LIMIT, 'memory limit exceeded'),
+    (OUTPUT_LIMIT, 'output limit exceeded'),
+    (ERROR, 'grading error'),
+)
+VIOLATIONS = (TIME_LIMIT, MEMORY_LIMIT, OUTPUT_LIMIT)
+
+LAUNCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'sandbox_exec.py')
+
+
+def enabled():
+    return getattr(settings, 'BATTLE_SANDBOX', True)
+
+
+class Limits:
+    """Resource limits of a sandboxed run, defaults come from settings."""
+
+    def __init__(self, cpu_time=None, wall_time=None, memory=None,
+                 output=None):
+        def setting(value, name, default):
+            if value is None:
+                return getattr(settings, name, default)
+            return value
+
+        self.cpu_time = setting(cpu_time, 'BATTLE_SANDBOX_CPU_TIME', 5)
+        self.wall_time = setting(wall_time, 'BATTLE_SANDBOX_WALL_TIME', 10)
+        self.memory = setting(memory, 'BATTLE_SANDBOX_MEMORY', 256 * 2 ** 20)
+        self.output = setting(output, 'BATTLE_SANDBOX_OUTPUT', 2 ** 20)
+
+    def command(self, argv):
+        """Return argv prefixed by the launcher that sets the rlimits."""
+        if resource is None:
+            return list(argv)
+        return [sys.executable, '-I', LAUNCHER, str(int(self.cpu_time + 1)),
+                str(int(self.memory)), str(int(self.output)), '--'] + \
+            [_executable(argv[0])] + list(argv[1:])
+
+
+class Result:
+    """Outcome and resources used by a sandboxed run."""
+
+    def __init__(self, status, returncode, stdout, stderr, cpu_time,
+                 wall_time, peak_memory):
+        self.status = status
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.cpu_time = cpu_time
+        self.wall_time = wall_time
+        self.peak_memory = peak_memory
+
+    @property
+    def violation(self):
+        return self.status in VIOLATIONS
+
+    def __repr__(self):
+        return '<Result %s cpu=%.3fs memory=%s>' % (
+            self.status, self.cpu_time, self.peak_memory)
+
+
+def _executable(name):
+    if os.path.dirname(name):
+        return name
+    return shutil.which(name) or name
+
+
+def _read(stream, chunks, limit, exceeded, kill):
+    size = 0
+    for chunk in iter(lambda: stream.read(65536), b''):
+        size += len(chunk)
+        if size > limit:
+            exceeded.set()
+            kill()
+            break
+        chunks.append(chunk)
+    stream.close()
+
+
+def run(argv, input=b'', limits=None, files=None):
+    """
+    Run a command under the limits and return its Result. ``files`` maps
+    names to the contents of files created in its working directory.
+    """
+    limits = limits or Limits()
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, data in (files or {}).items():
+            with open(os.path.join(workdir, name), 'wb') as file:
+                file.write(data)
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            limits.command(argv), cwd=workdir, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True)
+        timed_out = threading.Event()
+        exceeded = threading.Event()
+
+        def kill():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        def timeout():
+            timed_out.set()
+            kill()
+
+        stdout, stderr = [], []
+        readers = [
+            threading.Thread(target=_read, args=(
+                process.stdout, stdout, limits.output, exceeded, kill)),
+            threading.Thread(target=_read, args=(
+                process.stderr, stderr, limits.output, exceeded, kill)),
+        ]
+        timer = threading.Timer(limits.wall_time, timeout)
+        for thread in readers:
+            thread.start()
+        timer.start()
+        try:
+            process.stdin.write(input)
+            process.stdin.close()
+        except OSError:
+            pass
+        # Wait for the exit without reaping the child: while it is a zombie
+        # its pid, which is also the group id, can not be reused, so killing
+        # the group never reaches an unrelated process
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        wall_time = time.perf_counter() - start
+        timer.cancel()
+        timer.join()
+        kill()
+        for thread in readers:
+            thread.join()
+        _, status, usage = os.wait4(process.pid, 0)
+        # The process was reaped by wait4(), Popen must not wait for it
+        process.returncode = (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                              else os.WEXITSTATUS(status))
+
+    cpu_time = usage.ru_utime + usage.ru_stime
+    signum = -process.returncode
+    if exceeded.is_set() or signum == getattr(signal, 'SIGXFSZ', None):
+        outcome = OUTPUT_LIMIT
+    elif (timed_out.is_set() or signum == getattr(signal, 'SIGXCPU', None)
+          or cpu_time >= limits.cpu_time):
+        outcome = TIME_LIMIT
+    elif process.returncode != 0:
+        outcome = RUNTIME_ERROR
+    else:
+        outcome = OK
+    return Result(outcome, process.returncode, b''.join(stdout),
+                  b''.join(stderr), cpu_time, wall_time,
+                  usage.ru_maxrss * 1024)
+
+
+def run_source(source, input=b'', limits=None):
+    """
+    Run a Python source once under the limits, with input as its stdin.
+    A MemoryError only tells a memory limit from other runtime errors, so
+    the source can not make itself look better by faking it.
+    """
+    result = run([sys.executable, '-I', 'main.py'], input, limits,
+                 files={'main.py': source.encode('utf8')})
+    if result.status == RUNTIME_ERROR and b'MemoryError' in result.stderr:
+        result.status = MEMORY_LIMIT
+    return result
+
+
+def case_input(lines):
+    return ''.join(line + '\n' for line in lines).encode('utf8')
+
+
+def check_source(source, inputs, limits=None):
+    """
+    Run a Python source once for each test case input in a process of its
+    own. Return the Result of the first case that failed, or a Result with
+    the CPU and wall time of all cases and their largest peak memory.
+    """
+    total = Result(OK, 0, b'', b'', 0.0, 0.0, 0)
+    for lines in inputs:
+        result = run_source(source, case_input(lines), limits)
+        if result.status != OK:
+            return result
+        total.cpu_time += result.cpu_time
+        total.wall_time += result.wall_time
+        total.peak_memory = max(total.peak_memory, result.peak_memory)
+    return total
@@ -0,0 +1,36 @@
+"""
+Launcher of the commands run by cs_battles.sandbox.
+
+``python sandbox_exec.py CPU_TIME MEMORY OUTPUT -- ARGV...`` sets the rlimits
+of the current process and replaces it with ARGV. The sandbox runs it instead
+of using preexec_fn, which is not safe in a process with threads. It only uses
+the standard library and must not import Django.
+"""
+import os
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def set_limits(cpu_time, memory, output):
+    if resource is None:
+        return
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (output, output))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def main(args):
+    separator = args.index('--')
+    cpu_time, memory, output = map(int, args[:separator])
+    argv = args[separator + 1:]
+    set_limits(cpu_time, memory, output)
+    os.execv(argv[0], argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,61 @@
+"""
+Content addressed storage of submition sources.
+
+Once a battle item is graded its source moves to a SourceBlob row keyed by
+its SHA-256 digest: the item points to the blob through an ItemSource row and
+its own text is cleared, so a source submitted again is stored once. Blobs are
+compressed with the codec chosen by ``BATTLE_SOURCE_CODEC``: "zlib" (the
+default) or "zstd", which requires the optional zstandard package. The length
+of the source is stored with the blob and rankings never decompress it.
+
+Read the source of a battle item with ``ItemSource.objects.text(item)``.
+"""
+import hashlib
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+
+def digest(source):
+    return hashlib.sha256(source.encode('utf8')).hexdigest()
+
+
+def default_codec():
+    return getattr(settings, 'BATTLE_SOURCE_CODEC', ZLIB)
+
+
+def _zstandard():
+    if zstandard is None:
+        raise ImproperlyConfigured(
+            'The zstd source codec requires the zstandard package.')
+    return zstandard
+
+
+def compress(source, codec=None):
+    data = source.encode('utf8')
+    codec = codec or default_codec()
+    if codec == ZLIB:
+        return zlib.compress(data, 9)
+    elif codec == ZSTD:
+        return _zstandard().ZstdCompressor(level=10).compress(data)
+    raise ImproperlyConfigured('Unknown source codec: %r' % codec)
+
+
+def decompress(data, codec):
+    data = bytes(data)
+    if codec == ZLIB:
+        data = zlib.decompress(data)
+    elif codec == ZSTD:
+        data = _zstandard().ZstdDecompressor().decompress(data)
+    else:
+        raise ImproperlyConfigured('Unknown source codec: %r' % codec)
+    return data.decode('utf8')
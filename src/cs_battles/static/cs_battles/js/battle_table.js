@@ -1 +1,37 @@
-$('#battles').DataTable();
+// Server-side DataTables for the battle lists.
+//
+// When the user moves to the next page sorted by the key column, the key of
+// the last row received is sent as "after" so the server can use keyset
+// pagination instead of an OFFSET.
+function battleTable(selector, url, columns, createdRow, renderers){
+    var last = {start: null, length: null, order: null, key: null};
+    var columnDefs = [];
+    renderers = renderers || {};
+    for (var i = 0; i < columns; i++){
+        columnDefs.push({data: String(i), render: renderers[i] || null});
+    }
+    return $(selector).DataTable({
+        serverSide: true,
+        processing: true,
+        columns: columnDefs,
+        createdRow: createdRow,
+        ajax: {
+            url: url,
+            data: function(params){
+                var order = JSON.stringify(params.order);
+                if (last.key !== null && order === last.order
+                        && params.start === last.start + last.length
+                        && !params.search.value){
+                    params.after = last.key;
+                }
+                last.start = params.start;
+                last.length = params.length;
+                last.order = order;
+            },
+            dataSrc: function(json){
+                last.key = json.last_key;
+                return json.data;
+            }
+        }
+    });
+}
@@ -0,0 +1,103 @@
+from codeschool.tests import *
+from datetime import timedelta
+from django.core.management import call_command
+from django.utils import timezone
+from cs_battles import archive, queries, results
+from cs_battles.models import Battle, BattleResponse, BattleStats
+from cs_battles.test_models import battle_without_winner
+from cs_core.models import Response, ResponseItem
+
+
+def old_battle(days=60):
+    battle = battle_without_winner()
+    battle.determine_winner()
+    Battle.objects.filter(pk=battle.pk).update(
+        finished_at=timezone.now() - timedelta(days=days))
+    return battle
+
+
+def test_compress_roundtrip():
+    payload = {'participants': [{'source': "print('Oi')"}]}
+    assert archive.decompress(archive.compress(payload)) == payload
+
+@pytest.mark.django_db
+def test_winner_sets_finished_at():
+    battle = battle_without_winner()
+    battle.determine_winner()
+    assert Battle.objects.get(pk=battle.pk).finished_at is not None
+
+@pytest.mark.django_db
+def test_archive_battles_keeps_only_winner():
+    battle = old_battle()
+    response_ids = list(battle.battles.values_list('response_id', flat=True))
+    items = ResponseItem.objects.filter(response_id__in=response_ids).count()
+    call_command('archive_battles', days=30)
+    battle = results.queries.battle_summary().get(pk=battle.pk)
+    assert battle.archived
+    assert list(battle.battles.all()) == [battle.battle_winner]
+    assert (battle.active_count, battle.finished_count) == (0, 1)
+    # Responses belong to cs_core and are kept by default
+    assert Response.objects.filter(pk__in=response_ids).count() == 2
+    assert ResponseItem.objects.filter(response_id__in=response_ids) \
+                               .count() == items
+    payload = battle.archive.payload
+    assert len(payload['participants']) == 2
+    assert payload['participants'][0]['id'] == battle.battle_winner_id
+
+    entry = results.get_results(battle)
+    assert len(entry['payload']['participants']) == 2
+    assert 'Resultado da Batalha' in entry['html']
+    assert len(archive.standings(battle)) == 2
+
+@pytest.mark.django_db
+def test_archive_battles_purge_responses():
+    battle = old_battle()
+    winner = battle.battle_winner
+    loser = battle.battles.exclude(pk=winner.pk).get()
+    call_command('archive_battles', days=30, purge_responses=True)
+    assert not Response.objects.filter(pk=loser.response_id).exists()
+    assert list(ResponseItem.objects.filter(response_id=winner.response_id)) \
+        == [winner.last_item]
+
+@pytest.mark.django_db
+def test_archive_battles_is_resumable():
+    battle = old_battle()
+    recent = old_battle(days=1)
+    assert archive.archive_battle(battle.pk)
+    assert not archive.archive_battle(battle.pk)
+    call_command('archive_battles', days=30)
+    assert not Battle.objects.get(pk=recent.pk).archived
+
+@pytest.mark.django_db
+def test_rebuild_battle_stats_from_archive():
+    battle = old_battle()
+    archive.archive_battle(battle.pk)
+    call_command('rebuild_battle_stats')
+    assert sorted(BattleStats.objects.values_list('wins', flat=True)) == [0, 1]
+    assert sorted(BattleStats.objects.values_list('losses', flat=True)) == [0, 1]
+
+@pytest.mark.django_db
+def test_archived_results_and_standings():
+    battle = old_battle()
+    loser = battle.battles.exclude(pk=battle.battle_winner_id).get()
+    BattleResponse.objects.filter(pk=loser.pk).update(give_up=True)
+    live = {row['pk']: row for row in queries.standings(battle)}
+    archive.archive_battle(battle.pk)
+    battle = Battle.objects.get(pk=battle.pk)
+
+    rows = archive.standings(battle)
+    assert [row['pk'] for row in rows] == \
+        [battle.battle_winner_id, loser.pk]
+    for row in rows:
+        assert row['give_up'] == live[row['pk']]['give_up']
+        assert row['submitions_used'] == live[row['pk']]['submitions_used']
+        assert row['incorrect'] == int(live[row['pk']]['incorrect'])
+
+    participations = archive.participants(battle)
+    assert [p.pk for p in participations] == [row['pk'] for row in rows]
+    for participation in participations:
+        assert participation.give_up == live[participation.pk]['give_up']
+        assert participation.submitions_used == \
+            live[participation.pk]['submitions_used']
+        assert participation.metric('tokens') is not None
+        assert participation.source is not None
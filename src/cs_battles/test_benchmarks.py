@@ -0,0 +1,128 @@
+"""
+Latency and query count budgets for the battle views and hot model methods.
+
+Each target is measured on datasets of growing size (battles x participants x
+submitions) and compared with bench_budgets.json: the number of queries must
+stay under ``max_queries`` and, for ``constant`` targets, must not grow with
+the dataset. Set BATTLE_BENCH_OUTPUT to a path to write the measurements as
+JSON for trend tracking.
+
+Wall clock budgets (``max_ms``) depend on the machine and are only checked
+when BATTLE_BENCH_LATENCY is set, query budgets are always checked.
+"""
+from codeschool.tests import *
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from cs_battles.factories import UserFactory
+from cs_battles.models import Battle
+from cs_battles.test_models import (battle_fixture, battle_response_fix,
+                                    register_item, source_code)
+import json
+import os
+import time
+
+BUDGETS = json.load(open(os.path.join(os.path.dirname(__file__),
+                                      'bench_budgets.json')))
+
+# (battles, participants, submitions per participant)
+DATASETS = [(1, 2, 1), (3, 8, 2)]
+
+MEASUREMENTS = []
+
+CHECK_LATENCY = bool(os.environ.get('BATTLE_BENCH_LATENCY'))
+
+
+@pytest.fixture(scope='module', autouse=True)
+def bench_output():
+    yield
+    path = os.environ.get('BATTLE_BENCH_OUTPUT')
+    if path:
+        with open(path, 'w') as output:
+            json.dump(MEASUREMENTS, output, indent=2)
+
+
+def build_dataset(user, battles, participants, submitions):
+    """Create battles where user and other participants submitted code."""
+    created = []
+    for i in range(battles):
+        battle = battle_fixture()
+        battle.enroll_users([user])
+        for j in range(participants - 1):
+            battle_response = battle_response_fix(battle)
+            for k in range(submitions):
+                register_item(battle_response, source_code('#%d' % k))
+        battle.invitations_user.add(user, UserFactory.create())
+        created.append(battle)
+    return created
+
+
+def settling_battle(participants, submitions):
+    """
+    Return a battle without invitations whose participations are all finished
+    but whose winner was not settled yet.
+    """
+    battle = battle_fixture()
+    for j in range(participants):
+        battle_response = battle_response_fix(battle)
+        for k in range(submitions):
+            register_item(battle_response, source_code('#%d' % k))
+    battle.battles.update(finished=True)
+    Battle.objects.filter(pk=battle.pk).update(
+        battle_winner=None, finished_at=None, active_count=0,
+        finished_count=participants, limit_submitions=submitions)
+    return battle
+
+
+def measure(target, dataset, function):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        function()
+        elapsed = (time.perf_counter() - start) * 1000
+    MEASUREMENTS.append({
+        'target': target,
+        'dataset': dataset,
+        'queries': len(queries),
+        'ms': round(elapsed, 3),
+    })
+    budget = BUDGETS[target]
+    assert len(queries) <= budget['max_queries'], \
+        '%s used %d queries' % (target, len(queries))
+    if CHECK_LATENCY:
+        assert elapsed <= budget['max_ms'], \
+            '%s took %.1fms' % (target, elapsed)
+    return len(queries)
+
+
+def targets(client, user, battles, settling):
+    battle = battles[0]
+    other = battle.battles.exclude(response__user=user).first()
+    return [
+        ('battle_user', lambda: client.get('/battles/user')),
+        ('invitations', lambda: client.get('/battles/invitations')),
+        ('detail', lambda: client.get('/battles/%d/' % battle.pk)),
+        ('list', lambda: client.get('/battles/')),
+        ('submit_code', lambda: other.submit_code(source_code())),
+        ('determine_winner', lambda: Battle.objects.get(pk=settling.pk)
+                                                   .determine_winner()),
+    ]
+
+
+@pytest.mark.django_db
+def test_query_budgets(client):
+    from cs_battles.test_views import client_logged
+
+    counts = {}
+    for dataset in DATASETS:
+        client,user = client_logged(client)
+        battles = build_dataset(user, *dataset)
+        Battle.objects.filter(pk=battles[0].pk).update(limit_submitions=100)
+        settling = settling_battle(*dataset[1:])
+        for target, function in targets(client, user, battles, settling):
+            count = measure(target, list(dataset), function)
+            counts.setdefault(target, []).append(count)
+        assert Battle.objects.get(pk=settling.pk).battle_winner_id is not None
+
+    for target, values in counts.items():
+        if BUDGETS[target]['constant']:
+            assert len(set(values)) == 1, \
+                '%s queries grow with the dataset: %s' % (target, values)
@@ -0,0 +1,76 @@
+from codeschool.tests import *
+from cs_battles.cache import (LRUCache, GradeCache, get_grade_cache,
+                              source_hash)
+from cs_battles.factories import BattleResponseFactory
+from cs_battles.test_models import source_code
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache
+    assert len(cache) == 2
+
+def test_source_hash_ignores_line_endings():
+    assert source_hash("print(1)\r\nprint(2)\n\n") == \
+           source_hash("print(1)\nprint(2)")
+    assert source_hash("print(1)") != source_hash(" print(1)")
+
+def test_grade_cache_is_opt_in(settings):
+    if hasattr(settings, 'BATTLE_GRADE_CACHE'):
+        del settings.BATTLE_GRADE_CACHE
+    assert get_grade_cache() is None
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('use_db', [False, True])
+def test_grade_cache_hit_and_miss(use_db):
+    battle_response = BattleResponseFactory.create()
+    battle = battle_response.battle
+    cache = GradeCache(use_db=use_db)
+    first = battle_response.register_code(source_code())
+    assert not cache.apply(battle.question, battle.language, first)
+    first.autograde()
+    cache.store(battle.question, battle.language, first)
+
+    second = battle_response.register_code(source_code() + "\n")
+    assert cache.apply(battle.question, battle.language, second)
+    assert second.given_grade == first.given_grade
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('use_db', [False, True])
+def test_grade_cache_invalidated_by_iospec(use_db):
+    battle_response = BattleResponseFactory.create()
+    battle = battle_response.battle
+    cache = GradeCache(use_db=use_db)
+    item = battle_response.register_code(source_code())
+    item.autograde()
+    cache.store(battle.question, battle.language, item)
+
+    battle.question.iospec_source = "Other"
+    cache.invalidate(battle.question)
+    assert len(cache.memory) == 0
+    item = battle_response.register_code(source_code())
+    assert not cache.apply(battle.question, battle.language, item)
+
+@pytest.mark.django_db
+def test_grade_cache_db_tier_stores_json():
+    import json
+    from cs_battles.models import GradeCacheEntry
+    battle_response = BattleResponseFactory.create()
+    battle = battle_response.battle
+    item = battle_response.register_code(source_code())
+    item.autograde()
+    GradeCache(use_db=True).store(battle.question, battle.language, item)
+    data = json.loads(GradeCacheEntry.objects.get().data)
+    assert float(data['given_grade']) == float(item.given_grade)
+
+    other = battle_response.register_code(source_code())
+    assert GradeCache(use_db=True).apply(battle.question, battle.language,
+                                         other)
+    assert other.given_grade == item.given_grade
@@ -0,0 +1,70 @@
+from codeschool.tests import *
+from django.core.management import call_command
+from cs_battles import code_metrics
+from cs_battles.models import BattleResponse
+from cs_battles.test_models import battle_without_winner
+
+
+def test_measure_python():
+    metrics = code_metrics.measure("x = 1 + 2  # sum\nprint(x)\n", 'python')
+    assert metrics['bytes'] == 26
+    assert metrics['chars'] == 17
+    assert metrics['tokens'] == 9
+    assert metrics['ast_nodes'] > 0
+
+def test_measure_other_languages():
+    metrics = code_metrics.measure('int main() { return 0; }', 'c')
+    assert metrics['tokens'] == 9
+    assert metrics['ast_nodes'] is None
+
+def test_invalid_python_source():
+    metrics = code_metrics.measure("print('Oi'", 'python')
+    assert metrics['tokens'] == 3
+    assert metrics['ast_nodes'] is None
+
+@pytest.mark.django_db
+def test_metrics_stored_when_graded():
+    battle = battle_without_winner()
+    for battle_response in battle.battles.all():
+        source = battle_response.source
+        assert battle_response.source_bytes == len(source.encode('utf8'))
+        # Grading in the request leaves the other metrics for later
+        assert battle_response.metric('tokens') is None
+        battle_response.update(battle_response.last_item, all_metrics=True)
+        battle_response.refresh_from_db()
+        assert battle_response.metric('tokens') == \
+            code_metrics.count_tokens(source, battle.language)
+
+@pytest.mark.django_db
+def test_battle_metric_measured_in_the_request():
+    battle = battle_without_winner()
+    battle.length_metric = 'tokens'
+    battle.save()
+    battle_response = battle.battles.first()
+    battle_response.update(battle_response.last_item)
+    battle_response.refresh_from_db()
+    assert battle_response.metric('tokens') is not None
+    assert battle_response.metric('chars') is None
+
+@pytest.mark.django_db
+def test_rank_length_uses_battle_metric():
+    battle = battle_without_winner()
+    for battle_response in battle.battles.all():
+        battle_response.last_item.given_grade = 100
+        battle_response.last_item.save()
+    first, second = battle.battles.order_by('pk')
+    BattleResponse.objects.filter(pk=first.pk).update(source_bytes=1,
+                                                      source_tokens=9)
+    BattleResponse.objects.filter(pk=second.pk).update(source_bytes=9,
+                                                       source_tokens=1)
+    assert battle.battles.rank_length().first() == first
+    battle.length_metric = 'tokens'
+    battle.save()
+    assert battle.battles.rank_length().first() == second
+
+@pytest.mark.django_db
+def test_rebuild_code_metrics():
+    battle = battle_without_winner()
+    battle.battles.update(source_bytes=None, source_tokens=None)
+    call_command('rebuild_code_metrics')
+    assert not battle.battles.filter(source_bytes__isnull=True).exists()
@@ -0,0 +1,66 @@
+from codeschool.tests import *
+from cs_battles import events
+from cs_battles.factories import BattleResponseFactory
+from cs_battles.test_models import battle_fixture
+from cs_battles.test_views import client_logged
+
+
+@pytest.fixture
+def layer(settings):
+    settings.BATTLE_CHANNEL_LAYER = 'cs_battles.events.InMemoryChannelLayer'
+    settings.BATTLE_EVENTS_MAX_DURATION = 0
+    events._layer = (None, None)
+    return events.get_layer()
+
+
+def test_in_memory_layer_history():
+    layer = events.InMemoryChannelLayer(history=2)
+    for i in range(3):
+        layer.publish('group', 'progress', {'n': i})
+    assert [e[2]['n'] for e in layer.events_since('group', 0)] == [1, 2]
+    assert layer.events_since('group', 3) == []
+    assert layer.wait('group', 3, timeout=0.01) == []
+    assert layer.events_since('other', 0) == []
+
+def test_format_event():
+    assert events.format_event(3, 'grade', {'ticket': 1}) == \
+        'id: 3\nevent: grade\ndata: {"ticket": 1}\n\n'
+
+@pytest.mark.django_db
+def test_give_up_publishes_progress(layer):
+    battle_response = BattleResponseFactory.create()
+    battle_response.give_up_battle()
+    group = events.battle_group(battle_response.battle_id)
+    types = [event[1] for event in layer.events_since(group, 0)]
+    assert events.PROGRESS in types
+
+@pytest.mark.django_db
+def test_battle_events_stream(client, layer):
+    client,user = client_logged(client)
+    battle = battle_fixture()
+    battle.battle_owner = user
+    battle.save()
+    events.publish(battle.pk, events.WINNER, {'user': 'someone'})
+    events.publish(battle.pk, events.PROGRESS, {'user': 'other'})
+    response = client.get('/battles/events/%d' % battle.pk,
+                          HTTP_LAST_EVENT_ID='1')
+    assert response['Content-Type'] == 'text/event-stream'
+    content = b''.join(response.streaming_content).decode('utf8')
+    assert 'event: progress' in content
+    assert 'event: winner' not in content
+
+@pytest.mark.django_db
+def test_battle_events_only_for_players(client, layer):
+    client,user = client_logged(client)
+    battle = battle_fixture()
+    response = client.get('/battles/events/%d' % battle.pk)
+    assert response.status_code == 403
+
+@pytest.mark.django_db
+def test_battle_events_streams_are_limited(client, layer, settings):
+    settings.BATTLE_EVENTS_MAX_STREAMS = 0
+    client,user = client_logged(client)
+    battle = battle_fixture()
+    battle.invitations_user.add(user)
+    response = client.get('/battles/events/%d' % battle.pk)
+    assert response.status_code == 503
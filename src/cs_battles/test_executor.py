@@ -0,0 +1,104 @@
+from codeschool.tests import *
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cs_battles.executor import GradingExecutor
+import os
+import threading
+
+
+class ManualPool:
+    """Pool that only runs jobs when the test releases them"""
+
+    def __init__(self):
+        self.started = []
+
+    def submit(self, fn, *args):
+        from concurrent.futures import Future
+        future = Future()
+        self.started.append((future, fn, args))
+        return future
+
+    def finish(self, index=0):
+        future, fn, args = self.started.pop(index)
+        future.set_result(fn(*args))
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def test_executor_runs_jobs():
+    executor = GradingExecutor(max_workers=2, pool=ThreadPoolExecutor(2))
+    futures = [executor.submit(1, pow, 2, x) for x in range(5)]
+    assert [f.result(timeout=5) for f in futures] == [1, 2, 4, 8, 16]
+    stats = executor.stats()
+    assert stats['jobs_done'] == 5
+    assert stats['queue_depth'] == 0
+    assert stats['wall_time_avg'] is not None
+
+
+def test_executor_limits_jobs_per_battle():
+    pool = ManualPool()
+    executor = GradingExecutor(max_workers=3, per_battle=1, pool=pool)
+    for x in range(4):
+        executor.submit('hot', abs, x)
+    executor.submit('cold', abs, -1)
+    assert len(pool.started) == 2
+    assert executor.queue_depth == 3
+    pool.finish()
+    assert len(pool.started) == 2
+    assert executor.queue_depth == 2
+
+
+def test_executor_round_robin_between_battles():
+    pool = ManualPool()
+    executor = GradingExecutor(max_workers=1, per_battle=1, pool=pool)
+    a = [executor.submit('a', abs, x) for x in range(3)]
+    b = executor.submit('b', abs, -7)
+    pool.finish()
+    assert a[0].result() == 0
+    pool.finish()
+    assert b.result() == 7
+
+
+def test_executor_requeued_battle_waits_its_turn():
+    pool = ManualPool()
+    executor = GradingExecutor(max_workers=1, per_battle=1, pool=pool)
+    executor.submit('a', abs, -1)
+    b = executor.submit('b', abs, -2)
+    c = executor.submit('c', abs, -3)
+    pool.finish()
+    # 'a' emptied its queue and was served already, 'c' goes first
+    a = executor.submit('a', abs, -4)
+    pool.finish()
+    assert b.result() == 2
+    pool.finish()
+    assert c.result() == 3
+    assert not a.done()
+
+
+def test_executor_inline_jobs_share_the_slots():
+    pool = ManualPool()
+    executor = GradingExecutor(max_workers=1, per_battle=1, pool=pool)
+    executor.submit('a', abs, -1)
+    done = []
+    thread = threading.Thread(
+        target=lambda: done.append(executor.run('b', abs, -2)))
+    thread.start()
+    thread.join(0.1)
+    assert not done
+    pool.finish()
+    thread.join(5)
+    assert done == [2]
+    assert executor.running == 0
+
+
+def test_executor_replaces_broken_pool():
+    executor = GradingExecutor(max_workers=1)
+    assert executor.submit(1, pow, 2, 3).result(timeout=30) == 8
+    future = executor.submit(1, os._exit, 1)
+    with pytest.raises(BrokenProcessPool):
+        future.result(timeout=30)
+    assert executor.broken
+    assert executor.submit(1, pow, 2, 4).result(timeout=30) == 16
+    assert not executor.broken
+    executor.shutdown()
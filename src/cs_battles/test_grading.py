@@ -0,0 +1,98 @@
+from codeschool.tests import *
+from cs_battles import grading, sandbox
+from cs_battles.factories import BattleResponseFactory
+from cs_battles.models import BattleResponse, SandboxReport
+from cs_battles.test_models import source_code
+from cs_battles.test_views import client_logged, battle_response_iospec
+import json
+
+
+@pytest.fixture
+def queued(settings):
+    settings.BATTLE_GRADING_MODE = grading.QUEUED
+    settings.BATTLE_GRADING_BACKEND = 'cs_battles.grading.LocalQueueBackend'
+    settings.BATTLE_GRADING_WORKERS = 0
+    return grading.get_backend()
+
+
+@pytest.mark.django_db
+def test_sync_mode_grades_in_request():
+    battle_response = BattleResponseFactory.create()
+    response_item = battle_response.submit_code(source_code())
+    assert not grading.is_pending(response_item)
+    assert battle_response.last_item == response_item
+
+
+@pytest.mark.django_db
+def test_runtime_battles_are_queued_in_sync_mode(settings):
+    settings.BATTLE_GRADING_BACKEND = 'cs_battles.grading.LocalQueueBackend'
+    settings.BATTLE_GRADING_WORKERS = 0
+    battle_response = BattleResponseFactory.create(
+        battle__challenge_type='runtime')
+    response_item = battle_response.submit_code(source_code())
+    assert grading.is_pending(response_item)
+    assert grading.get_backend().drain() == 1
+
+@pytest.mark.django_db
+def test_queued_mode_returns_pending_item(queued):
+    battle_response = BattleResponseFactory.create()
+    response_item = battle_response.submit_code(source_code())
+    assert grading.is_pending(response_item)
+    assert battle_response.last_item is None
+    assert queued.drain() == 1
+    battle_response.refresh_from_db()
+    assert battle_response.last_item_id == response_item.pk
+    assert battle_response.last_item.given_grade is not None
+
+
+@pytest.mark.django_db
+def test_queued_submition_ticket(client, queued):
+    client,user = client_logged(client)
+    battle_response = battle_response_iospec(user)
+    response = client.post('/battles/battle/%d'%battle_response.battle.pk,
+                           {'code':"print('Oi')"})
+    content = json.loads(response.content.decode('unicode_escape'))
+    assert content['status_code'] == 3
+    url = '/battles/submition/%d' % content['ticket']
+
+    status = json.loads(client.get(url).content.decode('unicode_escape'))
+    assert status['status'] == 'pending'
+    queued.drain()
+    status = json.loads(client.get(url).content.decode('unicode_escape'))
+    assert status['status'] == 'graded'
+    assert status['status_code'] == 0
+
+
+@pytest.mark.django_db
+def test_queued_give_up_finishes_when_graded(client, queued):
+    client,user = client_logged(client)
+    battle_response = battle_response_iospec(user)
+    client.post('/battles/surrender/%d'%battle_response.battle.pk,
+                {'code':"print('O')"})
+    battle_response = BattleResponse.objects.get(pk=battle_response.pk)
+    assert battle_response.give_up
+    assert not battle_response.finished
+    assert queued.drain() == 1
+    battle_response = BattleResponse.objects.get(pk=battle_response.pk)
+    assert battle_response.finished
+    assert battle_response.last_item.given_grade is not None
+
+
+def failing_grader(battle, response_item):
+    raise RuntimeError('grader crashed')
+
+
+@pytest.mark.django_db
+def test_failed_job_is_graded_as_error(client, queued, settings):
+    settings.BATTLE_GRADER = 'cs_battles.test_grading.failing_grader'
+    client,user = client_logged(client)
+    battle_response = battle_response_iospec(user)
+    response = client.post('/battles/battle/%d'%battle_response.battle.pk,
+                           {'code':"print('Oi')"})
+    ticket = json.loads(response.content.decode('unicode_escape'))['ticket']
+    queued.drain()
+    status = json.loads(client.get('/battles/submition/%d' % ticket)
+                        .content.decode('unicode_escape'))
+    assert status['status'] == 'graded'
+    assert status['status_code'] == 9
+    assert SandboxReport.objects.get(item_id=ticket).status == sandbox.ERROR
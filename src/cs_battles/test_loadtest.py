@@ -0,0 +1,53 @@
+from codeschool.tests import *
+from cs_battles import throttle
+from cs_battles.factories import BattleResponseFactory
+from cs_battles.loadtest import LoadDriver, percentile
+from cs_battles.models import Battle
+from cs_core.models import ResponseContext
+
+
+def test_percentile():
+    values = [0.5, 0.1, 0.4, 0.2, 0.3]
+    assert percentile(values, 0.5) == 0.3
+    assert percentile(values, 0.99) == 0.5
+    assert percentile(values, 0) == 0.1
+    assert percentile([], 0.5) is None
+
+def test_report():
+    driver = LoadDriver('http://localhost', question=None)
+    driver.record('battle', 0, 200, b'{"status_code": 0}')
+    driver.record('battle', 0, 200, b'{"status_code": 4}')
+    driver.record('surrender', 0, 500, b'')
+    report = driver.report(2)
+    assert report['requests'] == 3
+    assert report['throughput'] == 1.5
+    assert report['errors'] == 1
+    assert report['endpoints']['battle']['error_rate'] == 0
+    assert report['endpoints']['surrender']['error_rate'] == 1
+    assert report['outcomes'] == {'AC': 1, 'THROTTLED': 1}
+
+
+@pytest.mark.django_db
+def test_stub_grader(settings):
+    settings.BATTLE_GRADER = 'cs_battles.loadtest.stub_autograde'
+    settings.BATTLE_STUB_GRADER_LATENCY = 0
+    battle_response = BattleResponseFactory.create()
+    response_item = battle_response.submit_code('print("anything")')
+    assert response_item.given_grade == 100
+    assert battle_response.last_item == response_item
+
+def test_throttle_can_be_disabled(settings):
+    settings.BATTLE_SUBMIT_THROTTLE = False
+    limiter = throttle.get_throttle()
+    for i in range(10):
+        assert limiter.admit(1, 1, 'a').outcome == throttle.ADMITTED
+
+@pytest.mark.django_db
+def test_cleanup_deletes_contexts():
+    battle = BattleResponseFactory.create().battle
+    context = battle.battle_context
+    driver = LoadDriver('http://localhost', question=None)
+    driver.battle_pks = [battle.pk]
+    driver.cleanup()
+    assert not Battle.objects.filter(pk=battle.pk).exists()
+    assert not ResponseContext.objects.filter(pk=context.pk).exists()
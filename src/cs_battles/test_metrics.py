@@ -0,0 +1,66 @@
+from codeschool.tests import *
+from cs_battles import metrics
+
+
+def test_counter_render():
+    counter = metrics.Counter('test_total', 'Test counter.', ['outcome'])
+    counter.inc(outcome='AC')
+    counter.inc(2, outcome='WA')
+    assert counter.render() == [
+        '# HELP test_total Test counter.',
+        '# TYPE test_total counter',
+        'test_total{outcome="AC"} 1',
+        'test_total{outcome="WA"} 2',
+    ]
+
+def test_histogram_render():
+    histogram = metrics.Histogram('test_seconds', 'Test.', ['phase'],
+                                  buckets=(0.1, 1))
+    histogram.observe(0.05, phase='update')
+    histogram.observe(0.5, phase='update')
+    histogram.observe(5, phase='update')
+    lines = histogram.render()
+    assert 'test_seconds_bucket{phase="update",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{phase="update",le="1"} 2' in lines
+    assert 'test_seconds_bucket{phase="update",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{phase="update"} 3' in lines
+
+@pytest.mark.django_db
+def test_track_view_counts_queries():
+    from django.contrib.auth.models import User
+    with metrics.track_view('test'):
+        list(User.objects.all())
+        list(User.objects.all())
+    counts, total = metrics.VIEW_QUERIES.values[('test',)]
+    assert total >= 2
+
+def test_registry_merges_drained_values():
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test.', ['outcome'])
+    histogram = registry.histogram('test_seconds', 'Test.', buckets=(1,))
+    counter.inc(outcome='AC')
+    histogram.observe(0.5)
+    snapshot = registry.drain()
+    assert counter.values == {} and histogram.values == {}
+    counter.inc(outcome='AC')
+    registry.merge(snapshot)
+    assert counter.values == {('AC',): 2}
+    assert histogram.values == {(): ([1, 0], 0.5)}
+
+@pytest.mark.django_db
+def test_metrics_endpoint(client, admin_client, settings):
+    with metrics.track_view('invitations'):
+        pass
+    response = admin_client.get('/battles/metrics')
+    assert response.status_code == 200
+    content = response.content.decode('utf8')
+    assert 'cs_battles_view_seconds_bucket{view="invitations"' in content
+    response = client.get('/battles/metrics')
+    assert response.status_code == 403
+    settings.BATTLE_METRICS_TOKEN = 'secret'
+    response = client.get('/battles/metrics',
+                          HTTP_AUTHORIZATION='Bearer wrong')
+    assert response.status_code == 403
+    response = client.get('/battles/metrics',
+                          HTTP_AUTHORIZATION='Bearer secret')
+    assert response.status_code == 200
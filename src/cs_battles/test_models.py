@@ -2,8 +2,10 @@ from codeschool.tests import *
 from codeschool.models import User
 from codeschool.factories import UserFactory
 from cs_battles.factories import *
-from cs_battles.models import Battle, BattleResponse
+from cs_battles.models import Battle, BattleResponse, BattleStats
 from cs_core.models import ProgrammingLanguage
+from datetime import timedelta
+from django.db.models import F
 from django.utils import timezone
 from cs_questions.models import CodingIoQuestion
 from codeschool.factories import UserFactory
@@ -37,6 +39,8 @@ def battle_deactived():
     battle.battles.add(battle.battle_winner)
     battle.limit_submitions = -1
     battle.save()
+    # A regular save leaves the winner to determine_winner()
+    battle.save(update_fields=['battle_winner'])
     return battle
 @pytest.fixture
 def battle_response_fix(battle):
@@ -56,9 +60,9 @@ def battle_without_winner():
     ri = register_item(battle_response2,source_code("a=1+1;"))
     battle_response2.update(ri)
 
-    battle.limit_submitions=0
-    battle.save()
-    return battle
+    # A queryset update, so saving the new limit does not settle the winner
+    Battle.objects.filter(pk=battle.pk).update(limit_submitions=0)
+    return Battle.objects.get(pk=battle.pk)
 
 @pytest.fixture
 def register_item(battle_response,source):
@@ -86,6 +90,24 @@ def test_active_battle():
     b = battle_with_invitations()
     assert b.is_active is True
 
+@pytest.mark.django_db
+def test_battle_queryset_activity():
+    active = battle_with_invitations()
+    finished = battle_deactived()
+    assert list(Battle.objects.active()) == [active]
+    assert list(Battle.objects.finished()) == [finished]
+    assert Battle.objects.with_activity().get(pk=active.pk).is_active
+
+@pytest.mark.django_db
+def test_battle_response_queryset_activity():
+    battle = battle_without_winner()
+    assert battle.battles.active().count() == 0
+    assert battle.battles.finished().count() == 2
+    battle.limit_submitions = 10
+    battle.save()
+    responses = battle.battles.with_activity()
+    assert all(br.submitions_used == 1 for br in responses)
+
 @pytest.mark.django_db
 def test_to_string_battle():
     b = battle_fixture()
@@ -156,3 +178,160 @@ def test_battle_response_cant_submit_code():
         assert False
     except:
         assert True
+
+@pytest.mark.django_db
+def test_submitions_counter_respects_limit():
+    battle_response = BattleResponseFactory.create()
+    battle_response.battle.limit_submitions = 1
+    battle_response.battle.save()
+    assert battle_response.reserve_submition()
+    assert not battle_response.reserve_submition()
+    battle_response.refresh_from_db()
+    assert battle_response.submitions_used == 1
+
+@pytest.mark.django_db
+def test_battle_participant_counters():
+    battle_response = BattleResponseFactory.create()
+    battle = Battle.objects.get(pk=battle_response.battle_id)
+    assert (battle.active_count, battle.finished_count) == (1, 0)
+    battle_response.give_up_battle()
+    battle_response.give_up_battle()
+    battle = Battle.objects.get(pk=battle_response.battle_id)
+    assert (battle.active_count, battle.finished_count) == (0, 1)
+
+@pytest.mark.django_db
+def test_rebuild_battle_counters():
+    from django.core.management import call_command
+    battle_response = BattleResponseFactory.create()
+    register_item(battle_response,source_code())
+    BattleResponse.objects.update(submitions_used=0)
+    Battle.objects.update(active_count=0)
+    call_command('rebuild_battle_counters')
+    battle_response.refresh_from_db()
+    assert battle_response.submitions_used == 1
+    assert Battle.objects.get(pk=battle_response.battle_id).active_count == 1
+
+@pytest.mark.django_db
+def test_counters_follow_limit_changes():
+    battle = battle_fixture()
+    battle_response = battle_response_fix(battle)
+    battle_response.register_code(source_code())
+    battle = Battle.objects.get(pk=battle.pk)
+    battle.limit_submitions = 1
+    battle.save()
+    battle_response.refresh_from_db()
+    assert battle_response.finished
+    battle = Battle.objects.get(pk=battle.pk)
+    assert (battle.active_count, battle.finished_count) == (0, 1)
+    assert battle.battle_winner_id == battle_response.pk
+
+@pytest.mark.django_db
+def test_winner_settled_when_last_participant_finishes():
+    battle = battle_fixture()
+    first = battle_response_fix(battle)
+    second = battle_response_fix(battle)
+    first.give_up_battle()
+    assert Battle.objects.get(pk=battle.pk).battle_winner is None
+    second.give_up_battle()
+    assert Battle.objects.get(pk=battle.pk).battle_winner is not None
+
+@pytest.mark.django_db
+def test_winner_length_prefers_correct_solution():
+    battle = battle_without_winner()
+    longer = battle.battles.last()
+    longer.last_item.given_grade = 100
+    longer.last_item.save()
+    assert battle.winner_length() == longer
+
+@pytest.mark.django_db
+def test_winner_time_ignores_grades():
+    battle = battle_without_winner()
+    fastest, slowest = battle.battles.order_by('pk')
+    BattleResponse.objects.filter(pk=fastest.pk).update(
+        time_end=F('time_begin') + timedelta(seconds=5))
+    BattleResponse.objects.filter(pk=slowest.pk).update(
+        time_end=F('time_begin') + timedelta(seconds=50))
+    slowest.last_item.given_grade = 100
+    slowest.last_item.save()
+    assert battle.winner_time() == fastest
+
+@pytest.mark.django_db
+def test_winner_strategies_use_one_query():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    battle = battle_without_winner()
+    for challenge_type in ('length', 'time'):
+        with CaptureQueriesContext(connection) as queries:
+            winner = battle.battles.ranked(challenge_type).first()
+        assert winner is not None
+        assert len(queries) == 1
+
+@pytest.mark.django_db
+def test_mass_battle_submitions_do_not_write_the_battle():
+    battle = battle_fixture()
+    battle.mass = True
+    battle.save()
+    battle_response = battle_response_fix(battle)
+    version = Battle.objects.get(pk=battle.pk).version
+    register_item(battle_response,source_code())
+    assert Battle.objects.get(pk=battle.pk).version == version
+    battle_response.give_up_battle()
+    assert Battle.objects.get(pk=battle.pk).version > version
+
+# TESTs to BattleStats ---------------------------------------------------------
+@pytest.mark.django_db(transaction=True)
+def test_stats_recorded_when_winner_settled():
+    battle = battle_without_winner()
+    winner = battle.determine_winner()
+    stats = BattleStats.objects.get(user=winner.response.user)
+    assert (stats.battles, stats.wins, stats.losses) == (1, 1, 0)
+    assert stats.rank_score == BattleStats.score(1, 0)
+    assert stats.rank == 1
+    assert BattleStats.objects.count() == 2
+    assert list(BattleStats.objects.top(1)) == [stats]
+
+@pytest.mark.django_db
+def test_rebuild_battle_stats():
+    from django.core.management import call_command
+    battle = battle_without_winner()
+    battle.determine_winner()
+    BattleStats.objects.update(wins=0, battles=0, rank_score=0)
+    call_command('rebuild_battle_stats', chunk_size=1)
+    assert sorted(BattleStats.objects.values_list('wins', flat=True)) == [0, 1]
+    assert sorted(BattleStats.objects.values_list('rank_score', flat=True)) \
+        == [BattleStats.score(1, 0), BattleStats.score(0, 1)]
+
+# TESTs to bulk invitations ----------------------------------------------------
+@pytest.mark.django_db
+def test_invite_users_in_bulk():
+    battle = battle_fixture()
+    users = [UserFactory.create() for i in range(5)]
+    assert battle.invite_users(users) == 5
+    assert battle.invite_users(users[:2] + [UserFactory.create()]) == 1
+    assert battle.invitations_user.count() == 6
+
+@pytest.mark.django_db
+def test_enroll_users_in_bulk():
+    battle = battle_fixture()
+    users = [UserFactory.create() for i in range(4)]
+    battle.invite_users(users)
+    assert len(battle.enroll_users(users)) == 4
+    assert len(battle.enroll_users(users)) == 0
+    battle = Battle.objects.get(pk=battle.pk)
+    assert battle.battles.count() == 4
+    assert battle.active_count == 4
+    assert battle.invitations_user.count() == 0
+
+@pytest.mark.django_db
+def test_enroll_users_queries_do_not_grow():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    counts = []
+    for size in (5, 20):
+        battle = battle_fixture()
+        users = [UserFactory.create() for i in range(size)]
+        with CaptureQueriesContext(connection) as queries:
+            battle.enroll_users(users)
+        assert battle.battles.count() == size
+        counts.append(len(queries))
+    assert counts[0] == counts[1]
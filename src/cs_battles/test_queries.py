@@ -0,0 +1,147 @@
+from codeschool.tests import *
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from cs_battles import queries
+from cs_battles.factories import UserFactory
+from cs_battles.models import Battle, BattleResponse, BattleStats
+from cs_core.models import ResponseContext
+from django.utils import timezone
+from cs_battles.test_models import (battle_fixture, battle_response_fix,
+                                    register_item, source_code)
+from cs_battles.test_views import client_logged
+
+
+def battle_with_participants(size):
+    battle = battle_fixture()
+    for i in range(size):
+        battle_response = battle_response_fix(battle)
+        register_item(battle_response,source_code())
+    battle.invitations_user.add(UserFactory.create())
+    return battle
+
+
+def count_queries(function):
+    with CaptureQueriesContext(connection) as captured:
+        function()
+    return len(captured)
+
+
+@pytest.mark.django_db
+def test_battle_detail_prefetch():
+    battle = battle_with_participants(3)
+    detail = queries.battle_detail().get(pk=battle.pk)
+    assert len(detail.participants) == 3
+    assert len(detail.pending_users) == 1
+    touch = lambda: [(br.response.user, br.last_item, br.activity)
+                     for br in detail.participants]
+    assert count_queries(touch) == 0
+
+
+@pytest.mark.django_db
+def test_detail_page_queries_do_not_grow(client):
+    client,user = client_logged(client)
+    small = battle_with_participants(2)
+    large = battle_with_participants(6)
+    small_count = count_queries(lambda: client.get('/battles/%d/' % small.pk))
+    large_count = count_queries(lambda: client.get('/battles/%d/' % large.pk))
+    assert small_count == large_count
+
+
+@pytest.mark.django_db
+def test_mass_battle_activity_uses_counters():
+    battle = battle_with_participants(3)
+    battle.invitations_user.clear()
+    battle.mass = True
+    battle.save()
+    Battle.objects.filter(pk=battle.pk).update(active_count=0)
+    assert Battle.objects.finished().filter(pk=battle.pk).exists()
+
+
+@pytest.mark.django_db
+def test_standings_do_not_load_sources():
+    battle = battle_with_participants(5)
+    rows = list(queries.standings(battle))
+    assert len(rows) == 5
+    assert all('source' not in key for row in rows for key in row)
+    assert len(list(queries.iter_standings(battle, chunk_size=2))) == 5
+    assert len(queries.top_participants(battle, 2)) == 2
+
+
+@pytest.mark.django_db
+def test_mass_battle_detail_is_paginated(client, settings):
+    settings.BATTLE_MASS_PAGE_SIZE = 2
+    client,user = client_logged(client)
+    battle = battle_with_participants(5)
+    battle.mass = True
+    battle.save()
+    response = client.get('/battles/%d/?page=2' % battle.pk)
+    assert response.context['standings'].number == 2
+    assert len(response.context['standings'].object_list) == 2
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        # Test tables are tiny, the planner must be told to avoid seq scans
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def index_name(model, columns):
+    """Name of the index of model on exactly these columns."""
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(
+            cursor, model._meta.db_table)
+    for name, info in constraints.items():
+        if info['index'] and set(info['columns']) == set(columns):
+            return name
+
+
+@pytest.mark.django_db
+@pytest.mark.skipif(connection.vendor != 'postgresql',
+                    reason='EXPLAIN plans are checked on PostgreSQL only')
+def test_hot_lookups_use_indexes():
+    battle = battle_with_participants(3)
+    user_id = battle.battles.first().response.user_id
+    invited = battle.invitations_user.first()
+    lookups = [
+        (battle.battles.filter(response__user_id=user_id),
+         BattleResponse._meta.db_table),
+        (BattleResponse.objects.filter(response__user_id=user_id),
+         BattleResponse._meta.db_table),
+        (Battle.objects.filter(invitations_user=invited.id),
+         Battle.invitations_user.through._meta.db_table),
+    ]
+    for queryset, table in lookups:
+        assert 'Seq Scan on %s' % table not in explain(queryset)
+    # The battle_N context is found through an index of cs_core, see
+    # migration 0015
+    context = ResponseContext.objects.filter(activity=battle.question,
+                                             name='battle_%d' % battle.pk)
+    assert 'Seq Scan on %s' % ResponseContext._meta.db_table \
+        not in explain(context)
+    indexed = [
+        (battle.battles.filter(finished=False),
+         'cs_battles_battleresponse_playing'),
+        (Battle.objects.filter(battle_winner__isnull=True),
+         'cs_battles_battle_unfinished'),
+        (Battle.objects.filter(archived=False,
+                               finished_at__lte=timezone.now()),
+         index_name(Battle, ['archived', 'finished_at'])),
+    ]
+    for queryset, name in indexed:
+        assert name is not None
+        assert name in explain(queryset)
+
+
+@pytest.mark.django_db
+@pytest.mark.skipif(connection.vendor != 'postgresql',
+                    reason='EXPLAIN plans are checked on PostgreSQL only')
+def test_ranking_reads_the_index_in_order():
+    for wins in range(3):
+        BattleStats.objects.create(user=UserFactory.create(), wins=wins,
+                                   rank_score=BattleStats.score(wins, 0))
+    plan = explain(BattleStats.objects.ranking()[:10])
+    assert index_name(BattleStats, ['rank_score', 'user_id']) in plan
+    assert 'Sort' not in plan
@@ -0,0 +1,65 @@
+from codeschool.tests import *
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from cs_battles import results
+from cs_battles.models import Battle
+from cs_battles.test_models import battle_without_winner
+
+
+def finished_battle():
+    battle = battle_without_winner()
+    battle.determine_winner()
+    return results.queries.battle_summary().get(pk=battle.pk)
+
+
+@pytest.mark.django_db
+def test_results_cached_for_finished_battle():
+    battle = finished_battle()
+    entry = results.get_results(battle)
+    assert entry['payload']['winner'] == battle.battle_winner_id
+    assert len(entry['payload']['participants']) == 2
+    assert 'Resultado da Batalha' in entry['html']
+
+    battle = results.queries.battle_summary().get(pk=battle.pk)
+    with CaptureQueriesContext(connection) as queries:
+        assert results.get_results(battle) == entry
+    assert len(queries) == 0
+
+@pytest.mark.django_db
+def test_results_invalidated_by_battle_response_change():
+    battle = finished_battle()
+    key = results.cache_key(battle)
+    results.get_results(battle)
+    battle.battle_winner.give_up_battle()
+    battle = Battle.objects.get(pk=battle.pk)
+    assert results.cache_key(battle) != key
+
+@pytest.mark.django_db
+def test_results_none_for_active_battle():
+    battle = battle_without_winner()
+    assert results.get_results(battle) is None
+
+@pytest.mark.django_db
+def test_battle_save_bumps_version_in_one_update():
+    battle = battle_without_winner()
+    version = Battle.objects.get(pk=battle.pk).version
+    battle.mass = True
+    with CaptureQueriesContext(connection) as queries:
+        battle.save()
+    updates = [query for query in queries
+               if query['sql'].startswith('UPDATE')]
+    assert len(updates) == 1
+    assert battle.version == version + 1
+    assert Battle.objects.get(pk=battle.pk).version == version + 1
+
+@pytest.mark.django_db
+def test_battle_save_keeps_settled_winner():
+    battle = battle_without_winner()
+    stale = Battle.objects.get(pk=battle.pk)
+    winner = battle.determine_winner()
+    stale.mass = True
+    stale.save()
+    battle = Battle.objects.get(pk=battle.pk)
+    assert battle.battle_winner == winner
+    assert battle.finished_at is not None
+    assert battle.mass
@@ -0,0 +1,58 @@
+from codeschool.tests import *
+from cs_battles import runtime
+from cs_battles.models import BattleResponse, BattleStats
+from cs_battles.test_models import battle_without_winner
+
+
+def test_summarize():
+    summary = runtime.summarize([0.4, 0.1, 0.3, 0.2, 0.5])
+    assert summary['median'] == 0.3
+    assert abs(summary['iqr'] - 0.2) < 1e-9
+    assert summary['repetitions'] == 5
+
+def test_benchmark_runs_every_input():
+    summary = runtime.benchmark('x = input()\nprint(x * 2)\n',
+                                [['a'], ['b']], warmup=1, repetitions=3)
+    assert summary['repetitions'] == 3
+    assert summary['median'] >= 0
+
+def test_benchmark_errors():
+    with pytest.raises(runtime.BenchmarkError):
+        runtime.benchmark('1/0', [[]], warmup=0, repetitions=1)
+    with pytest.raises(runtime.BenchmarkError):
+        runtime.benchmark('while True: pass', [[]], warmup=0, repetitions=1,
+                          timeout=1)
+
+def test_benchmark_ignores_what_the_source_writes():
+    source = ('sum(range(2 * 10 ** 7))\n'
+              'import os\n'
+              'os.write(1, b\'{"timings": [0.0, 0.0]}\')\n'
+              'os._exit(0)\n')
+    summary = runtime.benchmark(source, [[]], warmup=0, repetitions=2)
+    assert summary['min'] > 0.1
+
+@pytest.mark.django_db
+def test_winner_runtime():
+    battle = battle_without_winner()
+    for battle_response in battle.battles.all():
+        battle_response.last_item.given_grade = 100
+        battle_response.last_item.save()
+    first, second = battle.battles.order_by('pk')
+    BattleResponse.objects.filter(pk=first.pk).update(runtime_median=0.5)
+    BattleResponse.objects.filter(pk=second.pk).update(runtime_median=0.1)
+    assert battle.winner_runtime() == second
+    BattleResponse.objects.filter(pk=second.pk).update(runtime_median=None)
+    assert battle.winner_runtime() == first
+
+@pytest.mark.django_db
+def test_stats_record_runtime():
+    battle = battle_without_winner()
+    for battle_response in battle.battles.all():
+        battle_response.last_item.given_grade = 100
+        battle_response.last_item.save()
+    battle.battles.update(runtime_median=0.25)
+    BattleStats.objects.record_battle(battle)
+    for battle_response in battle.battles.all():
+        stats = BattleStats.objects.get(user=battle_response.response.user)
+        assert stats.runtime_count == 1
+        assert stats.average_runtime == 0.25
@@ -0,0 +1,87 @@
+from codeschool.tests import *
+from cs_battles import sandbox
+from cs_battles.models import SandboxReport
+from cs_battles.test_views import client_logged, battle_response_iospec
+import json
+
+linux_only = pytest.mark.skipif(sandbox.resource is None,
+                                reason='rlimits are not available')
+
+
+def limits():
+    return sandbox.Limits(cpu_time=1, wall_time=2, memory=256 * 2 ** 20,
+                          output=2 ** 16)
+
+def check(source, inputs=None):
+    return sandbox.check_source(source, inputs or [[]], limits())
+
+def test_ok_records_resources():
+    result = check('x = input()\nprint(x)\n', [['a'], ['b']])
+    assert result.status == sandbox.OK
+    assert not result.violation
+    assert result.cpu_time >= 0
+    assert result.peak_memory > 0
+
+def test_reads_stdin():
+    result = check('import sys\nprint(sys.stdin.read().split())\n',
+                   [['a', 'b']])
+    assert result.status == sandbox.OK
+
+@linux_only
+def test_can_not_forge_its_result():
+    forged = ('import os\n'
+              'os.write(1, b\'{"timings": [0.0], "cases": []}\')\n'
+              'os._exit(0)\n')
+    assert check('while True: pass\n' + forged).status == sandbox.TIME_LIMIT
+    assert check('1/0\n' + forged).status == sandbox.RUNTIME_ERROR
+    result = check('sum(range(2 * 10 ** 7))\n' + forged)
+    assert result.status == sandbox.OK
+    assert result.cpu_time > 0.1
+
+def test_runtime_error_is_not_a_violation():
+    result = check('1/0')
+    assert result.status == sandbox.RUNTIME_ERROR
+    assert not result.violation
+
+@linux_only
+def test_infinite_loop():
+    assert check('while True: pass').status == sandbox.TIME_LIMIT
+
+def test_sleep_hits_wall_time():
+    assert check('import time\ntime.sleep(10)').status == sandbox.TIME_LIMIT
+
+@linux_only
+def test_memory_bomb():
+    result = check('x = bytearray(2 ** 30)')
+    assert result.status == sandbox.MEMORY_LIMIT
+    assert result.violation
+
+def test_output_flood():
+    assert check('while True: print("x" * 1000)').status == \
+        sandbox.OUTPUT_LIMIT
+
+@linux_only
+@pytest.mark.django_db
+def test_violation_gets_status_code(client, settings):
+    settings.BATTLE_SANDBOX_WALL_TIME = 2
+    client,user = client_logged(client)
+    battle_response = battle_response_iospec(user)
+    response = client.post('/battles/battle/%d'%battle_response.battle.pk,
+                           {'code':"while True: pass"})
+    content = json.loads(response.content.decode('unicode_escape'))
+    assert content['status_code'] == 6
+    report = SandboxReport.objects.get(item_id=content['ticket'])
+    assert report.status == sandbox.TIME_LIMIT
+    assert report.item.given_grade == 0
+
+@pytest.mark.django_db
+def test_within_limits_is_autograded(client):
+    client,user = client_logged(client)
+    battle_response = battle_response_iospec(user)
+    response = client.post('/battles/battle/%d'%battle_response.battle.pk,
+                           {'code':"import sys\nsys.stdin.read()\nprint('Oi')"})
+    content = json.loads(response.content.decode('unicode_escape'))
+    assert content['status_code'] == 0
+    report = SandboxReport.objects.get(item_id=content['ticket'])
+    assert report.status == sandbox.OK
+    assert report.item.given_grade == 100
@@ -0,0 +1,50 @@
+from codeschool.tests import *
+from cs_battles import sources
+from cs_battles.factories import BattleResponseFactory
+from cs_battles.models import ItemSource, SourceBlob
+from cs_questions.models import CodingIoResponseItem
+from cs_battles.test_models import battle_without_winner, source_code
+
+
+def test_compress_roundtrip():
+    source = "print('Oi')\n" * 20
+    data = sources.compress(source, sources.ZLIB)
+    assert len(data) < len(source)
+    assert sources.decompress(data, sources.ZLIB) == source
+
+@pytest.mark.skipif(sources.zstandard is None,
+                    reason='zstandard is not installed')
+def test_zstd_roundtrip():
+    source = "print('Oi')\n" * 20
+    data = sources.compress(source, sources.ZSTD)
+    assert sources.decompress(data, sources.ZSTD) == source
+
+@pytest.mark.django_db
+def test_repeated_submitions_are_stored_once():
+    battle_response = BattleResponseFactory.create()
+    battle_response.submit_code(source_code())
+    battle_response.submit_code(source_code())
+    blob = SourceBlob.objects.get()
+    assert blob.digest == sources.digest(source_code())
+    assert blob.length == len(source_code())
+    assert blob.text == source_code()
+    assert battle_response.source_blob_id == blob.digest
+    assert battle_response.source == source_code()
+    # The items only point to the blob
+    items = CodingIoResponseItem.objects.filter(
+        response_id=battle_response.response_id)
+    assert [item.source for item in items] == ['', '']
+    assert ItemSource.objects.filter(blob=blob).count() == 2
+    assert all(ItemSource.objects.text(item) == source_code()
+               for item in items)
+
+@pytest.mark.django_db
+def test_rank_length_reads_stored_length():
+    battle = battle_without_winner()
+    for battle_response in battle.battles.all():
+        battle_response.last_item.given_grade = 100
+        battle_response.last_item.save()
+    battle.battles.update(source_bytes=7)
+    lengths = battle.battles.rank_length().values_list('source_length',
+                                                       flat=True)
+    assert list(lengths) == [7, 7]
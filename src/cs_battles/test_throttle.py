@@ -0,0 +1,78 @@
+from codeschool.tests import *
+from cs_battles import throttle
+from cs_battles.throttle import Throttle
+from django.core.cache.backends.locmem import LocMemCache
+import uuid
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_throttle(clock=None, pending=None, **kwargs):
+    clock = clock or Clock()
+    pending = set() if pending is None else pending
+    kwargs.setdefault('cache', LocMemCache(uuid.uuid4().hex, {}))
+    kwargs.setdefault('rate', 1)
+    kwargs.setdefault('burst', 2)
+    kwargs.setdefault('timeout', 60)
+    return Throttle(is_pending=pending.__contains__, clock=clock, **kwargs), \
+           clock, pending
+
+
+def test_token_bucket():
+    limiter, clock, pending = make_throttle()
+    for i in range(2):
+        assert limiter.admit(1, 1, 'a').outcome == throttle.ADMITTED
+        limiter.release(1, 1)
+    assert limiter.admit(1, 1, 'a').outcome == throttle.RATE_LIMITED
+    assert limiter.admit(2, 1, 'a').outcome == throttle.ADMITTED
+    clock.now += 2
+    assert limiter.admit(1, 1, 'a').outcome == throttle.ADMITTED
+    assert limiter.stats()['rate_limited'] == 1
+
+def test_token_bucket_has_no_window_boundary():
+    limiter, clock, pending = make_throttle()
+    clock.now = 1.9
+    for i in range(2):
+        assert limiter.admit(1, 1, 'a').outcome == throttle.ADMITTED
+        limiter.release(1, 1)
+    # A fixed window of burst / rate seconds would start again here
+    clock.now = 2.0
+    assert limiter.admit(1, 1, 'a').outcome == throttle.RATE_LIMITED
+    clock.now = 3.0
+    assert limiter.admit(1, 1, 'a').outcome == throttle.ADMITTED
+    limiter.release(1, 1)
+    assert limiter.admit(1, 1, 'a').outcome == throttle.RATE_LIMITED
+
+def test_in_flight_rejected_and_merged():
+    limiter, clock, pending = make_throttle()
+    assert limiter.admit(1, 1, 'print(1)').outcome == throttle.ADMITTED
+    assert limiter.admit(1, 1, 'print(1)').outcome == throttle.IN_FLIGHT
+    limiter.started(1, 1, 42)
+    pending.add(42)
+    assert limiter.admit(1, 1, 'print(1)\n') == (throttle.MERGED, 42)
+    assert limiter.admit(1, 1, 'print(2)') == (throttle.IN_FLIGHT, 42)
+    pending.discard(42)
+    assert limiter.admit(1, 1, 'print(2)').outcome == throttle.ADMITTED
+
+def test_in_flight_expires():
+    limiter, clock, pending = make_throttle(timeout=10)
+    limiter.admit(1, 1, 'a')
+    clock.now += 11
+    assert limiter.admit(1, 1, 'b').outcome == throttle.ADMITTED
+
+def test_throttles_share_the_cache():
+    limiter, clock, pending = make_throttle()
+    other, _, _ = make_throttle(clock=clock, pending=pending,
+                                cache=limiter.cache)
+    assert limiter.admit(1, 1, 'a').outcome == throttle.ADMITTED
+    assert other.admit(1, 1, 'b').outcome == throttle.IN_FLIGHT
+    other.release(1, 1)
+    assert limiter.admit(1, 1, 'a').outcome == throttle.ADMITTED
+    limiter.release(1, 1)
+    assert other.admit(1, 1, 'a').outcome == throttle.RATE_LIMITED
@@ -1,8 +1,10 @@
 from codeschool.tests import *
 from cs_battles.factories import BattleResponseFactory
 from cs_battles.models import *
+from cs_battles import throttle
 from cs_battles.test_models import battle_fixture,battle_without_winner
 from cs_questions.factories import CodingIoQuestionFactory
+from django.core.cache import cache
 import json
 
 @pytest.fixture
@@ -12,6 +14,9 @@ def many_battles():
 
 @pytest.fixture
 def client_logged(client):
+    # Every test starts with empty submition buckets
+    throttle._throttle = None
+    cache.clear()
     user = user_with_password("1234")
     client.login(username=user.username,password='1234')
     return client,user
@@ -162,6 +167,8 @@ def test_redirect_reject_challange(client):
 @pytest.mark.django_db
 def test_detail_battle(client):
     battle = battle_without_winner()
+    # The winner is settled on the write path, the detail view only reads it
+    battle.determine_winner()
     client,user = client_logged(client)
     response = client.get('/battles/%d/'%battle.pk)
 
@@ -171,6 +178,14 @@ def test_detail_battle(client):
     assert len(response.context['all_battles']) == 2
     assert response.context['battle'].battle_winner is not None
 
+@pytest.mark.django_db
+def test_detail_does_not_settle_winner(client):
+    battle = battle_without_winner()
+    client,user = client_logged(client)
+    response = client.get('/battles/%d/'%battle.pk)
+    assert 200 <= response.status_code < 300
+    assert Battle.objects.get(pk=battle.pk).battle_winner is None
+
 @pytest.mark.django_db
 def test_battle_creation(client):
     client,user = client_logged(client)
@@ -204,3 +219,95 @@ class _TestURLS(URLBaseTester):
     url(r'^accept$',views.battle_invitation,name="accept_battle"),
     url(r'^invitations$',views.invitations, name="view_invitation"),
 """
+
+@pytest.mark.django_db
+def test_battle_list_data(client):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    many_battles()
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get('/battles/list/data',
+                              {'draw': 1, 'start': 0, 'length': 4})
+    content = json.loads(response.content.decode('utf8'))
+    assert content['recordsTotal'] == 10
+    assert len(content['data']) == 4
+    assert len(queries) == 2
+
+    response = client.get('/battles/list/data',
+                          {'draw': 2, 'start': 4, 'length': 4,
+                           'order[0][column]': 1, 'order[0][dir]': 'asc',
+                           'after': content['last_key']})
+    page = json.loads(response.content.decode('utf8'))
+    assert page['data'][0]['1'] == content['last_key'] + 1
+
+@pytest.mark.django_db
+def test_battle_user_data(client):
+    client,user = client_logged(client)
+    battle_response_iospec(user)
+    battle_response_iospec(user)
+    response = client.get('/battles/user/data', {'draw': 1})
+    content = json.loads(response.content.decode('utf8'))
+    assert content['recordsTotal'] == 2
+    assert content['draw'] == 1
+
+@pytest.mark.django_db
+def test_bulk_invite_only_for_owner(client):
+    client,user = client_logged(client)
+    battle = battle_fixture()
+    invited = user_with_password("1234")
+    response = client.post('/battles/invite/%d' % battle.pk,
+                           {'users': [invited.username]})
+    assert response.status_code == 403
+
+    battle.battle_owner = user
+    battle.save()
+    response = client.post('/battles/invite/%d' % battle.pk,
+                           {'users': [invited.username]})
+    content = json.loads(response.content.decode('utf8'))
+    assert content['invited'] == 1
+    response = client.post('/battles/invite/%d' % battle.pk,
+                           {'users': [str(invited.pk)], 'enroll': True})
+    content = json.loads(response.content.decode('utf8'))
+    assert content['enrolled'] == 1
+
+@pytest.mark.django_db
+def test_api_status_conditional_get(client):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    battle = battle_without_winner()
+    url = '/battles/api/%d/status' % battle.pk
+    response = client.get(url)
+    content = json.loads(response.content.decode('utf8'))
+    assert content['battle'] == battle.pk
+    etag = response['ETag']
+    assert response['Last-Modified']
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert len(queries) == 1
+
+    battle.battles.first().give_up_battle()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+@pytest.mark.django_db
+def test_api_standings(client):
+    battle = battle_without_winner()
+    response = client.get('/battles/api/%d/standings' % battle.pk)
+    content = json.loads(response.content.decode('utf8'))
+    assert content['count'] == 2
+    assert [row['position'] for row in content['standings']] == [1, 2]
+
+@pytest.mark.django_db
+def test_api_user_battles(client):
+    client,user = client_logged(client)
+    battle = battle_fixture()
+    battle.enroll_users([user])
+    response = client.get('/battles/api/user')
+    content = json.loads(response.content.decode('utf8'))
+    assert [row['battle'] for row in content['battles']] == [battle.pk]
+    response = client.get('/battles/api/user',
+                          HTTP_IF_NONE_MATCH=response['ETag'])
+    assert response.status_code == 304
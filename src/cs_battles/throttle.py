@@ -0,0 +1,198 @@
+"""
+Admission control for battle submitions.
+
+Before a submition is registered, the throttle checks for each (user, battle)
+pair:
+
+* a token bucket of ``BATTLE_SUBMIT_BURST`` tokens refilled with
+  ``BATTLE_SUBMIT_RATE`` tokens per second, every submition takes a token;
+* whether another submition of the user is still being graded. If it has the
+  same source code the client gets the ticket of that submition (merged),
+  otherwise the new one is rejected.
+
+Both live in the Django cache ``BATTLE_SUBMIT_CACHE`` (default "default"), so
+every worker process shares them as long as that cache is shared. A bucket
+stores its tokens and the time of its last refill under one key, which is
+read and written while holding a lock key taken with the atomic add(). Keys
+expire once the bucket would be full again or the in-flight timeout is over.
+
+Every decision is counted by the process, so stats() tells how much load
+reaches the graders.
+"""
+import threading
+import time
+from collections import Counter, namedtuple
+
+from django.conf import settings
+
+from cs_battles.cache import source_hash
+
+ADMITTED = 'admitted'
+MERGED = 'merged'
+IN_FLIGHT = 'in_flight'
+RATE_LIMITED = 'rate_limited'
+
+Decision = namedtuple('Decision', ['outcome', 'ticket'])
+
+# A bucket is locked for a few milliseconds, a submition that can not get the
+# lock after these attempts is rate limited
+LOCK_ATTEMPTS = 20
+LOCK_WAIT = 0.005
+
+_throttle = None
+
+
+def get_throttle():
+    """
+    Return the throttle of the process, or one that admits everything when
+    ``BATTLE_SUBMIT_THROTTLE`` is false (e.g. in load tests).
+    """
+    global _throttle
+    if not getattr(settings, 'BATTLE_SUBMIT_THROTTLE', True):
+        return UNTHROTTLED
+    if _throttle is None:
+        from django.core.cache import caches
+
+        _throttle = Throttle(
+            rate=getattr(settings, 'BATTLE_SUBMIT_RATE', 0.2),
+            burst=getattr(settings, 'BATTLE_SUBMIT_BURST', 3),
+            timeout=getattr(settings, 'BATTLE_SUBMIT_IN_FLIGHT_TIMEOUT', 120),
+            cache=caches[getattr(settings, 'BATTLE_SUBMIT_CACHE', 'default')],
+        )
+    return _throttle
+
+
+def ticket_pending(ticket):
+    """Default check used to release queued submitions already graded."""
+    from cs_core.models import ResponseItem
+
+    return ResponseItem.objects.filter(pk=ticket, given_grade__isnull=True) \
+                               .exists()
+
+
+class Throttle:
+    """
+    Admission control backed by a Django cache. ``is_pending(ticket)`` tells
+    whether a queued submition is still waiting for its grade; in-flight
+    entries older than ``timeout`` seconds are dropped.
+
+    ``clock`` must agree between processes, so it defaults to the wall clock.
+    """
+
+    def __init__(self, rate=0.2, burst=3, timeout=120, cache=None,
+                 is_pending=ticket_pending, clock=time.time):
+        if cache is None:
+            from django.core.cache import cache
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.cache = cache
+        self.is_pending = is_pending
+        self.clock = clock
+        # Time an empty bucket takes to be full again
+        self.refill_time = burst / rate
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def admit(self, user_id, battle_id, source):
+        """Decide whether a submition can be registered."""
+        key = self._flight_key(user_id, battle_id)
+        digest = source_hash(source or '')
+        flight = self._current_flight(key)
+        if flight is None:
+            if not self._take_token(user_id, battle_id):
+                return self._decide(RATE_LIMITED, None)
+            # add() is atomic, so only one of two racing submitions wins
+            if self.cache.add(key, (digest, None, self.clock()),
+                              self._expiry()):
+                return self._decide(ADMITTED, None)
+            flight = self.cache.get(key)
+            if flight is None:
+                return self._decide(IN_FLIGHT, None)
+        flight_digest, ticket, started = flight
+        if flight_digest == digest and ticket is not None:
+            return self._decide(MERGED, ticket)
+        return self._decide(IN_FLIGHT, ticket)
+
+    def started(self, user_id, battle_id, ticket):
+        """Attach the ticket of an admitted submition waiting for a grader."""
+        key = self._flight_key(user_id, battle_id)
+        flight = self.cache.get(key)
+        if flight is not None:
+            digest, _, started = flight
+            self.cache.set(key, (digest, ticket, started), self._expiry())
+
+    def release(self, user_id, battle_id):
+        """Forget the in-flight submition of a user after it was graded."""
+        self.cache.delete(self._flight_key(user_id, battle_id))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        for outcome in (ADMITTED, MERGED, IN_FLIGHT, RATE_LIMITED):
+            stats.setdefault(outcome, 0)
+        return stats
+
+    def _decide(self, outcome, ticket):
+        with self._lock:
+            self.counters[outcome] += 1
+        return Decision(outcome, ticket)
+
+    def _expiry(self):
+        return int(self.timeout) + 1
+
+    def _flight_key(self, user_id, battle_id):
+        return 'cs_battles:throttle:flight:%s:%s' % (user_id, battle_id)
+
+    def _current_flight(self, key):
+        flight = self.cache.get(key)
+        if flight is None:
+            return None
+        digest, ticket, started = flight
+        expired = self.clock() - started > self.timeout
+        if expired or (ticket is not None and not self.is_pending(ticket)):
+            self.cache.delete(key)
+            return None
+        return flight
+
+    def _take_token(self, user_id, battle_id):
+        key = 'cs_battles:throttle:bucket:%s:%s' % (user_id, battle_id)
+        lock = key + ':lock'
+        for _ in range(LOCK_ATTEMPTS):
+            # The lock expires by itself if its owner dies
+            if self.cache.add(lock, True, 1):
+                try:
+                    return self._refill_and_take(key)
+                finally:
+                    self.cache.delete(lock)
+            time.sleep(LOCK_WAIT)
+        return False
+
+    def _refill_and_take(self, key):
+        now = self.clock()
+        tokens, refilled = self.cache.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - refilled) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.cache.set(key, (tokens, now), int(self.refill_time) + 1)
+        return allowed
+
+
+class Unthrottled:
+    """Throttle that admits every submition."""
+
+    def admit(self, user_id, battle_id, source):
+        return Decision(ADMITTED, None)
+
+    def started(self, user_id, battle_id, ticket):
+        pass
+
+    def release(self, user_id, battle_id):
+        pass
+
+    def stats(self):
+        return {}
+
+
+UNTHROTTLED = Unthrottled()
@@ -7,7 +7,17 @@ urlpatterns = [
     url(r'^',views.BattleCRUDView.as_include(namespace='battles')),
     url(r'^battle/(?P<battle_pk>\d+)$', views.battle, name='battle'),
     url(r'^user$',views.battle_user, name='user_battle'),
+    url(r'^user/data$',views.battle_user_data, name='user_battle_data'),
+    url(r'^list/data$',views.battle_list_data, name='list_data'),
+    url(r'^ranking$',views.ranking, name='ranking'),
+    url(r'^metrics$',views.metrics_export, name='metrics'),
     url(r'^accept$',views.battle_invitation,name="accept_battle"),
+    url(r'^invite/(?P<battle_pk>\d+)$',views.battle_bulk_invite,name="bulk_invite"),
     url(r'^invitations$',views.invitations, name="view_invitation"),
     url(r'^surrender/(?P<battle_pk>\d+)$',views.battle_give_up,name="surrender"),
+    url(r'^events/(?P<battle_pk>\d+)$',views.battle_events,name="events"),
+    url(r'^api/(?P<battle_pk>\d+)/status$',views.api_battle_status,name="api_status"),
+    url(r'^api/(?P<battle_pk>\d+)/standings$',views.api_battle_standings,name="api_standings"),
+    url(r'^api/user$',views.api_user_battles,name="api_user_battles"),
+    url(r'^submition/(?P<item_pk>\d+)$',views.submition_status,name="submition_status"),
 ]
@@ -1,31 +1,128 @@
 from django.shortcuts import render,redirect
-from django.http import Http404,HttpResponse
+from django.http import (Http404,HttpResponse,HttpResponseForbidden,
+                         HttpResponseNotAllowed,StreamingHttpResponse)
+from django.db.models import Q
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.paginator import InvalidPage, Paginator
+from django.views.decorators.http import condition
 from cs_questions.models.coding_io import CodingIoQuestion
 from cs_core.models import ProgrammingLanguage, ResponseContext
-from .models import BattleResponse, Battle
+from cs_core.models import ResponseItem
+from .models import BattleResponse, Battle, BattleStats, SandboxReport
+from . import archive
+from . import events
+from . import grading
+from . import metrics
+from . import queries
+from . import throttle
+from . import results
+from . import sandbox
+from .datatables import DataTable
+from .filters import date_format
 from datetime import datetime
 from viewpack import CRUDViewPack
 from django.views.generic.edit import ModelFormMixin
+import hashlib
 import json
+import logging
+import time
 #from .forms import  BattleForm
 
+logger = logging.getLogger(__name__)
+
 MAXIMUM_POINT = 100
 AC = 0
 WA = 1
 LIMIT = 2
+PENDING = 3
+THROTTLED = 4
+BUSY = 5
+TLE = 6
+MLE = 7
+OLE = 8
+ERROR = 9
 MESSAGES = {
                 AC: "Sua questão está certa",
                 WA: "Está errada",
                 LIMIT: "Atingiu limite de submissões",
+                PENDING: "Sua submissão está sendo corrigida",
+                THROTTLED: "Muitas submissões, aguarde um pouco",
+                BUSY: "Aguarde a correção da sua submissão anterior",
+                TLE: "Tempo limite de execução excedido",
+                MLE: "Limite de memória excedido",
+                OLE: "Limite de saída excedido",
+                ERROR: "Erro na correção da sua submissão",
+            }
+OUTCOMES = {
+                AC: 'AC',
+                WA: 'WA',
+                LIMIT: 'LIMIT',
+                PENDING: 'PENDING',
+                THROTTLED: 'THROTTLED',
+                BUSY: 'BUSY',
+                TLE: 'TLE',
+                MLE: 'MLE',
+                OLE: 'OLE',
+                ERROR: 'ERROR',
+            }
+# Sandbox statuses of the submitions that exceeded a limit or failed
+VIOLATION_STATUS = {
+                sandbox.TIME_LIMIT: TLE,
+                sandbox.MEMORY_LIMIT: MLE,
+                sandbox.OUTPUT_LIMIT: OLE,
+                sandbox.ERROR: ERROR,
             }
+
+def grade_status(response_item):
+    """Return the status code for a graded or pending response item"""
+    if grading.is_pending(response_item):
+        return PENDING
+    given_grade = response_item.given_grade
+    if given_grade == MAXIMUM_POINT:
+        return AC
+    sandbox_status = SandboxReport.objects.filter(item_id=response_item.pk) \
+                                  .values_list('status',flat=True).first()
+    if sandbox_status in VIOLATION_STATUS:
+        return VIOLATION_STATUS[sandbox_status]
+    MESSAGES[WA]="Está errada: %.2f%%"%float(given_grade)
+    return WA
+
+def admitted_submition(battle_response,user_id,code,give_up=False):
+    """
+    Submit the code if the throttle admits it. Return the status code and the
+    ticket that the client should follow.
+    """
+    submition_throttle = throttle.get_throttle()
+    battle_id = battle_response.battle_id
+    decision = submition_throttle.admit(user_id,battle_id,code)
+    if decision.outcome == throttle.MERGED:
+        return PENDING, decision.ticket
+    elif decision.outcome == throttle.IN_FLIGHT:
+        return BUSY, decision.ticket
+    elif decision.outcome == throttle.RATE_LIMITED:
+        return THROTTLED, None
+    try:
+        response_item = battle_response.submit_code(code,give_up=give_up)
+    except Exception:
+        submition_throttle.release(user_id,battle_id)
+        raise
+    status_code = grade_status(response_item)
+    if status_code == PENDING:
+        submition_throttle.started(user_id,battle_id,response_item.pk)
+    else:
+        submition_throttle.release(user_id,battle_id)
+    return status_code, response_item.pk
+
+@metrics.instrumented('battle')
 def battle(request,battle_pk):
-    battle = Battle.objects.get(id=battle_pk)
+    battle = queries.battle_for_submition(battle_pk)
     if request.method == "POST":
         status_code = 0
-        given_grade = 0.0
+        ticket = None
         post = request.POST
         if post:
             # Obtain attributes from post
@@ -33,19 +130,15 @@ def battle(request,battle_pk):
             try:
                 battle_response = battle.battles \
                                 .get(response__user_id=request.user.id)
-                response_item = battle_response.submit_code(battle_code)
-                given_grade = response_item.given_grade
-                battle_is_correct = (response_item.given_grade == MAXIMUM_POINT)
-                if battle_is_correct:
-                    status_code = AC
-                else:
-                    status_code = WA
-                    MESSAGES[WA]="Está errada: %.2f%%"%float(given_grade)
-            except Exception as e:
-                print(e)
+                status_code, ticket = admitted_submition(
+                                battle_response,request.user.id,battle_code)
+            except Exception:
+                logger.exception('Error submitting to battle %s',battle_pk)
                 status_code = LIMIT
+            metrics.SUBMITIONS.inc(outcome=OUTCOMES[status_code])
         context = {
             'status_code':status_code,
+            'ticket':ticket,
             'messages':MESSAGES
         }
         return HttpResponse(json.dumps(context),content_type="application/json")
@@ -53,33 +146,167 @@ def battle(request,battle_pk):
     else:
         return render(request, 'battles/battle.jinja2',{'battle':battle})
 
+@metrics.instrumented('surrender')
 def battle_give_up(request,battle_pk):
     if request.method == "POST":
         post = request.POST
         if post:
-            # Make the submition to prevent errors
-            battle = Battle.objects.get(id=battle_pk)
+            # Make the submition to prevent errors, unless the throttle
+            # rejects it (the previous submition is graded anyway)
+            battle = queries.battle_for_submition(battle_pk)
             battle_response = battle.battles \
                               .get(response__user_id=request.user.id)
-            battle_response.submit_code(post.get("code"))
+            if battle_response.can_submit:
+                admitted_submition(battle_response,request.user.id,
+                                   post.get("code"),give_up=True)
+            # A give up still being graded is finished, and may settle the
+            # winner, when its grade lands
             battle_response.give_up_battle()
     return HttpResponse('')
 
+# Follow a submition ticket returned by the battle view
+@metrics.instrumented('submition_status')
+def submition_status(request,item_pk):
+    try:
+        response_item = ResponseItem.objects.get(
+                                pk=item_pk,
+                                response__user_id=request.user.id
+                            )
+    except ResponseItem.DoesNotExist:
+        raise Http404
+    status_code = grade_status(response_item)
+    context = {
+        'status': 'pending' if status_code == PENDING else 'graded',
+        'given_grade': (None if status_code == PENDING
+                        else float(response_item.given_grade)),
+        'status_code': status_code,
+        'ticket': response_item.pk,
+        'messages': MESSAGES,
+    }
+    return HttpResponse(json.dumps(context),content_type="application/json")
+
+# Stream the events of a battle with Server-Sent Events, only for its owner,
+# challengers and invited users
+def battle_events(request,battle_pk):
+    if not Battle.objects.filter(pk=battle_pk).exists():
+        raise Http404
+    user_id = request.user.id
+    allowed = user_id is not None and Battle.objects.filter(
+        Q(battle_owner_id=user_id)
+        | Q(battles__response__user_id=user_id)
+        | Q(invitations_user=user_id),
+        pk=battle_pk,
+    ).exists()
+    if not allowed:
+        return HttpResponseForbidden()
+    if not events.open_stream():
+        # Clients fall back to polling their submition tickets
+        response = HttpResponse(status=503)
+        response['Retry-After'] = '10'
+        return response
+    try:
+        last_id = int(request.META.get('HTTP_LAST_EVENT_ID')
+                      or request.GET.get('last_event_id', 0))
+    except ValueError:
+        last_id = 0
+    keepalive = getattr(settings, 'BATTLE_EVENTS_KEEPALIVE', 15)
+    duration = getattr(settings, 'BATTLE_EVENTS_MAX_DURATION', 30)
+
+    def stream(last_id):
+        # The browser reconnects with Last-Event-ID when the stream ends
+        layer = events.get_layer()
+        group = events.battle_group(battle_pk)
+        deadline = time.monotonic() + duration
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                timeout = min(keepalive, max(deadline - time.monotonic(), 0))
+                new_events = layer.wait(group, last_id, timeout)
+                for event_id, event_type, data in new_events:
+                    last_id = event_id
+                    yield events.format_event(event_id, event_type, data)
+                if time.monotonic() >= deadline:
+                    return
+                if not new_events:
+                    yield ': keepalive\n\n'
+        finally:
+            events.close_stream()
+
+    response = StreamingHttpResponse(stream(last_id),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 # Define the battles of a user
+@metrics.instrumented('battle_user')
 def battle_user(request):
-    user = request.user
-    battles = BattleResponse.objects.filter(response__user_id=user.id)
+    battles = queries.user_battles(request.user)
     context = {"battles": battles}
     return render(request, 'battles/battle_user.jinja2', context)
 
 
+# Server-side data for the table of battles of a user
+@metrics.instrumented('battle_user_data')
+def battle_user_data(request):
+    battles = queries.user_battles(request.user)
+    table = DataTable(
+        battles,
+        columns=['pk', 'time_begin', 'time_end', 'battle_id'],
+        search_fields=['battle__question__short_description'],
+        render_row=lambda battle: {
+            'DT_RowData': {'battle': battle.battle_id},
+            '0': battle.id,
+            '1': date_format(battle.time_begin),
+            '2': date_format(battle.time_end) if battle.time_end else '',
+            '3': str(battle.battle),
+        },
+    )
+    return table.response(request)
+
+# Server-side data for the list of battles
+@metrics.instrumented('list_data')
+def battle_list_data(request):
+    battles = Battle.objects.with_activity().select_related('question')
+    table = DataTable(
+        battles,
+        columns=['activity', 'pk', 'question__name',
+                 'question__short_description', 'challenge_type'],
+        search_fields=['question__name', 'question__short_description',
+                       'challenge_type'],
+        render_row=lambda battle: {
+            'DT_RowData': {'battle': battle.pk},
+            '0': battle.is_active,
+            '1': battle.pk,
+            '2': str(battle.question),
+            '3': battle.short_description,
+            '4': battle.challenge_type,
+        },
+    )
+    return table.response(request)
+
+# Global ranking and the stats of the current user
+@metrics.instrumented('ranking')
+def ranking(request):
+    size = getattr(settings, 'BATTLE_RANKING_SIZE', 50)
+    stats = BattleStats.objects.filter(user_id=request.user.id).first()
+    context = {
+        'ranking': BattleStats.objects.top(size),
+        'my_stats': stats,
+        'my_rank': stats.rank if stats is not None else None,
+    }
+    return render(request, 'battles/ranking.jinja2', context)
+
+
 # View the invitations
+@metrics.instrumented('invitations')
 def invitations(request):
-    invitations_user = Battle.objects.filter(invitations_user=request.user.id).all()
+    invitations_user = queries.user_invitations(request.user)
     context = {'invitations': invitations_user}
     return render(request,'battles/invitation.jinja2', context)
 
 # Accept the invitation
+@metrics.instrumented('accept_battle')
 def battle_invitation(request):
     if request.method == "POST":
         form_post = request.POST
@@ -92,20 +319,189 @@ def battle_invitation(request):
         elif battle_pk and form_post.get('reject'):
             battle_result = Battle.objects.get(id=battle_pk)
             battle_result.invitations_user.remove(request.user)
+            Battle.bump_version(battle_result.pk)
+            battle_result.determine_winner()
             method_return = redirect(reverse('cs_battles:view_invitation'))
 
     return method_return
 
 def create_battle_response(battle,user):
-    response = battle.question.get_response(
-                                user=user,
-                                context=battle.battle_context
-                                )
-    battle_response = BattleResponse.objects.get_or_create(
-        response=response,
-        battle=battle
+    battle.enroll_users([user])
+
+# Invite or enroll many users at once, only the battle owner can do it
+@metrics.instrumented('bulk_invite')
+def battle_bulk_invite(request,battle_pk):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+    battle = queries.battle_for_submition(battle_pk)
+    if battle.battle_owner_id != request.user.id:
+        return HttpResponseForbidden()
+    users = User.objects.filter(
+        Q(pk__in=[x for x in request.POST.getlist('users') if x.isdigit()])
+        | Q(username__in=request.POST.getlist('users'))
     )
-    battle.invitations_user.remove(user)
+    if request.POST.get('enroll'):
+        context = {'enrolled': len(battle.enroll_users(users))}
+    else:
+        context = {'invited': battle.invite_users(users)}
+    return HttpResponse(json.dumps(context),content_type="application/json")
+
+# JSON API ----------------------------------------------------------------------
+# Polling clients send the ETag back and are answered with 304 after reading
+# a single battle row.
+def battle_state(request,battle_pk):
+    """(version, updated) of a battle, read once per request"""
+    if not hasattr(request,'_battle_state'):
+        request._battle_state = Battle.objects.filter(pk=battle_pk) \
+                                      .values_list('version','updated') \
+                                      .first()
+    return request._battle_state
+
+def battle_etag(request,battle_pk):
+    state = battle_state(request,battle_pk)
+    if state is not None:
+        return 'battle-%s-%s' % (battle_pk,state[0])
+
+def standings_etag(request,battle_pk):
+    state = battle_state(request,battle_pk)
+    if state is not None:
+        return 'standings-%s-%s-%s' % (battle_pk,state[0],
+                                       request.GET.get('page',1))
+
+def battle_last_modified(request,battle_pk):
+    state = battle_state(request,battle_pk)
+    if state is not None:
+        return state[1]
+
+def user_battles_state(request):
+    if not hasattr(request,'_battles_state'):
+        request._battles_state = list(
+            Battle.objects.filter(battles__response__user_id=request.user.id)
+                          .order_by('pk')
+                          .values_list('pk','version','updated'))
+    return request._battles_state
+
+def user_battles_etag(request):
+    versions = ','.join('%s:%s' % row[:2] for row in user_battles_state(request))
+    return 'user-%s-%s' % (request.user.id,
+                           hashlib.sha1(versions.encode()).hexdigest())
+
+def user_battles_last_modified(request):
+    return max((row[2] for row in user_battles_state(request)),default=None)
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+def json_response(data):
+    return HttpResponse(json.dumps(data),content_type="application/json")
+
+@metrics.instrumented('api_status')
+@condition(etag_func=battle_etag,last_modified_func=battle_last_modified)
+def api_battle_status(request,battle_pk):
+    try:
+        battle = queries.battle_summary().get(pk=battle_pk)
+    except Battle.DoesNotExist:
+        raise Http404
+    winner = battle.battle_winner
+    return json_response({
+        'battle': battle.pk,
+        'version': battle.version,
+        'updated': isoformat(battle.updated),
+        'challenge_type': battle.challenge_type,
+        'mass': battle.mass,
+        'active': battle.is_active,
+        'active_count': battle.active_count,
+        'finished_count': battle.finished_count,
+        'pending_invitations': battle.pending_invitations,
+        'limit_submitions': battle.limit_submitions,
+        'finished_at': isoformat(battle.finished_at),
+        'winner': {
+            'battle_response': winner.pk,
+            'user': str(winner.response.user),
+        } if winner else None,
+    })
+
+@metrics.instrumented('api_standings')
+@condition(etag_func=standings_etag,last_modified_func=battle_last_modified)
+def api_battle_standings(request,battle_pk):
+    try:
+        battle = Battle.objects.get(pk=battle_pk)
+    except Battle.DoesNotExist:
+        raise Http404
+    if battle.archived:
+        rows = archive.standings(battle)
+    else:
+        rows = queries.standings(battle)
+    paginator = Paginator(rows,getattr(settings,'BATTLE_MASS_PAGE_SIZE',50))
+    try:
+        page = paginator.page(request.GET.get('page',1))
+    except InvalidPage:
+        raise Http404
+    standings = []
+    for position,row in enumerate(page.object_list,page.start_index()):
+        duration = row.get('duration')
+        standings.append({
+            'position': position,
+            'battle_response': row['pk'],
+            'user': row['response__user__username'],
+            'submitions': row['submitions_used'],
+            'give_up': row['give_up'],
+            'correct': not row['incorrect'],
+            'length': row.get('source_length'),
+            'duration': duration.total_seconds() if duration else None,
+            'runtime': row.get('runtime'),
+        })
+    return json_response({
+        'battle': battle.pk,
+        'version': battle.version,
+        'page': page.number,
+        'pages': paginator.num_pages,
+        'count': paginator.count,
+        'standings': standings,
+    })
+
+@metrics.instrumented('api_user_battles')
+@condition(etag_func=user_battles_etag,
+           last_modified_func=user_battles_last_modified)
+def api_user_battles(request):
+    battles = []
+    for battle_response in queries.user_battles(request.user):
+        battle = battle_response.battle
+        battles.append({
+            'battle': battle.pk,
+            'battle_response': battle_response.pk,
+            'question': str(battle.question),
+            'challenge_type': battle.challenge_type,
+            'time_begin': isoformat(battle_response.time_begin),
+            'time_end': isoformat(battle_response.time_end),
+            'submitions': battle_response.submitions_used,
+            'give_up': battle_response.give_up,
+            'finished': battle_response.finished,
+            'winner': battle.battle_winner_id == battle_response.pk,
+        })
+    return json_response({'battles': battles})
+
+# Prometheus metrics of this process, for staff users or scrapers sending
+# "Authorization: Bearer <BATTLE_METRICS_TOKEN>"
+def metrics_export(request):
+    token = getattr(settings, 'BATTLE_METRICS_TOKEN', None)
+    given = request.META.get('HTTP_AUTHORIZATION','')
+    if not request.user.is_staff and not (
+            token and constant_time_compare(given,'Bearer '+token)):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.REGISTRY.render(),
+                        content_type='text/plain; version=0.0.4')
+
+class InstrumentedMixin:
+    """Track the CRUD views, rendering the response inside the tracker"""
+    metrics_name = None
+
+    def dispatch(self, request, *args, **kwargs):
+        with metrics.track_view(self.metrics_name):
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+        return response
 
 class BattleCRUDView(CRUDViewPack):
     model = Battle
@@ -115,7 +511,8 @@ class BattleCRUDView(CRUDViewPack):
     raise_404_on_permission_error = False
     exclude_fields = ['battle_owner','battle_winner','battle_context']
 
-    class CreateMixin:
+    class CreateMixin(InstrumentedMixin):
+        metrics_name = 'create'
 
         def get_success_url(self):
             return reverse("cs_battles:battle",kwargs={'battle_pk': self.object.pk})
@@ -137,13 +534,46 @@ class BattleCRUDView(CRUDViewPack):
             create_battle_response(self.object,self.request.user)
             return super(ModelFormMixin, self).form_valid(form)
 
-    class DetailViewMixin:
-        def get_object(self,queryset=None):
-            object = super().get_object(queryset)
-            object.determine_winner()
-            return object
+    class ListViewMixin(InstrumentedMixin):
+        metrics_name = 'list'
+        def get_queryset(self):
+            return super().get_queryset().with_activity()
+
+    class DetailViewMixin(InstrumentedMixin):
+        metrics_name = 'detail'
+        def get_queryset(self):
+            return queries.battle_summary(super().get_queryset())
+
+        def get_standings(self):
+            if self.object.archived:
+                rows = archive.standings(self.object)
+            else:
+                rows = queries.standings(self.object)
+            paginator = Paginator(
+                rows,
+                getattr(settings, 'BATTLE_MASS_PAGE_SIZE', 50)
+            )
+            try:
+                return paginator.page(self.request.GET.get('page', 1))
+            except InvalidPage:
+                return paginator.page(1)
 
         def get_context_data(self, **kwargs):
+                if self.object.mass:
+                    kwargs['standings'] = self.get_standings()
+                battle_results = results.get_results(self.object)
+                if battle_results is not None:
+                    # Finished battles are rendered from the results cache
+                    return super().get_context_data(
+                        all_battles=self.object.battles.all(),
+                        results_html=battle_results['html'],
+                        **kwargs)
+                participants = results.load_participants(self.object) \
+                                      .participants
                 return super().get_context_data(
-                    all_battles=self.object.battles.all(),**kwargs)
+                    all_battles=participants,
+                    active_battles=[br for br in participants if br.activity],
+                    pending_users=self.object.pending_users,
+                    results_html=None,
+                    **kwargs)
 